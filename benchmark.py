@@ -0,0 +1,544 @@
+'''
+    End to end latency benchmarks. The real modules run against simulated
+    pins (hardware.Sim_Backend) and a fake plivo gateway on localhost, so
+    this can run anywhere. Two paths are measured:
+
+      webhook - signed POST to the SMS_Monitor web server, through the
+        webhook pipeline, the multiprocessing queue, the event core and
+        garage.route_message to Door.press_button pulling the relay low
+      edge - reed switch edge through Door._door_moving_callback, the
+        settle timer and _publish_event to the SMS arriving at the gateway
+
+    The webhook path also times one /metrics scrape, with this process's
+    metrics published the way the main process does.
+
+    and a stress test of the door locks:
+
+      locks - every door pressed, settled and read as fast as possible
+        from its own thread, for 1, 2, 4 ... doors, with each door on its
+        own lock and (for comparison) all on one shared lock. The pins are
+        on a simulated port expander, so each pin read or write takes a
+        little while. Lock order checking (locks.py) is on and violations
+        are counted.
+
+    Each path reports p50/p95/p99/max latency and throughput under load
+    from several concurrent clients. Results (with the git commit) are
+    saved as JSON, and can be compared to an earlier run:
+
+      python benchmark.py
+      python benchmark.py --compare bench_results/<old commit>.json
+'''
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from multiprocessing import Queue
+import subprocess
+import threading
+import argparse
+import tempfile
+import urllib
+import platform
+import logging
+import httplib
+import socket
+import sys
+import json
+import uuid
+import time
+import ssl
+import os
+
+import const
+
+# Defaults for the command line options
+WEBHOOK_REQUESTS = 400
+WEBHOOK_CLIENTS = 8
+EDGE_CYCLES = 50
+EDGE_DOORS = 4
+# Most doors in the lock stress test, and secs each run lasts
+LOCK_DOORS = 8
+LOCK_SECS = 1.0
+# Secs a pin read or write takes in the lock stress test, about an I2C
+# port expander
+LOCK_IO_TIME = 0.0002
+# Secs the fake gateway takes to answer, roughly a plivo round trip
+GATEWAY_DELAY = 0.0
+# Secs the relay is held down and the door waits after an edge. The real
+# values are much longer, they would only add a constant to every number.
+PRESS_TIME = 0.01
+SETTLE_TIME = 0.05
+WEBHOOK_PORT = 5443
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_results")
+
+l = logging.getLogger(__name__)
+
+
+def percentile(values, pct):
+    """ Nearest rank percentile of a sorted list """
+    if not values:
+        return None
+    rank = int(round(pct / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def latency_summary(latencies, elapsed):
+    """ Dict of the numbers we report for one path, times in millisecs """
+    s = sorted(latencies)
+    ms = lambda v: None if v is None else round(v * 1000.0, 3)
+    return {
+        "count": len(s),
+        "p50_ms": ms(percentile(s, 50)),
+        "p95_ms": ms(percentile(s, 95)),
+        "p99_ms": ms(percentile(s, 99)),
+        "max_ms": ms(s[-1] if s else None),
+        "mean_ms": ms(sum(s) / len(s) if s else None),
+        "elapsed_secs": round(elapsed, 3),
+        "per_sec": round(len(s) / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+def match_in_order(sent, arrived):
+    """
+        Latencies for events that are handled first in first out, e.g. the
+        presses for one door. With concurrent clients two requests can swap
+        places on the way, the total (and so the mean) is still exact.
+    """
+    return [b - a for a, b in zip(sorted(sent), sorted(arrived))]
+
+
+def commit_id():
+    """ Current git commit, None if we aren't in a git checkout """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Fake_Gateway(ThreadingMixIn, HTTPServer):
+    """
+        Stands in for the plivo REST api. Every message sent is kept as
+        (time received, dst, text).
+    """
+    daemon_threads = True
+
+    def __init__(self, delay=GATEWAY_DELAY):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), _Gateway_Handler)
+        self.delay = delay
+        self.received = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self.serve_forever, name="Fake_Gateway")
+        self._thread.daemon = True
+        self._thread.start()
+        return
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def record(self, params):
+        t = time.time()
+        with self._cond:
+            self.received.append((t, params.get("dst"), params.get("text")))
+            self._cond.notify_all()
+        return
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        return
+
+
+class _Gateway_Handler(BaseHTTPRequestHandler):
+    # Keep connections open like plivo does, replies in one write
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader("content-length", 0)))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.server.record(json.loads(body))
+        reply = json.dumps({"api_id": str(uuid.uuid4()), "message": "message(s) queued",
+                "message_uuid": [str(uuid.uuid4())]})
+        self.send_response(202)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+        return
+
+    def log_message(self, format, *args):
+        return
+
+
+def _wait_for_port(port, process, timeout=60):
+    ctx = ssl._create_unverified_context()
+    end = time.time() + timeout
+    while time.time() < end and process.is_alive():
+        try:
+            s = ctx.wrap_socket(socket.create_connection(("127.0.0.1", port), 1))
+            s.close()
+            return True
+        except (socket.error, ssl.SSLError):
+            time.sleep(0.05)
+    return False
+
+
+def bench_webhook(sim, doors, requests=WEBHOOK_REQUESTS, clients=WEBHOOK_CLIENTS,
+        port=WEBHOOK_PORT):
+    """
+        POST signed 'i' / 'h' commands to SMS_Monitor and time them until
+        the door's relay pin goes low. doors maps the command to the Door.
+    """
+    import garage
+    import runtime
+    import sms_monitor
+    from webhook_pipeline import Signature_Validator
+
+    signer = Signature_Validator(sms_monitor.WEBHOOK_URI, const.auth_token)
+    sent = dict((cmd, []) for cmd in doors)
+    pressed = dict((cmd, []) for cmd in doors)
+    for cmd, door in doors.items():
+        def on_relay(value, times=pressed[cmd]):
+            if value == sim.gpio.LOW:
+                times.append(time.time())
+        sim.gpio.watch_output(door.push_button_pin, on_relay)
+
+    q = Queue()
+    monitor = sms_monitor.SMS_Monitor(q, port=port)
+    monitor.daemon = True
+    monitor.start()
+    core = runtime.Event_Core(q, garage.route_message)
+    core_thread = threading.Thread(target=core.run, name="Event_Core")
+    core_thread.daemon = True
+    core_thread.start()
+    if not _wait_for_port(port, monitor):
+        monitor.terminate()
+        raise RuntimeError("SMS_Monitor didn't start on port {}".format(port))
+
+    cmds = sorted(doors)
+    errors = []
+    statuses = []
+
+    def client(n, count):
+        ctx = ssl._create_unverified_context()
+        conn = httplib.HTTPSConnection("127.0.0.1", port, context=ctx)
+        for i in range(count):
+            cmd = cmds[(n + i) % len(cmds)]
+            form = {"From": const.Ivan_cell, "To": const.number, "Text": cmd,
+                    "MessageUUID": str(uuid.uuid1())}
+            body = urllib.urlencode(form)
+            headers = {"Content-Type": "application/x-www-form-urlencoded",
+                    "X-Plivo-Signature": signer.signature(form)}
+            sent[cmd].append(time.time())
+            try:
+                conn.request("POST", "/", body, headers)
+                resp = conn.getresponse()
+                resp.read()
+                statuses.append(resp.status)
+            except (httplib.HTTPException, socket.error) as e:
+                errors.append(e)
+                conn.close()
+                continue
+            if resp.getheader("connection", "").lower() == "close":
+                conn.close()
+        conn.close()
+        return
+
+    per_client = max(requests // clients, 1)
+    total = per_client * clients
+    start = time.time()
+    threads = [threading.Thread(target=client, args=(n, per_client)) for n in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Presses for a door run one at a time, each holds it for the press time
+    end = time.time() + 30 + total * PRESS_TIME
+    while sum(len(p) for p in pressed.values()) < total and time.time() < end:
+        time.sleep(0.01)
+    elapsed = max(max(p) for p in pressed.values() if p) - start if \
+            any(pressed.values()) else 0.0
+    scrape = scrape_metrics(port)
+
+    core.stop()
+    monitor.terminate()
+    monitor.join()
+    latencies = []
+    for cmd in cmds:
+        latencies += match_in_order(sent[cmd], pressed[cmd])
+    result = latency_summary(latencies, elapsed)
+    result["requests"] = total
+    result["clients"] = clients
+    result["lost"] = total - len(latencies)
+    result["errors"] = len(errors)
+    result["not_200"] = len([s for s in statuses if s != 200])
+    result["metrics"] = scrape
+    return result
+
+
+def scrape_metrics(port):
+    """
+        Publish this (main) process's metrics and time a /metrics scrape of
+        the SMS process, which adds them to its own
+    """
+    import metrics
+
+    metrics.publish("main")
+    ctx = ssl._create_unverified_context()
+    conn = httplib.HTTPSConnection("127.0.0.1", port, context=ctx)
+    start = time.time()
+    conn.request("GET", "/metrics")
+    resp = conn.getresponse()
+    body = resp.read()
+    elapsed = time.time() - start
+    conn.close()
+    samples = [line for line in body.splitlines() if line and not line.startswith("#")]
+    return {"status": resp.status, "scrape_ms": elapsed * 1000.0,
+            "samples": len(samples),
+            "metrics": len([line for line in body.splitlines() if line.startswith("# TYPE")])}
+
+
+def bench_edge(sim, doors, gateway, cycles=EDGE_CYCLES):
+    """
+        Open and close each door cycles times, all doors at the same time,
+        and time each reed switch edge until its SMS gets to the gateway.
+    """
+    from door import Door
+    number = "15550000001"
+    messages = {}
+    for door in doors:
+        door.sub_event(Door.OPEN_E, number)
+        door.sub_event(Door.CLOSE_E, number)
+        messages[door.name] = (door.OPEN_E.msg, door.CLOSE_E.msg)
+    edges = dict((door.name, []) for door in doors)
+    before = len(gateway.received)
+    timeout = 10 + Door._settle_time
+
+    def drive(door):
+        sim_door = sim.doors[door.push_button_pin]
+        seen = before
+        for i in range(cycles * 2):
+            msg = messages[door.name][i % 2]
+            edges[door.name].append(time.time())
+            sim_door.press()
+            # Wait for our message before moving the door again, so every
+            # edge is a new settle and not folded into the last one
+            end = time.time() + timeout
+            while time.time() < end:
+                if any(text == msg for t, dst, text in gateway.received[seen:]):
+                    break
+                time.sleep(0.001)
+            seen = len(gateway.received)
+        return
+
+    start = time.time()
+    threads = [threading.Thread(target=drive, args=(d,)) for d in doors]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    received = gateway.received[before:]
+    elapsed = (received[-1][0] - start) if received else 0.0
+    latencies = []
+    for door in doors:
+        arrived = [t for t, dst, text in received if text in messages[door.name]]
+        latencies += match_in_order(edges[door.name], arrived)
+    result = latency_summary(latencies, elapsed)
+    result["doors"] = len(doors)
+    result["lost"] = len(doors) * cycles * 2 - len(latencies)
+    result["settle_ms"] = Door._settle_time * 1000.0
+    return result
+
+
+def bench_locks(max_doors=LOCK_DOORS, secs=LOCK_SECS, io_time=LOCK_IO_TIME):
+    """
+        Door operations per sec for 1, 2, 4 ... max_doors doors, each door
+        driven by its own thread, with per door locks and with one shared
+        lock. A door operation is a button press, a settle (state check,
+        history and publish) and a status read.
+    """
+    from door import Door
+    import hardware
+    import locks
+
+    def drive(door, stop, counts, i):
+        n = 0
+        while not stop.is_set():
+            door.press_button(None, ["x"])
+            door._door_settled()
+            door.get_status()
+            n += 1
+        counts[i] = n
+        return
+
+    locks.enable_debug()
+    before = len(locks.violations)
+    result = {}
+    counts_run = [1]
+    while counts_run[-1] * 2 <= max_doors:
+        counts_run.append(counts_run[-1] * 2)
+    for n in counts_run:
+        for mode in ("per_door", "shared"):
+            sim = hardware.Sim_Backend(io_time=io_time)
+            shared = threading.RLock() if mode == "shared" else None
+            doors = []
+            for i in range(n):
+                reed_pin, relay_pin = 300 + i, 400 + i
+                sim.add_door(reed_pin, relay_pin)
+                doors.append(Door(reed_pin, relay_pin, "Lock{}_{}".format(mode, i),
+                        shared, sim, press_time=0))
+            stop = threading.Event()
+            counts = [0] * n
+            threads = [threading.Thread(target=drive, args=(d, stop, counts, i))
+                    for i, d in enumerate(doors)]
+            start = time.time()
+            for t in threads:
+                t.start()
+            time.sleep(secs)
+            stop.set()
+            for t in threads:
+                t.join()
+            result["{}_{}".format(mode, n)] = round(sum(counts) / (time.time() - start), 1)
+    result["violations"] = len(locks.violations) - before
+    locks.disable_debug()
+    return result
+
+
+def compare(old, new):
+    """ Lines showing how each number changed from the old results """
+    lines = ["Compared to {}:".format(old.get("commit"))]
+    for path in ("webhook", "edge"):
+        if path not in old or path not in new:
+            continue
+        for k in ("p50_ms", "p95_ms", "p99_ms", "max_ms", "per_sec"):
+            a, b = old[path].get(k), new[path].get(k)
+            if a is None or b is None:
+                continue
+            change = (b - a) * 100.0 / a if a else 0.0
+            lines.append("  {:8} {:8} {:10} -> {:10} ({:+.1f}%)".format(path, k, a, b, change))
+    return "\n".join(lines)
+
+
+def run(args):
+    """ Set up the simulated garage, run both paths and return the results """
+    import garage_shared as GS
+    import sms_dispatcher
+    import sms_coalescer
+    import sms_monitor
+    import hardware
+    import garage
+    from door import Door
+
+    data_dir = tempfile.mkdtemp(prefix="garage_bench_")
+    const.DOOR_DATA_DIR = data_dir + "/"
+    sms_monitor.LOG_DIR = data_dir + "/"
+    gateway = Fake_Gateway(args.gateway_delay)
+    sms_dispatcher.PLIVO_URL = gateway.url
+    # No rate limits, the numbers are the time through our own code
+    GS.dispatcher = sms_dispatcher.SMS_Dispatcher(rate=None, number_rate=None)
+    # The edge path times each event through to the gateway, so send them
+    # without waiting for a coalescing window
+    GS.coalescer = sms_coalescer.SMS_Coalescer(window=0)
+    Door._BTN_PRESS_TIME = args.press_time
+    Door._settle_time = args.settle_time
+    Door._BOUNCE_TIME = 0
+
+    results = {
+        "commit": commit_id(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "host": platform.node(),
+        "config": {
+            "gateway_delay": args.gateway_delay,
+            "press_time": args.press_time,
+            "settle_time": args.settle_time,
+        },
+    }
+
+    if args.path in ("all", "webhook"):
+        # No subscribers, so moving the doors doesn't send anything
+        sim = hardware.Sim_Backend()
+        for abbr, reed_pin, relay_pin, name in (("h", 16, 9, "Heather"),
+                ("i", 26, 25, "Ivan")):
+            sim.add_door(reed_pin, relay_pin)
+            garage.doors[abbr] = Door(reed_pin, relay_pin, name, None, sim, abbr)
+        garage.f_map = garage.build_f_map()
+        results["webhook"] = bench_webhook(sim, dict(garage.doors),
+                args.requests, args.clients, args.port)
+
+    if args.path in ("all", "edge"):
+        sim = hardware.Sim_Backend(bounce=True)
+        doors = []
+        for i in range(args.doors):
+            reed_pin, relay_pin = 100 + i, 200 + i
+            sim.add_door(reed_pin, relay_pin)
+            doors.append(Door(reed_pin, relay_pin, "Bench{}".format(i), backend=sim))
+        results["edge"] = bench_edge(sim, doors, gateway, args.cycles)
+        results["edge"]["sms_dispatcher"] = GS.dispatcher.stats.summary()
+
+    if args.path in ("all", "locks"):
+        results["locks"] = bench_locks(args.lock_doors, args.lock_secs)
+
+    gateway.stop()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="garagePi end to end latency benchmarks")
+    parser.add_argument("--path", choices=("all", "webhook", "edge", "locks"), default="all")
+    parser.add_argument("--requests", type=int, default=WEBHOOK_REQUESTS)
+    parser.add_argument("--clients", type=int, default=WEBHOOK_CLIENTS)
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT)
+    parser.add_argument("--cycles", type=int, default=EDGE_CYCLES)
+    parser.add_argument("--doors", type=int, default=EDGE_DOORS)
+    parser.add_argument("--lock-doors", type=int, default=LOCK_DOORS)
+    parser.add_argument("--lock-secs", type=float, default=LOCK_SECS)
+    parser.add_argument("--gateway-delay", type=float, default=GATEWAY_DELAY)
+    parser.add_argument("--press-time", type=float, default=PRESS_TIME)
+    parser.add_argument("--settle-time", type=float, default=SETTLE_TIME)
+    parser.add_argument("--output", help="JSON results file (default bench_results/<commit>.json)")
+    parser.add_argument("--compare", help="Earlier JSON results to compare with")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    results = run(args)
+    for path in ("webhook", "edge"):
+        if path in results:
+            r = results[path]
+            print("{:8} n={} p50 {}ms p95 {}ms p99 {}ms max {}ms, {}/sec, lost {}".format(
+                    path, r["count"], r["p50_ms"], r["p95_ms"], r["p99_ms"],
+                    r["max_ms"], r["per_sec"], r["lost"]))
+    if "webhook" in results:
+        print("webhook  {} errors, {} responses not 200".format(results["webhook"]["errors"],
+                results["webhook"]["not_200"]))
+        r = results["webhook"]["metrics"]
+        print("metrics  /metrics {} in {:.1f}ms, {} metrics, {} samples".format(r["status"],
+                r["scrape_ms"], r["metrics"], r["samples"]))
+    if "locks" in results:
+        r = results["locks"]
+        n = 1
+        while "per_door_{}".format(n) in r:
+            print("locks    {} doors: {}/sec per door locks, {}/sec shared lock".format(n,
+                    r["per_door_{}".format(n)], r["shared_{}".format(n)]))
+            n *= 2
+        print("locks    {} lock order violations".format(r["violations"]))
+
+    output = args.output
+    if output is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, "{}.json".format(
+                (results["commit"] or "unknown")[:12]))
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Saved results to {}".format(output))
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), results))
+    # The scheduler and dispatcher threads are daemons that can wake up in
+    # the middle of the interpreter tearing down modules, skip that
+    sys.stdout.flush()
+    os._exit(0)
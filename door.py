@@ -2,18 +2,25 @@ import garage_shared as GS
 import multiprocessing as mp
 import os
 import time
-import RPi.GPIO as GPIO
-from threading import Timer
+import hardware
+import locks
 import logging
 import const
-import shelve
+import storage
+import sms_dispatcher
+import metrics
 from event import Event
+import history
 
 # Set up module logging
 l = logging.getLogger(__name__)
 l.setLevel(logging.INFO)
 #l.setLevel(logging.DEBUG)
 
+_TRAVEL_SECONDS = metrics.histogram("garage_door_travel_seconds",
+        "Secs from a button press to the last reed switch edge of the move",
+        ["door", "direction"], buckets=metrics.TRAVEL_BUCKETS)
+
 class Door(object):
     """
         This module controls a garage door. It does the following:
@@ -34,13 +41,17 @@ class Door(object):
     _CLOSE_HIST_KEY = "Close history"
     _EVENT_SUB_KEY = "Event subscriptions"
     _default_hist_count = 5
+    _max_hist_count = 25  # Most rows returned for a time range query
     _BTN_PRESS_TIME = 1
     _power_pin = 20
     _initial_wait_time = 2800.0  # Time in secs before first nag msg is sent when door is left opened
     _repeat_wait_time = 2800.0  # Time in secs before repeat nag msg is sent
     _transition_wait_time = 16  # Time in secs to wait for door operation to complete (open/close)
-    _DATA_FILE = '.door_saved_data.db'
-    _data_f = None  # The file that stores persistent data, not thread safe, use one per class
+    _settle_time = 20  # Time in secs after a reed switch edge before checking the door state
+    _BOUNCE_TIME = 2000  # Time in ms that reed switch edges are ignored after one is seen
+    _DATA_FILE = '.door_saved_data.db'  # Preferences file older versions kept (shelve)
+    _old_data = None  # What was in _DATA_FILE, read once if a door needs migrating
+    _storage_lock = locks.storage_lock()  # Guards _old_data, see locks.py for the lock order
     _TIMESTAMP_FORMAT_STR = "%a %b %d %Y @ %I:%M:%S %p"
 
 
@@ -52,6 +63,29 @@ class Door(object):
     DOOR_OPENING_ERROR_E = Event("Door Opening Error Event")
     BUTTON_CLOSE_E = Event("Button Close Event")
     BUTTON_OPEN_E = Event("Button Open Event")
+    # Sent straight away, not held back by the coalescer (sms_coalescer.py)
+    _URGENT_EVENTS = (DOOR_CLOSING_ERROR_E, DOOR_OPENING_ERROR_E)
+    # Door state an event reports, an opened and a closed for the same door
+    # cancel out in the coalescer
+    _EVENT_STATES = {OPEN_E: _OPENED, BUTTON_OPEN_E: _OPENED,
+            CLOSE_E: _CLOSED, BUTTON_CLOSE_E: _CLOSED}
+    # Outbox priority class of an event, anything else is a state change
+    _EVENT_PRIORITIES = {DOOR_CLOSING_ERROR_E: sms_dispatcher.ERROR,
+            DOOR_OPENING_ERROR_E: sms_dispatcher.ERROR,
+            BUTTON_CLOSE_E: sms_dispatcher.CONFIRM, BUTTON_OPEN_E: sms_dispatcher.CONFIRM,
+            TIMER_E: sms_dispatcher.NAG}
+
+    # Settings that can be given per door (see door_config.py), name ->
+    # (attribute, type). Anything not given uses the class default above.
+    SETTINGS = {
+        "power_pin": ("_power_pin", int),
+        "press_time": ("_BTN_PRESS_TIME", float),
+        "initial_wait_time": ("_initial_wait_time", float),
+        "repeat_wait_time": ("_repeat_wait_time", float),
+        "transition_wait_time": ("_transition_wait_time", float),
+        "settle_time": ("_settle_time", float),
+        "bounce_time": ("_BOUNCE_TIME", int),
+    }
 
     @classmethod
     def supported_events(cls):
@@ -95,7 +129,7 @@ class Door(object):
         return self._id
 
     def __init__(self, open_close_state_pin, push_button_pin, door_name,
-            resource_lock):
+            resource_lock=None, backend=None, abbr=None, **settings):
         """
             Initialize the door - set pins, set up logging, etc
             All pin numbering is in BCM mode
@@ -103,10 +137,25 @@ class Door(object):
               is closed or not closed (may be partially opened)
             push_putting_pin: the pin on the PI that triggers the door
             door_name: The name of this door. Used or messaging
-            resource_lock: a shared RLock that prevents contention from
-              multiple doors
+            resource_lock: lock for this door's state, defaults to its own
+              (locks.door_lock), doors don't share one
+            backend: hardware backend for the pins (see hardware.py),
+              defaults to hardware.default_backend()
+            abbr: what the door is called in commands, defaults to the
+              first letter of the name
+            settings: per door values for Door.SETTINGS
         """
+        for setting, value in settings.items():
+            if setting not in Door.SETTINGS:
+                raise ValueError("Unknown door setting {}".format(setting))
+            attr, kind = Door.SETTINGS[setting]
+            setattr(self, attr, kind(value))
+        if resource_lock is None:
+            resource_lock = locks.door_lock(door_name)
         self.lock = resource_lock
+        if backend is None:
+            backend = hardware.default_backend()
+        self._gpio = backend.gpio
         self.lock.acquire()
 
         # Setup logging just for this door
@@ -115,11 +164,22 @@ class Door(object):
 
         # Set up basic instance vars
         self.name = door_name
+        self.abbr = abbr or door_name[0].lower()
         self.open_close_state_pin = open_close_state_pin
         self.push_button_pin = push_button_pin
         self.msg_timer = None
         self._check_door_timer = None
         self.door_last_opened = None
+
+        # Reed switch debounce state, see _door_moving_callback
+        self._edge_lock = locks.edge_lock(door_name)
+        self._settling = False
+        self._edge_pending = False
+        self._settle_timer = None
+        # For the travel time, see _record_travel
+        self._pressed_at = None
+        self._last_edge = None
+        self._edge_listeners = []
         self._id = str(type(self)) + self.name
 
         # Create the events with customized messages
@@ -132,31 +192,20 @@ class Door(object):
         self.BUTTON_CLOSE_E = Door.BUTTON_CLOSE_E.localize("Confirming {}'s door closed. {}".format(self.name, URL))
         self.BUTTON_OPEN_E = Door.BUTTON_OPEN_E.localize("Confirming {}'s door opened. {}".format(self.name, URL))
 
-        # Load any saved data, this includes subscriptions and history
-        if Door._data_f is None:
-            self.l.debug("Opening preferences file [{}]".format(Door._DATA_FILE))
-            Door._data_f = shelve.open(const.DOOR_DATA_DIR + Door._DATA_FILE, writeback=True)
-        if self.name in Door._data_f:
-            self.l.debug("Loading existing data from preferences file")
-            self._saved_data_dict = Door._data_f[self.name]
-        else:  # Build out initial data structures
-            self.l.debug("Building list from scratch")
-            self._saved_data_dict = {
-                Door._OPEN_HIST_KEY: [],
-                Door._CLOSE_HIST_KEY: [],
-                Door._EVENT_SUB_KEY: {}
-            }
-            for e in Door.supported_events():
-                self._saved_data_dict[Door._EVENT_SUB_KEY][e] = []
-            Door._data_f[self.name] = self._saved_data_dict
-            self._sync(first=True)
-        # Should be built out
-        #self.l.debug(str(self._saved_data_dict))
-        self._close_history_list = self._saved_data_dict[Door._CLOSE_HIST_KEY]
-        self._open_history_list = self._saved_data_dict[Door._OPEN_HIST_KEY]
-        self._event_sub_list = self._saved_data_dict[Door._EVENT_SUB_KEY]
+        # Subscriptions are kept in the shared registry
+        self.subscription = GS.get_subscriptions().subscription(self.name,
+                Door.supported_events())
+
+        # Preferences and history are kept in the store, only the newest
+        # history is read in
+        store = GS.get_store()
+        self._saved_data_dict = store.prefs(self.name)
+        self._history = history.Door_History(store, self.name)
+        if not store.migrated("door:{}".format(self.name)):
+            self._migrate()
 
         # Now set up the pins
+        GPIO = self._gpio
         # Multiple processes are setting up pins, so supress warnings
         GPIO.setwarnings(False)
         GPIO.setmode(GPIO.BCM)
@@ -165,8 +214,8 @@ class Door(object):
         # GPIO.setup(self.open_close_state_pin, GPIO.IN, initial=GPIO.LOW,
         GPIO.setup(self.open_close_state_pin, GPIO.IN,
                 pull_up_down=GPIO.PUD_DOWN)
-        GPIO.setup(Door._power_pin, GPIO.OUT, initial=GPIO.LOW)
-        GPIO.output(Door._power_pin, True)
+        GPIO.setup(self._power_pin, GPIO.OUT, initial=GPIO.LOW)
+        GPIO.output(self._power_pin, True)
 
         # Settings for relay switch (door switch)
         GPIO.setup(self.push_button_pin, GPIO.OUT, initial=GPIO.HIGH)
@@ -174,21 +223,21 @@ class Door(object):
         # Set a callback function, when it detects a change
         # this function will be called
         GPIO.add_event_detect(self.open_close_state_pin, GPIO.RISING,
-                callback = self._door_moving_callback, bouncetime=2000)
+                callback = self._door_moving_callback, bouncetime=self._BOUNCE_TIME)
 
         # Now get and set the current state of the door
         self.last_state = self.get_status()
         if self.last_state == Door._OPENED:
             self.l.info("Door already opened at startup")
-            self.msg_timer = Timer(Door._initial_wait_time, self._quiet_time_over)
-            self.msg_timer.start()
+            self.msg_timer = GS.get_scheduler().call_later(self._initial_wait_time,
+                    self._quiet_time_over, name="{} nag".format(self.name))
             self.door_last_opened = Door.now_str()
 
         self.l.info("\n\tName: {0}\n".format(door_name) +
                 "\tProcess name: {0}\n".format(mp.current_process().name) +
                 "\tParent PID: {0}\n".format(os.getppid()) +
                 "\tPID: {0}\n".format(os.getpid()) +
-                "\tPower pin: {0}\n".format(Door._power_pin) +
+                "\tPower pin: {0}\n".format(self._power_pin) +
                 "\tSignal pin: {0}\n".format(open_close_state_pin) +
                 "\tSwitch pin: {0}\n".format(push_button_pin) +
                 "\tCurrent state {0}\n".format(self.get_state_str()))
@@ -197,11 +246,14 @@ class Door(object):
         return  # END __init__
 
     def get_status(self):
-        """ Get and set the current state of the door (open/close) """
-        self.lock.acquire()
-        self.current_state = GPIO.input(self.open_close_state_pin)
-        self.lock.release()
-        return self.current_state
+        """
+            Get and set the current state of the door (open/close). Reading
+            a pin is atomic, so this doesn't need the lock. current_state
+            (and get_state_str) is the last value read, also lock free.
+        """
+        state = self._gpio.input(self.open_close_state_pin)
+        self.current_state = state
+        return state
 
     def snooze_timer(self, from_number, cmds):
         """ Either cancel or snooze the timer"""
@@ -215,7 +267,7 @@ class Door(object):
         # If  # of minutes was specififed (cmds[1]) then set new timer with that delay
         try:
             snooze_time = cmds[1]  # Did user give a time?
-            int(snooze_time)  # Is the argument an int?
+            snooze_secs = int(snooze_time) * 60  # Is the argument an int?
         except IndexError:
             GS.send_message("Okay, {}'s door won't bother you again.", [from_number,])
             return  # No snooze time specified, just return
@@ -227,8 +279,8 @@ class Door(object):
             return
 
         # User specified sleep time - set a timer to check again
-        self.msg_timer = Timer(snooze_time, self._quiet_time_over)
-        self.msg_timer.start()
+        self.msg_timer = GS.get_scheduler().call_later(snooze_secs,
+                self._quiet_time_over, name="{} snooze".format(self.name))
         GS.send_message("Okay, I'll remind you in {} minutes if {}'s door is still open".format(snooze_time, self.name),
                         [from_number,])
         return
@@ -266,32 +318,65 @@ class Door(object):
             self._check_door_timer = None
         begin_state = self.get_status()
         self.l.info("Pushing button {0}'s door".format(self.name))
-        GPIO.output(self.push_button_pin, GPIO.LOW)
+        self._pressed_at = time.time()
+        self._gpio.output(self.push_button_pin, self._gpio.LOW)
+        self.lock.release()
+        # Don't hold the lock while the relay is held down, the relay pin
+        # is only used by this door
         time.sleep(self._BTN_PRESS_TIME)
-        GPIO.output(self.push_button_pin, GPIO.HIGH)
+        self.lock.acquire()
+        self._gpio.output(self.push_button_pin, self._gpio.HIGH)
         self.lock.release()
 
-        self._check_door_timer = Timer(Door._transition_wait_time, self._check_door, [begin_state])
-        self._check_door_timer.start()
+        self._check_door_timer = GS.get_scheduler().call_later(self._transition_wait_time,
+                self._check_door, [begin_state], name="{} button check".format(self.name))
         return
 
     def _door_moving_callback(self, channel):
         """
             This function is called when the reed switch senses a change
             (i.e. door closes or opens). It's possible that it gets false
-            alarms, so do a second check after waiting for the door to finish
-            moving.
+            alarms, so don't wait here - just note the edge and schedule a
+            check for when the door should have finished moving.
+
+            Debounce states:
+              idle - no check scheduled, an edge schedules one
+              settling - check scheduled, edges are noted as pending and
+                cause one more check after the scheduled one
         """
-        self.lock.acquire()
         self.l.debug("Got a callback")
+        self._last_edge = time.time()
+        with self._edge_lock:
+            if self._settling:
+                self._edge_pending = True
+            else:
+                self._start_settle_timer()
+        for fn in self._edge_listeners:
+            fn()
+        return
+
+    def add_edge_listener(self, fn):
+        """ Call fn() on every reed switch edge, it mustn't block """
+        self._edge_listeners.append(fn)
+        return
+
+    def _start_settle_timer(self):
+        """ Schedule a door state check, call with _edge_lock held """
         # 20 secs should be enough time for the door to complete either
-        # opening or closing, wait till it's done, this also helps us
-        # avoid "floating" calls that may happen from time to time
-        time.sleep(20)
+        # opening or closing, this also helps us avoid "floating" calls
+        # that may happen from time to time
+        self._settling = True
+        self._edge_pending = False
+        self._settle_timer = GS.get_scheduler().call_later(self._settle_time,
+                self._door_settled, name="{} settle".format(self.name))
+        return
 
-        # Now see if the door state has changed
+    def _door_settled(self):
+        """ Door should have finished moving, see if its state changed """
+        self.lock.acquire()
         self.get_status()
         if self.current_state != self.last_state:
+            self._record_travel()
             if self.current_state == Door._OPENED:
                 self._door_opened()
                 self.l.debug("In callback, door opened")
@@ -301,11 +386,34 @@ class Door(object):
             self.last_state = self.current_state
         else:
             self.l.debug("In callback, nothing changed")
-
         self.lock.release()
+
+        with self._edge_lock:
+            if self._edge_pending:
+                # More edges came in while settling, check once more
+                self._start_settle_timer()
+            else:
+                self._settling = False
+                self._settle_timer = None
         self.l.debug("Done processing callback")
         return
 
+    def _record_travel(self):
+        """
+            The door moved, if it was because of a button press record the
+            time from the press to its last reed switch edge. The switch is
+            at the closed end, so that's the whole move when closing and
+            until the door cleared the switch when opening.
+        """
+        pressed, edge = self._pressed_at, self._last_edge
+        self._pressed_at = None
+        if pressed is None or edge is None or not (
+                pressed <= edge <= pressed + self._transition_wait_time):
+            return
+        direction = "opening" if self.current_state == Door._OPENED else "closing"
+        _TRAVEL_SECONDS.labels(self.name, direction).observe(edge - pressed)
+        return
+
     def _door_opened(self):
         """
             This function is called when the garage door is detected to have
@@ -320,14 +428,13 @@ class Door(object):
         else:
             # Record the time last opened if event is "new"
             self.door_last_opened = Door.now_str()
-            self._open_history_list.insert(0, self.door_last_opened)
-            self._sync()
+            self._history.record(history.OPEN)
             # Now send msg and set a msg timer so we don't send more messages
             self._publish_event(self.OPEN_E)
 
         # Set a timer so we don't bother with repeated messages
-        self.msg_timer = Timer(Door._initial_wait_time, self._quiet_time_over)
-        self.msg_timer.start()
+        self.msg_timer = GS.get_scheduler().call_later(self._initial_wait_time,
+                self._quiet_time_over, name="{} nag".format(self.name))
         return
 
     def _quiet_time_over(self):
@@ -340,21 +447,26 @@ class Door(object):
         # again in 30 mins
         if self.get_status() == Door._OPENED:
             self._publish_event(self.TIMER_E)
-            self.msg_timer = Timer(Door._repeat_wait_time, self._quiet_time_over)
-            self.msg_timer.start()
+            self.msg_timer = GS.get_scheduler().call_later(self._repeat_wait_time,
+                    self._quiet_time_over, name="{} nag".format(self.name))
         self.l.debug("Leaving quiet timer")
         return
 
     def _publish_event(self, event):
         """ Sends a message via sms to all numbers set up to get messages about the event """
         msg = event.msg
-        if event not in self._event_sub_list:
-            self.l.debug("Event not in list")
-            self.l.debug(str(self._event_sub_list))
-            self.l.debug("Event = {}".format(event))
+        numbers = self.subscription.subscribers(event)
+        if not numbers:
+            self.l.debug("No subscribers for {}".format(event))
         else:
-            GS.send_message(msg, self._event_sub_list[event])
-        self.l.debug("Sent message '{}' to numbers {}".format(msg, str(self._event_sub_list[event])))
+            priority = Door._EVENT_PRIORITIES.get(event.event, sms_dispatcher.STATE)
+            if event.event in Door._URGENT_EVENTS:
+                # Errors go out straight away, everything else is coalesced
+                GS.send_message(msg, sorted(numbers), priority)
+            else:
+                GS.get_coalescer().add(self.name, event, sorted(numbers),
+                        Door._EVENT_STATES.get(event.event), priority)
+        self.l.debug("Sent message '{}' to numbers {}".format(msg, sorted(numbers)))
         return
 
     def _door_closed(self):
@@ -367,74 +479,124 @@ class Door(object):
             self.l.error("Door closed and no open msg_timer - should not happen")
         else:
             self.msg_timer.cancel()
-            self._close_history_list.insert(0, Door.now_str())
-            self._sync()
+            self._history.record(history.CLOSE)
             self.msg_timer = None
             self._publish_event(self.CLOSE_E)
         return
 
-    def _custom_ts_sort(self, ts):
-        """ Sort based on the timestamp we are sending """
-        t = time.strptime(ts[:-8], Door._TIMESTAMP_FORMAT_STR)
-        return time.strftime("%Y%m%d%H%M%S", t)
-
-    def get_history(self, count):
-        """ Return a string of the last n times door opened """
+    def get_history(self, count, since=None, event_type=None):
+        """
+            Return a string of the last n door events. Can be limited to events
+            since an epoch time and to one event type (history.OPEN / CLOSE)
+        """
         if count is None:  # calling arg will always send count
-            count = Door._default_hist_count
+            if since is None:
+                count = Door._default_hist_count
+            else:
+                count = Door._max_hist_count
         else:
             count = int(count)
         ordered_hist_list = []
-        #  Note - (Open) and (Close) strings should be same length to make sorting work
-        for i in self._open_history_list[:count]:
-            ordered_hist_list.append(i + " {:7s}".format("(Open)"))
-        for i in self._close_history_list[:count]:
-            ordered_hist_list.append(i + " {:7s}".format("(Close)"))
-
-        ordered_hist_list.sort(reverse=True,key=self._custom_ts_sort)
-        count = min(count, len(ordered_hist_list))
-        str_list = ["{}'s door history:".format(self.name),] + ordered_hist_list[:count]
+        for t, e in self._history.query(count, since=since, event_type=event_type):
+            ordered_hist_list.append(history.format_record(t, e, Door._TIMESTAMP_FORMAT_STR))
+        str_list = ["{}'s door history:".format(self.name),] + ordered_hist_list
         ret_str = "\n  ".join(str_list)
         return ret_str.replace("@","at")
 
     def sub_event(self, event, phone_number):
         self.l.debug("Got sub event = {} number = {}".format(event, phone_number))
-        self.l.debug("Before: _event_sub_list = {}".format(self._event_sub_list))
-        #self.l.debug("Before: Door._data_f = {}".format(str(Door._data_f)))
-        if phone_number not in self._event_sub_list[event]:
-            self._event_sub_list[event].append(phone_number)
-            self._sync()
-        self.l.debug("After: _event_sub_list = {}".format(self._event_sub_list))
-        #self.l.debug("After: Door._data_f = {}".format(str(Door._data_f)))
+        self.subscription.subscribe(event, phone_number)
         return
 
-    def _sync(self, first=False):
-        """ Provide thread protected access to shelve file """
-        self.lock.acquire()
-        self.l.debug("Before sync")
-        Door._data_f[self.name] = self._saved_data_dict 
-        self._saved_data_dict[Door._CLOSE_HIST_KEY] = self._close_history_list 
-        self._saved_data_dict[Door._OPEN_HIST_KEY] = self._open_history_list 
-        self._saved_data_dict[Door._EVENT_SUB_KEY] = self._event_sub_list 
-        Door._data_f.sync()
-        self.l.debug("After sync")
-        self.lock.release()
+    def _migrate(self):
+        """
+            Move this door's data out of the shared preferences shelve
+            older versions kept (subscriptions, history as strings and
+            anything else). Done once per door.
+        """
+        with Door._storage_lock:
+            if Door._old_data is None:
+                old = storage.open_shelve(const.DOOR_DATA_DIR + Door._DATA_FILE)
+                Door._old_data = dict(old) if old is not None else {}
+                if old is not None:
+                    old.close()
+            saved = dict(Door._old_data.get(self.name, {}))
+        if Door._EVENT_SUB_KEY in saved:
+            count = GS.get_subscriptions().migrate(self.name, saved.pop(Door._EVENT_SUB_KEY))
+            self.l.info("Migrated {} subscriptions".format(count))
+        if Door._OPEN_HIST_KEY in saved:
+            count = self._history.migrate(saved.pop(Door._OPEN_HIST_KEY),
+                    saved.pop(Door._CLOSE_HIST_KEY, []), Door._TIMESTAMP_FORMAT_STR)
+            self.l.info("Migrated {} history records".format(count))
+        for key, value in saved.items():
+            try:
+                GS.get_store().set_pref(self.name, key, value)
+                self._saved_data_dict[key] = value
+            except (TypeError, ValueError):
+                self.l.error("Can't migrate preference {}: {!r}".format(key, value))
+        GS.get_store().mark_migrated("door:{}".format(self.name))
         return
 
     def unsub_event(self, event, phone_number):
         """ Remove phone number from notifications """
-        if phone_number in self._event_sub_list[event]:
-            self._event_sub_list[event].remove(phone_number)
-        self.l.debug("Event notification list: {}".format(self._event_sub_list))
-        self._sync()
+        self.subscription.unsubscribe(event, phone_number)
+        self.l.debug("Unsubscribed {} from {}".format(phone_number, event))
         return
 
     def is_sub_event(self, event, phone_number):
         """ Return true if phone number is subscribed """
-        if event not in self._event_sub_list:
-            self._event_sub_list[event] = []
-        return phone_number in self._event_sub_list[event]
+        return self.subscription.is_subscribed(event, phone_number)
 
 
 if __name__ == "__main__":
-    pass
+    # Two doors moving at the same time on simulated hardware. Each door's
+    # events have to be published within its own travel + settle window,
+    # i.e. neither door waits for the other.
+    import tempfile
+    import threading
+    from sms_dispatcher import SMS_Dispatcher
+    from sms_coalescer import SMS_Coalescer
+
+    class _Sent(object):
+        """ Stand in for plivo, remembers what was sent and when """
+        def __init__(self):
+            self.msgs = []
+        def send_message(self, params):
+            self.msgs.append((time.time(), params['text']))
+            return (202, {})
+
+    const.DOOR_DATA_DIR = tempfile.mkdtemp() + "/"
+    sent = _Sent()
+    GS.dispatcher = SMS_Dispatcher(client=sent, number_rate=None)
+    # Time each event, not the coalescing window
+    GS.coalescer = SMS_Coalescer(window=0)
+    Door._BTN_PRESS_TIME = 0.05
+    Door._settle_time = 0.5
+    Door._transition_wait_time = 0.6
+    travel_time = 0.3
+    window = Door._BTN_PRESS_TIME + travel_time + Door._settle_time + 0.2
+
+    sim = hardware.Sim_Backend(travel_time=travel_time)
+    doors = []
+    for reed_pin, relay_pin, name in ((16, 9, "Heather"), (26, 25, "Ivan")):
+        sim.add_door(reed_pin, relay_pin)
+        doors.append(Door(reed_pin, relay_pin, name, backend=sim))
+    for d in doors:
+        d.sub_event(Door.OPEN_E, "15550000001")
+        d.sub_event(Door.CLOSE_E, "15550000001")
+
+    for action in ("opened", "closed"):
+        # Let the 2 sec edge detect bouncetime from the last move pass
+        time.sleep(2)
+        del sent.msgs[:]
+        start = time.time()
+        for d in doors:
+            threading.Thread(target=d.press_button, args=(None, ["x"])).start()
+        time.sleep(window)
+        for d in doors:
+            times = [t - start for t, msg in sent.msgs
+                    if msg.startswith("{}'s door was {}".format(d.name, action))]
+            ok = len(times) == 1 and times[0] <= window
+            print("{:8} {} in {}: {}".format(d.name, action,
+                    ", ".join("{:.2f}s".format(t) for t in times) or "-",
+                    "ok" if ok else "FAILED"))
@@ -0,0 +1,152 @@
+'''
+    Door configuration. The doors, their pins, command abbreviations and
+    timing come from an ini style file, one section per door, in the order
+    they should be listed:
+
+      [DEFAULT]
+      power_pin = 20
+
+      [Ivan]
+      abbr = i
+      reed_pin = 26
+      relay_pin = 25
+      settle_time = 25
+
+    Anything in Door.SETTINGS (power pin, press time, nag / settle / bounce
+    times) can be given per door or for all doors in [DEFAULT], whatever
+    isn't given uses the Door class default. Doors may share a power pin,
+    but no other pin, and names must differ in more than case. The file is
+    config/doors.cfg, set GARAGE_DOORS in the environment to use another
+    one.
+'''
+from ConfigParser import SafeConfigParser, Error as Parser_Error
+import logging
+import os
+
+ENV_VAR = "GARAGE_DOORS"
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config",
+        "doors.cfg")
+# Options every door section has to have
+REQUIRED = ("abbr", "reed_pin", "relay_pin")
+
+l = logging.getLogger(__name__)
+
+
+class Config_Error(Exception):
+    pass
+
+
+class Door_Config(object):
+    """ One door from the config file """
+
+    def __init__(self, name, abbr, reed_pin, relay_pin, settings=None):
+        self.name = name
+        self.abbr = abbr
+        self.reed_pin = reed_pin
+        self.relay_pin = relay_pin
+        # Door.SETTINGS name -> value
+        self.settings = dict(settings or {})
+        return
+
+    @property
+    def phase_name(self):
+        """ Name of the startup phase that creates the door """
+        return "{}_door".format(self.name.lower())
+
+    def create(self, resource_lock=None, backend=None):
+        """ Make the Door, with its own lock unless one is given """
+        from door import Door
+        return Door(self.reed_pin, self.relay_pin, self.name, resource_lock, backend,
+                abbr=self.abbr, **self.settings)
+
+    def __repr__(self):
+        return "Door_Config({}, {}, reed {}, relay {})".format(self.name, self.abbr,
+                self.reed_pin, self.relay_pin)
+
+
+def config_file():
+    """ The file load() reads by default """
+    return os.environ.get(ENV_VAR) or CONFIG_FILE
+
+
+def _int(section, option, value):
+    try:
+        return int(value)
+    except ValueError:
+        raise Config_Error("[{}] {} must be a number, not '{}'".format(section,
+                option, value))
+
+
+def parse(parser):
+    """ Door_Configs from a SafeConfigParser, checked for clashes """
+    from door import Door
+    doors = []
+    abbrs = {}
+    names = {}
+    pins = {}
+    for section in parser.sections():
+        if section.lower() in names:
+            raise Config_Error("[{}] and [{}] differ only in case".format(
+                    names[section.lower()], section))
+        names[section.lower()] = section
+        options = dict(parser.items(section))
+        for option in REQUIRED:
+            if not options.get(option):
+                raise Config_Error("[{}] has no {}".format(section, option))
+        abbr = options.pop("abbr").strip().lower()
+        if not abbr.isalnum():
+            raise Config_Error("[{}] abbr '{}' must be letters or digits".format(section,
+                    abbr))
+        if abbr in abbrs:
+            raise Config_Error("[{}] and [{}] are both '{}'".format(abbrs[abbr],
+                    section, abbr))
+        abbrs[abbr] = section
+        reed_pin = _int(section, "reed_pin", options.pop("reed_pin"))
+        relay_pin = _int(section, "relay_pin", options.pop("relay_pin"))
+        for pin in reed_pin, relay_pin:
+            if pin in pins:
+                raise Config_Error("[{}] and [{}] both use pin {}".format(pins[pin],
+                        section, pin))
+            pins[pin] = section
+
+        settings = {}
+        for option, value in options.items():
+            if option not in Door.SETTINGS:
+                raise Config_Error("[{}] unknown option {}, use one of {}".format(section,
+                        option, ", ".join(REQUIRED + tuple(sorted(Door.SETTINGS)))))
+            kind = Door.SETTINGS[option][1]
+            try:
+                settings[option] = kind(value)
+            except ValueError:
+                raise Config_Error("[{}] {} must be a number, not '{}'".format(section,
+                        option, value))
+        doors.append(Door_Config(section, abbr, reed_pin, relay_pin, settings))
+    if not doors:
+        raise Config_Error("No doors configured")
+    for door in doors:
+        power_pin = door.settings.get("power_pin", Door._power_pin)
+        if power_pin in pins:
+            raise Config_Error("[{}] power_pin {} is [{}]'s reed or relay pin".format(
+                    door.name, power_pin, pins[power_pin]))
+    return doors
+
+
+def load(path=None):
+    """ Door_Configs from the config file, in file order """
+    if path is None:
+        path = config_file()
+    parser = SafeConfigParser()
+    try:
+        if not parser.read(path):
+            raise Config_Error("Can't read door config {}".format(path))
+    except Parser_Error as e:
+        raise Config_Error("Bad door config {}: {}".format(path, e))
+    doors = parse(parser)
+    l.info("Loaded {} doors from {}".format(len(doors), path))
+    return doors
+
+
+if __name__ == "__main__":
+    for door in load():
+        print("{:10} {:3} reed {:3} relay {:3} {}".format(door.name, door.abbr,
+                door.reed_pin, door.relay_pin, door.settings))
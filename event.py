@@ -1,21 +1,50 @@
+'''
+    Event types. There is one Event per name (they are interned), so
+    events compare and hash by their name and group lookups are a dict
+    lookup. A localized event (e.g. "Ivan's door was opened") is a small
+    Localized_Event that points at its type and carries the message, it
+    isn't added to any group.
+'''
+from collections import OrderedDict
+import threading
+
+
 class Event(object):
 
-    _event_groups = {}
+    __slots__ = ('_name', '_msg', '_my_group', '_hash')
+
+    _registry = {}  # name -> Event
+    _event_groups = {}  # group key -> OrderedDict of Event -> None
+    _lock = threading.Lock()
 
     @classmethod
     def get_events(cls, key="Default"):
-        return cls._event_groups.get(key, [])
+        return list(cls._event_groups.get(key, ()))
 
-    def __init__(self, name, msg=None, group_key="Default"):
-        self._name = name
-        self._msg = msg
-        self._my_group = group_key 
-        groups = Event._event_groups
-        groups[group_key] = groups.get(group_key, []) + [self,]
-        return
+    @classmethod
+    def lookup(cls, name):
+        """ The Event called name, None if there isn't one """
+        return cls._registry.get(name)
+
+    def __new__(cls, name, msg=None, group_key="Default"):
+        with cls._lock:
+            event = cls._registry.get(name)
+            if event is None:
+                event = object.__new__(cls)
+                event._name = name
+                event._msg = msg
+                event._my_group = group_key
+                event._hash = hash(name)
+                cls._registry[name] = event
+                cls._event_groups.setdefault(group_key, OrderedDict())[event] = None
+        return event
 
     def localize(self, msg):
-        return Event(self.name, msg, self._my_group)
+        return Localized_Event(self, msg)
+
+    @property
+    def event(self):
+        return self
 
     @property
     def name(self):
@@ -25,11 +54,28 @@ class Event(object):
     def msg(self):
         return self._msg
 
+    @property
+    def group(self):
+        return self._my_group
+
+    def in_group(self, key):
+        return self in Event._event_groups.get(key, ())
+
     def __hash__(self):
-        return hash(self._name)
+        return self._hash
 
-    def __ne__(self):
-        return not(self == other)
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, (Event, Localized_Event)):
+            return NotImplemented
+        return self._name == other.name
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
 
     def __str__(self):
         return self._name
@@ -37,14 +83,89 @@ class Event(object):
     def __repr__(self):
         return self._name
 
+    def __reduce__(self):
+        return (Event, (self._name, self._msg, self._my_group))
+
+    def __setstate__(self, state):
+        # Events pickled by older versions (a plain __dict__), e.g. in old
+        # preference files
+        if isinstance(state, tuple):
+            state = state[-1]
+        self._name = state['_name']
+        self._msg = state.get('_msg')
+        self._my_group = state.get('_my_group', "Default")
+        self._hash = hash(self._name)
+        return
+
+
+class Localized_Event(object):
+    """ An event type with its own message, equal to (and hashed as) its type """
+
+    __slots__ = ('_event', '_msg')
+
+    def __init__(self, event, msg):
+        self._event = event.event
+        self._msg = msg
+        return
+
+    def localize(self, msg):
+        return Localized_Event(self._event, msg)
+
+    @property
+    def event(self):
+        return self._event
+
+    @property
+    def name(self):
+        return self._event._name
+
+    @property
+    def msg(self):
+        return self._msg
+
+    @property
+    def group(self):
+        return self._event._my_group
+
+    def in_group(self, key):
+        return self._event.in_group(key)
+
+    def __hash__(self):
+        return self._event._hash
+
     def __eq__(self, other):
-        return self._name == other._name
+        return self._event.__eq__(other)
+
+    def __ne__(self, other):
+        return self._event.__ne__(other)
+
+    def __str__(self):
+        return self._event._name
+
+    def __repr__(self):
+        return self._event._name
+
+    def __reduce__(self):
+        return (Localized_Event, (self._event, self._msg))
+
 
 if __name__ == "__main__":
+    import time
 
     grp = "a group"
     a = Event("a", "a msg", grp)
     b = Event("b", "b msg")
     c = Event("c", "c msg", grp)
+    a2 = a.localize("a for Ivan")
+    assert Event("a") is a and a2 == a and not (a2 != a) and a != b
+    assert hash(a2) == hash(a) and a2.in_group(grp) and not b.in_group(grp)
+    print("{}: {}".format(grp, Event.get_events(grp)))
 
-    print(c.__dict__)
+    n = 10000
+    start = time.time()
+    events = [a.localize("msg {}".format(i)) for i in range(n)]
+    print("{} localize calls in {:.1f} ms, {} events in the group".format(n,
+            (time.time() - start) * 1000, len(Event.get_events(grp))))
+    start = time.time()
+    found = sum(1 for e in events if e.in_group(grp))
+    print("{} group checks in {:.1f} ms".format(found, (time.time() - start) * 1000))
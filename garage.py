@@ -5,8 +5,12 @@
 	These are class level references, not instance level
 	All objects referenced here must be thread / multi process safe
 '''
-from multiprocessing import RLock, Queue, Lock
+# Before anything else, so every import can be timed
+import import_profile
+import_profile.enable_from_env()
+from multiprocessing import Queue
 from Queue import Empty
+from collections import OrderedDict
 import garage_shared as GS
 from door import Door
 import time
@@ -16,6 +20,31 @@ import sys
 import const
 import logging
 import sdnotify
+import history
+import runtime
+import startup
+import door_config
+import sms_dispatcher
+import metrics
+
+# Run handlers on a worker pool, one at a time per door (runtime.Event_Core),
+# instead of one at a time on the main thread
+USE_EVENT_CORE = True
+
+# These are set up in __main__ (or by whatever drives this module, e.g.
+# benchmark.py)
+l = logging.getLogger()
+# Door abbreviation -> Door, in config file order
+doors = OrderedDict()
+light_monitor = None
+sms_listener = None
+f_map = {}
+# Door command (press / snooze) -> the door's abbreviation
+door_commands = {}
+
+# Number map just gives a list of valid numbers for the from
+valid_numbers = [const.Ivan_cell, const.Heather_cell, const.Zane_cell]
+extra_notification = [const.Zane_cell, ]
 
 """
     TO DO: Respond to texts to the number that it came from for help and status
@@ -23,21 +52,23 @@ import sdnotify
 
 def list_current_subscriptions(from_number, cmds):
     msg_str = "You'll be notified of the following events:\n"
-    for d in ivan_door, heather_door:
+    # Everything this number gets, in one lookup
+    subscribed = GS.get_subscriptions().subscriptions_for(from_number)
+    for d in doors.values():
+        events = subscribed.get(d.name, ())
         e_str = "{}'s door:\n".format(d.name)
-        #e_str = "{}'s door:\n".format(d.name)
         e_check = len(e_str) # We'll check for changes later
-        if d.is_sub_event(Door.OPEN_E, from_number):
+        if Door.OPEN_E.name in events:
             e_str += " - When door opens\n"
-        if d.is_sub_event(Door.CLOSE_E, from_number):
+        if Door.CLOSE_E.name in events:
             e_str += " - When door closes\n"
-        if d.is_sub_event(Door.TIMER_E, from_number):
+        if Door.TIMER_E.name in events:
             e_str += " - When door is left open\n"
-        if d.is_sub_event(Door.BUTTON_OPEN_E, from_number):
+        if Door.BUTTON_OPEN_E.name in events:
             e_str += " - Confirmation of open\n"
-        if d.is_sub_event(Door.BUTTON_CLOSE_E, from_number):
+        if Door.BUTTON_CLOSE_E.name in events:
             e_str += " - Confirmation of close\n"
-        if d.is_sub_event(Door.DOOR_OPENING_ERROR_E, from_number) or d.is_sub_event(Door.DOOR_CLOSING_ERROR_E, from_number):
+        if Door.DOOR_OPENING_ERROR_E.name in events or Door.DOOR_CLOSING_ERROR_E.name in events:
             e_str += " - If there is an error\n"
         if len(e_str) == e_check:
             # You are not subscribed to anything for this door
@@ -48,23 +79,29 @@ def list_current_subscriptions(from_number, cmds):
     return
 
 def _get_door(door_abbr):
-    door = None
-    if door_abbr == "i":
-        door = ivan_door
-    elif door_abbr == "h":
-        door = heather_door
-    else:
+    door = doors.get(door_abbr)
+    if door is None:
         l.info("Unknown door abbreviation: {}".format(door_abbr))
     return door
 
+def _door_choices():
+    """ e.g. "i or h" for the invalid door messages """
+    abbrs = list(doors)
+    if len(abbrs) < 2:
+        return "".join(abbrs)
+    return "{} or {}".format(", ".join(abbrs[:-1]), abbrs[-1])
+
 def help_text(from_number, cmds):
     """ Respond with the list of valid commands """
-    ret_str = ("s, i, h\n"
-               "[un]sub [i/h] [timer/open/close/error/button]\n"
+    abbrs = "/".join(doors)
+    ret_str = ("s, {}\n"
+               "[un]sub [{}] [timer/open/close/error/button]\n"
                "list\n"
                "?\n"
-               "hist i/h [count]\n"
-               "si/sh [# minutes (optional)")
+               "hist {} [count] [since day/3d/12h] [open/close]\n"
+               "light stats [since day/3d/12h]\n"
+               "{} [# minutes (optional)").format(", ".join(doors), abbrs, abbrs,
+                       "/".join("s" + a for a in doors))
     GS.send_message(ret_str)
     GS.send_message(from_number)
     return
@@ -79,14 +116,31 @@ def get_history(from_number, cmds):
     else:
         door = _get_door(cmds[1])
     if door is None:
-        GS.send_message("Invalid door name '{}'. Use i or h.".format(door), [from_number,])
+        GS.send_message("Invalid door name '{}'. Use {}.".format(door, _door_choices()),
+                        [from_number,])
         return
 
-    if len(cmds) > 2: #We should have a count
-        count = cmds[2]
-    else:
-        count = None
-    ret_str = door.get_history(count)
+    # Optional args in any order: count, since <when>, open/close
+    count = None
+    since = None
+    event_type = None
+    args = cmds[2:]
+    while args:
+        arg = args.pop(0)
+        if arg.isdigit():
+            count = arg
+        elif arg in history.EVENT_TYPES:
+            event_type = history.EVENT_TYPES[arg]
+        elif arg == "since" and args:
+            since = history.parse_since(args.pop(0))
+            if since is None:
+                GS.send_message("Don't know when that is. Use a day, today, 3d or 12h.",
+                                [from_number,])
+                return
+        else:
+            GS.send_message("Unknown history option '{}'.".format(arg), [from_number,])
+            return
+    ret_str = door.get_history(count, since, event_type)
     l.info("In get_history: return msg is: {}".format(ret_str))
     GS.send_message(ret_str)
     return
@@ -100,7 +154,8 @@ def subscribe(from_number, cmds):
     l.info("Got a subscribe command: {}".format(cmds))
     door = _get_door(cmds[1])
     if door is None:
-        GS.send_message("Invalid door name '{}'. Use i or h.".format(cmds[1]), [from_number,])
+        GS.send_message("Invalid door name '{}'. Use {}.".format(cmds[1], _door_choices()),
+                        [from_number,])
         return
 
     event_type = cmds[2]
@@ -132,7 +187,8 @@ def unsubscribe(from_number, cmds):
     l.info("Got an unsubscribe command: {}".format(cmds))
     door = _get_door(cmds[1])
     if door is None:
-        GS.send_message("Invalid door name '{}'. Use i or h.".format(cmds[1]), [from_number, ])
+        GS.send_message("Invalid door name '{}'. Use {}.".format(cmds[1], _door_choices()),
+                        [from_number, ])
         return
 
     event_type = cmds[2]
@@ -156,15 +212,183 @@ def unsubscribe(from_number, cmds):
     GS.send_message("Unsubscribe to {} events for {}'s door confirmed!".format(event_type, door))
     return
 
+def _command_key(cmd_str):
+    """
+        Commands that change a door (press, snooze, subscriptions) run one at
+        a time and in order for that door. Read only ones (status, list,
+        hist, help, light) return None and run alongside anything.
+    """
+    key = door_commands.get(cmd_str[0])
+    if key is not None:
+        return key
+    if cmd_str[0] in ("sub", "unsub"):
+        if len(cmd_str) > 1 and cmd_str[1] in doors:
+            return cmd_str[1]
+        return "subscriptions"
+    return None
+
+def too_busy(msg):
+    """ Let the sender know their command was dropped """
+    GS.send_message("Sorry, too busy right now. Try again in a minute.",
+                    [msg['From'],])
+    return
+
+def route_message(msg):
+    """
+        Check an inbound message and work out what to do with it.
+        Returns (key, handler, args) or None if there's nothing to do.
+        Raises runtime.Shutdown if we've been asked to shut down.
+    """
+    # We might be asked to shut down (e.g. in case of attempted hack)
+    if not msg.has_key('From'):
+        l.info("Invalid message <{0}>".format(msg))
+        raise runtime.Shutdown()
+
+    # check to see if message came from allowed number
+    if msg['From'] not in valid_numbers:
+        l.info("Got command from invalid number")
+        GS.send_message("Got msg from invalid number {0}".format(
+                        msg['From']), priority=sms_dispatcher.ERROR)
+        return None
+    # tell me if Zane is using it
+    if msg['From'] in extra_notification:
+        l.info("Got command from special user")
+        GS.send_message("Got message from Zane")
+
+    # now work out the handler for the message
+    cmd_str = msg['Text'].lower().strip().split()
+    msg_func = f_map.get(cmd_str[0]) if cmd_str else None
+    if msg_func is None:
+        GS.send_message("I don't know that command. Sorry.")
+        l.info("Unknown msg <{0}>".format(msg))
+        return None
+    return _command_key(cmd_str), msg_func, (msg['From'], cmd_str)
+
+def light_stats(from_number, cmds):
+    """ Summary of the light sensor readings, light stats [since] """
+    since = history.parse_since(cmds[2] if len(cmds) > 2 else "1h")
+    if len(cmds) < 2 or cmds[1] != "stats" or since is None:
+        GS.send_message("Use: light stats [since day/3d/12h]", [from_number,])
+        return
+    GS.send_message(light_monitor.get_lux_stats(since), [from_number,])
+    return
+
+def build_f_map():
+    """
+        This is our function map. Based on the type of message (which is just
+        the name of a class), call an associated function. Each door adds
+        <abbr> (press the button) and s<abbr> (snooze), door_commands is
+        filled in to match. Raises door_config.Config_Error if a door
+        command clashes with another command.
+    """
+    global door_commands
+    f_map = { 's': ret_status,
+              'status': ret_status,
+             'help': help_text,
+              '?': help_text,
+              'sub': subscribe,
+              'unsub': unsubscribe,
+              'hist': get_history,
+              'list': list_current_subscriptions,
+              'light': light_stats}
+    commands = {}
+    for abbr, door in doors.items():
+        for cmd, func in ((abbr, door.press_button), ("s" + abbr, door.snooze_timer)):
+            if cmd in f_map:
+                raise door_config.Config_Error("{}'s door command '{}' is already "
+                        "a command".format(door.name, cmd))
+            f_map[cmd] = func
+            commands[cmd] = abbr
+    door_commands = commands
+    return f_map
+
+def start_up(q, door_configs=None):
+    """
+        Create the doors (door_configs, defaults to the ones in the config
+        file) and start the SMS and light monitors, at the same time
+        wherever their dependencies allow. Returns the startup.Startup
+        (which has the timing breakdown) once everything is ready, raises
+        startup.Startup_Error if something didn't start.
+    """
+    if door_configs is None:
+        door_configs = door_config.load()
+    boot = startup.Startup()
+
+    def start_sms_listener():
+        # Start the flask server so we can receive SMS messages. Everything
+        # else waits for this, so we fork before there are other threads
+        # that could be holding a lock (e.g. logging) the child needs.
+        global sms_listener
+        sms_listener = SMS.SMS_Monitor(q, debug=True)
+        sms_listener.daemon = True
+        sms_listener.start()
+        return sms_listener
+
+    # Edge detect is armed by the time a door is created. The doors are
+    # added in config order once they all exist, so status and lists keep
+    # that order.
+    created = {}
+
+    def create_door(config):
+        created[config.abbr] = config.create()
+        return created[config.abbr]
+
+    def start_light_monitor():
+        global light_monitor
+        light_monitor = LM.Light_Monitor(q)
+        light_monitor.daemon = True
+        light_monitor.start()
+        return light_monitor
+
+    def watch_doors():
+        # The light is likely to change soon after a door moves
+        for door in created.values():
+            door.add_edge_listener(light_monitor.poke)
+        return
+
+    def build_commands():
+        global f_map
+        for config in door_configs:
+            doors[config.abbr] = created[config.abbr]
+        f_map = build_f_map()
+        return f_map
+
+    boot.add("sms_listener", start_sms_listener)
+    # Shared objects are created on first use, do it once up front rather
+    # than have the phases race to create them
+    boot.add("shared", lambda: (GS.get_store(), GS.get_scheduler(),
+            GS.get_dispatcher(), GS.get_subscriptions()), ["sms_listener"])
+    boot.add("solar", GS.get_solar, ["sms_listener"])
+    # Send what the last run left in the outbox. The SMS process is up by
+    # now, but it only sends the messages it queues itself
+    boot.add("outbox", lambda: GS.get_dispatcher().recover(), ["shared"])
+    # The SMS process serves /metrics, it reads ours from shared memory. The
+    # publisher is a thread, so it waits for the fork like everything else
+    boot.add("metrics", lambda: metrics.start_publishing("main"), ["sms_listener"])
+    door_phases = []
+    for config in door_configs:
+        door_phases.append(config.phase_name)
+        boot.add(door_phases[-1], lambda config=config: create_door(config), ["shared"])
+    boot.add("light_monitor", start_light_monitor, ["shared", "solar"])
+    boot.add("commands", build_commands, door_phases)
+    boot.add("light_doors", watch_doors, door_phases + ["light_monitor"])
+    # Ready when the port is listening and the first light sample is taken
+    boot.add("sms_ready", lambda: startup.wait_ready(sms_listener.ready,
+            sms_listener), ["sms_listener"])
+    boot.add("light_ready", lambda: startup.wait_ready(light_monitor.ready,
+            light_monitor), ["light_monitor"])
+    boot.run()
+    return boot
+
 def ret_status(from_number, cmds):
     """ Build the status message to send back to texter """
-    s1 = "Ivan's door is {0}.".format(ivan_door.get_state_str().lower())
-    s2 = "Heather's door is {0}.".format(heather_door.get_state_str().lower())
+    lines = ["{0}'s door is {1}.".format(d.name, d.get_state_str().lower())
+             for d in doors.values()]
     if GS.is_dark(): # i.e. it's night time
-            s3 = "The light is {0}.".format(light_monitor.get_light_str().lower())
+            lines.append("The light is {0}.".format(light_monitor.get_light_str().lower()))
     else:
-            s3 = "It's daytime so light state is unknown."
-    GS.send_message("{0}\n{1}\n{2}".format(s1, s2, s3))
+            lines.append("It's daytime so light state is unknown.")
+    GS.send_message("\n".join(lines))
     return
 	
 
@@ -175,56 +399,15 @@ if __name__ == "__main__":
     keep_alive = True
     l = GS.configure_logging()
     l.info("Just configured logger")
-    GS.lock = RLock()
     q = Queue()
 
-    l.debug("Creating Ivan's door")
-    time.sleep(5)
-    heather_door = Door(16, 9, "Heather", GS.lock)
-    l.debug("Creating Heather's door")
-    time.sleep(5)
-    ivan_door = Door(26, 25, "Ivan", GS.lock)
-    time.sleep(5)
-
-    # Start the flask server so we can receive SMS messages
-    l.debug("Starting sms_listener")
-    sms_listener = SMS.SMS_Monitor(q, debug=True)
-    l.debug("Created sms_listener")
-    time.sleep(5)
-    sms_listener.daemon = True
-    sms_listener.start()
-    time.sleep(5)
-    l.debug("Started sms_listener")
-
-    # Start the light monitor
-    l.info("Starting light_monitor")
-    light_monitor = LM.Light_Monitor(q)
-    l.info("LM created, sleeping for 5 secs")
-    light_monitor.daemon = True
-    time.sleep(5)
-    light_monitor.start()
-    l.info("LM started")
-    time.sleep(5)
-    l.info("Started light_monitor")
-    
-
-    # This is our function map. Based on the type of message (which is just
-    # the name of a class), call an associated function
-    f_map = { 's': ret_status,
-              'status': ret_status,
-             'help': help_text,
-              '?': help_text,
-              'sub': subscribe,
-              'unsub': unsubscribe,
-              'hist': get_history,
-              'list': list_current_subscriptions,
-              'si': ivan_door.snooze_timer,
-              'sh': heather_door.snooze_timer,
-             'i': ivan_door.press_button,
-             'h': heather_door.press_button}
-    # Number map just gives a list of valid numbers for the from
-    valid_numbers = [const.Ivan_cell, const.Heather_cell, const.Zane_cell]
-    extra_notification = [const.Zane_cell, ]
+    try:
+        start_up(q)
+    except (startup.Startup_Error, door_config.Config_Error) as e:
+        l.error(str(e))
+        sys.exit(1)
+    if import_profile.enabled():
+        l.info(import_profile.report())
 
     # We are a service, so tell them that we have started up successfully
     n = sdnotify.SystemdNotifier()
@@ -232,6 +415,11 @@ if __name__ == "__main__":
     n.notify("WATCHDOG_USEC=80")
 
     # everything is set up, now wait for messages and process them as needed
+    if USE_EVENT_CORE:
+        core = runtime.Event_Core(q, route_message, n, on_busy=too_busy)
+        core.run()
+        sys.exit(1)
+
     while keep_alive:
             n.notify("WATCHDOG=1")
             # wait until we get a message
@@ -243,29 +431,10 @@ if __name__ == "__main__":
                     l.debug("Queue get timed out after waiting")
                     continue
 
-            # We might be asked to shut down (e.g. in case of attempted hack)
-            if not msg.has_key('From'):
-                    l.info("Invalid message <{0}>".format(msg))
+            try:
+                    routed = route_message(msg)
+            except runtime.Shutdown:
                     sys.exit(1)
-
-            # check to see if message came from allowed number
-            if msg['From'] not in valid_numbers:
-                    l.info("Got command from invalid number")
-                    GS.send_message("Got msg from invalid number {0}".format(
-                                    msg['From']))
-                    continue
-            # tell me if Zane is using it
-            if msg['From'] in extra_notification:
-                l.info("Got command from special user")
-                GS.send_message("Got message from Zane")
-
-            # now process the message
-            cmd_str = msg['Text'].lower().strip().split()
-            msg_func = f_map.get(cmd_str[0])
-            if msg_func is not None:
-                    msg_func(msg['From'], cmd_str)
-            else:
-                    GS.send_message("I don't know that command. Sorry.")
-                    l.info("Unknown msg <{0}>".format(msg))
-    
-
+            if routed is not None:
+                    key, msg_func, args = routed
+                    msg_func(*args)
@@ -2,60 +2,110 @@
     This is the parent class for all classes in this project
     Used to share objects that are common
 '''
-from dateutil import tz
-import ephem
-import plivo
 import const
 import logging
 import sys
+import os
+import threading
 import datetime as dt
 
 # Name for logger
 loggerName = "GaragePi"
 LOG_DIR = "/home/garage/garagePi/logs/"
 
-# Placeholder for lock
-lock = None
+# Placeholder for the outbound sms dispatcher, created on first send
+dispatcher = None
+
+# Placeholder for the per recipient notification coalescer, created on first use
+coalescer = None
+
+# Placeholder for the cached sunrise / sunset schedule
+solar = None
+
+# Placeholder for the timer scheduler, created on first use
+scheduler = None
+
+# Placeholder for the subscription registry, opened on first use
+subscriptions = None
+
+# Placeholder for the (per process) storage, opened on first use
+store = None
+_store_lock = threading.Lock()
+
+# utility function to get this process's store, a forked child opens its own
+# Sender threads may ask for it first, so only one of them opens it
+def get_store():
+    global store
+    if store is None or store.pid != os.getpid():
+        with _store_lock:
+            if store is None or store.pid != os.getpid():
+                from storage import Store, STORAGE_FILE
+                store = Store(const.DOOR_DATA_DIR + STORAGE_FILE)
+    return store
+
+# utility function to get the shared subscription registry
+def get_subscriptions():
+    global subscriptions
+    if subscriptions is None:
+        from subscription import Subscription_Registry
+        subscriptions = Subscription_Registry(get_store())
+    return subscriptions
+
+# utility function to get the shared timer scheduler
+def get_scheduler():
+    global scheduler
+    if scheduler is None:
+        from scheduler import Scheduler
+        scheduler = Scheduler()
+    return scheduler
+
+# utility function to get the shared solar schedule
+def get_solar():
+    global solar
+    if solar is None:
+        from solar import Solar_Schedule
+        solar = Solar_Schedule()
+    return solar
 
 # utility function for getting sunrise
 def sunrise():
-    utc_datetime = ephem.city('New York').next_rising(
-            ephem.Sun()).datetime()
-    utc_datetime = utc_datetime.replace(tzinfo=tz.gettz('UTC'))
-    return utc_datetime.astimezone(my_tz())
+    return dt.datetime.fromtimestamp(get_solar().next_rising(), my_tz())
 
 # utility function for getting sunset
 def sunset():
-    utc_datetime = ephem.city('New York').next_setting(
-            ephem.Sun()).datetime()
-    utc_datetime = utc_datetime.replace(tzinfo=tz.gettz('UTC'))
-    return utc_datetime.astimezone(my_tz())
+    return dt.datetime.fromtimestamp(get_solar().next_setting(), my_tz())
 
 # utility function for getting my timezone
 def my_tz():
-    return tz.gettz('America/New_York')
+    return get_solar().tz
 
 # utility function to see if it's dark
 def is_dark():
-    return (sunrise() < sunset())
-    
-# Utility function to send out an SMS message
-def send_message(msg, number_list=[const.Ivan_cell,]):
+    return get_solar().is_dark()
+
+# Utility function to get the (per process) sms dispatcher
+def get_dispatcher():
+    global dispatcher
+    if dispatcher is None:
+        from sms_dispatcher import SMS_Dispatcher
+        dispatcher = SMS_Dispatcher()
+    return dispatcher
+
+# Utility function to get the notification coalescer (door events go
+# through it, see sms_coalescer.py)
+def get_coalescer():
+    global coalescer
+    if coalescer is None:
+        from sms_coalescer import SMS_Coalescer
+        coalescer = SMS_Coalescer()
+    return coalescer
+
+# Utility function to send out an SMS message, priority is one of the
+# sms_dispatcher classes (ERROR, CONFIRM, STATE, NAG), CONFIRM if not given
+# Doesn't wait for the send, returns a handle that can be waited on
+def send_message(msg, number_list=[const.Ivan_cell,], priority=None):
     logging.info("In send message, sending: {} to the following numbers {}".format(msg, number_list))
-    # Your Account Sid and Auth Token from plivo.com/user/account
-    account_id = const.auth_id
-    auth_token  = const.auth_token
-    # List of numbers to send message to
-    client = plivo.RestAPI(account_id, auth_token)
-    # All numbers must be prefixed by a +
-    for n in number_list:
-        params = { 'src': const.number, 
-                'dst': "+" + n,
-                'text': msg, 
-                'type': 'sms', }
-        response = client.send_message(params)
-        logging.debug(str(response))
-    return
+    return get_dispatcher().send(msg, number_list, priority)
 
 
 # Utility to configure a logger instance
@@ -0,0 +1,289 @@
+'''
+    Hardware backends. Door and Light_Monitor talk to the pins and the I2C
+    bus through a backend instead of importing RPi.GPIO and smbus directly:
+
+      RPi_Backend - the real thing, RPi.GPIO and smbus
+      Sim_Backend - simulated pins, reed switches, relay driven doors and
+        light sensor, so the code can run (and be benchmarked) off a Pi
+
+    A backend has a gpio attribute with the RPi.GPIO interface that we use
+    and an smbus(bus_number) method that returns an object with
+    read_i2c_block_data.
+
+    Set GARAGE_HARDWARE=sim in the environment to get the simulator from
+    default_backend().
+'''
+import threading
+import logging
+import time
+import os
+from scheduler import Scheduler, monotonic
+
+l = logging.getLogger(__name__)
+
+_default = None
+
+
+def default_backend():
+    """ The backend to use when none is given, created on first use """
+    global _default
+    if _default is None:
+        if os.environ.get("GARAGE_HARDWARE") == "sim":
+            _default = Sim_Backend()
+        else:
+            _default = RPi_Backend()
+    return _default
+
+
+class RPi_Backend(object):
+    """ Real pins and I2C bus """
+
+    def __init__(self):
+        import RPi.GPIO
+        self.gpio = RPi.GPIO
+        return
+
+    def smbus(self, bus_number):
+        import smbus
+        return smbus.SMBus(bus_number)
+
+
+class Sim_GPIO(object):
+    """
+        Simulated RPi.GPIO. Pin values can be scripted with set_input.
+        io_time is how long each pin read or write takes, 0 (the default)
+        is like the Pi's own pins, an I2C port expander takes a few hundred
+        microseconds.
+    """
+
+    # Same values as RPi.GPIO
+    LOW = 0
+    HIGH = 1
+    OUT = 0
+    IN = 1
+    BCM = 11
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, io_time=0.0):
+        self.io_time = io_time
+        self._values = {}
+        self._detect = {}  # pin -> [edge, callback, bouncetime secs, last fired]
+        self._on_output = {}  # pin -> functions called with new output value
+        self._lock = threading.RLock()
+        return
+
+    def setwarnings(self, flag):
+        return
+
+    def setmode(self, mode):
+        return
+
+    def setup(self, pin, mode, pull_up_down=None, initial=None):
+        with self._lock:
+            if initial is not None:
+                self._values[pin] = initial
+            elif pin not in self._values:
+                self._values[pin] = self.HIGH if pull_up_down == self.PUD_UP else self.LOW
+        return
+
+    def input(self, pin):
+        if self.io_time:
+            time.sleep(self.io_time)
+        return self._values.get(pin, self.LOW)
+
+    def output(self, pin, value):
+        if self.io_time:
+            time.sleep(self.io_time)
+        value = self.HIGH if value else self.LOW
+        with self._lock:
+            changed = self._values.get(pin) != value
+            self._values[pin] = value
+            on_output = self._on_output.get(pin, ())
+        if changed:
+            for fn in on_output:
+                fn(value)
+        return
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=0):
+        with self._lock:
+            self._detect[pin] = [edge, callback, bouncetime / 1000.0, None]
+        return
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            self._detect.pop(pin, None)
+        return
+
+    def set_input(self, pin, value):
+        """ Drive an input pin (e.g. a reed switch), firing edge callbacks """
+        with self._lock:
+            old = self._values.get(pin, self.LOW)
+            self._values[pin] = value
+            detect = self._detect.get(pin)
+            if detect is None or old == value:
+                return
+            edge, callback, bouncetime, last = detect
+            if edge == self.RISING and value != self.HIGH or \
+                    edge == self.FALLING and value != self.LOW:
+                return
+            now = monotonic()
+            if last is not None and now - last < bouncetime:
+                return
+            detect[3] = now
+        if callback is not None:
+            callback(pin)
+        return
+
+    def watch_output(self, pin, fn):
+        """ Call fn(value) whenever an output pin changes """
+        with self._lock:
+            self._on_output[pin] = self._on_output.get(pin, ()) + (fn,)
+        return
+
+
+class Sim_I2C(object):
+    """ Simulated BH1750 light sensor, set_light changes the level """
+
+    def __init__(self, lux=0):
+        self.lux = lux
+        self.reads = 0
+        return
+
+    def set_light(self, lux):
+        self.lux = lux
+        return
+
+    def read_i2c_block_data(self, addr, cmd):
+        self.reads += 1
+        raw = int(self.lux * 1.2)
+        return [(raw >> 8) & 0xff, raw & 0xff]
+
+
+class Sim_Door(object):
+    """
+        A garage door wired to a reed switch (HIGH when closed) and a relay
+        (active LOW). Pulling the relay low starts the door moving. The reed
+        switch opens as soon as a closed door starts moving and closes when
+        a closing door gets to the bottom, travel_time secs later. With
+        bounce on, each reed switch change chatters the way a real contact
+        does.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    OPENING = "opening"
+    CLOSING = "closing"
+
+    def __init__(self, backend, reed_pin, relay_pin, opened=False):
+        self._backend = backend
+        self._gpio = backend.gpio
+        self.reed_pin = reed_pin
+        self.relay_pin = relay_pin
+        self.state = Sim_Door.OPEN if opened else Sim_Door.CLOSED
+        self.cycles = 0
+        self._travel = None
+        self._gpio.setup(reed_pin, self._gpio.IN, initial=self._gpio.LOW if opened
+                else self._gpio.HIGH)
+        self._gpio.watch_output(relay_pin, self._relay)
+        return
+
+    def _reed(self, value):
+        gpio = self._gpio
+        if self._backend.bounce:
+            for v in (value, 1 - value):
+                gpio.set_input(self.reed_pin, v)
+        gpio.set_input(self.reed_pin, value)
+        return
+
+    def _relay(self, value):
+        if value == self._gpio.LOW:
+            self.press()
+        return
+
+    def press(self):
+        """ Same as the relay closing, start the door moving """
+        if self._travel is not None:
+            self._travel.cancel()
+        if self.state in (Sim_Door.CLOSED, Sim_Door.CLOSING):
+            was_closed = self.state == Sim_Door.CLOSED
+            self.state = Sim_Door.OPENING
+            if was_closed:
+                self._reed(self._gpio.LOW)
+            self._after_travel(Sim_Door.OPEN)
+        else:
+            self.state = Sim_Door.CLOSING
+            self._after_travel(Sim_Door.CLOSED)
+        return
+
+    def _after_travel(self, state):
+        if self._backend.travel_time <= 0:
+            self._arrive(state)
+        else:
+            self._travel = self._backend.scheduler.call_later(
+                    self._backend.travel_time, self._arrive, [state])
+        return
+
+    def _arrive(self, state):
+        self._travel = None
+        self.state = state
+        if state == Sim_Door.CLOSED:
+            self.cycles += 1
+            self._reed(self._gpio.HIGH)
+        return
+
+    @property
+    def is_closed(self):
+        return self.state == Sim_Door.CLOSED
+
+
+class Sim_Backend(object):
+    """
+        Simulated hardware. travel_time is how long a door takes to open or
+        close, 0 makes it instant (and the simulator as fast as possible).
+        io_time is how long each pin read or write takes (see Sim_GPIO).
+    """
+
+    def __init__(self, travel_time=0.0, bounce=True, lux=0, io_time=0.0):
+        self.gpio = Sim_GPIO(io_time)
+        self.i2c = Sim_I2C(lux)
+        self.travel_time = travel_time
+        self.bounce = bounce
+        self.doors = {}
+        self._scheduler = None
+        return
+
+    @property
+    def scheduler(self):
+        if self._scheduler is None:
+            self._scheduler = Scheduler("Sim_Backend")
+        return self._scheduler
+
+    def smbus(self, bus_number):
+        return self.i2c
+
+    def add_door(self, reed_pin, relay_pin, opened=False):
+        """ Wire up a simulated door, do this before creating the Door """
+        door = Sim_Door(self, reed_pin, relay_pin, opened)
+        self.doors[relay_pin] = door
+        return door
+
+
+if __name__ == "__main__":
+    sim = Sim_Backend()
+    gpio = sim.gpio
+    door = sim.add_door(16, 9)
+    gpio.setup(9, gpio.OUT, initial=gpio.HIGH)
+    edges = []
+    gpio.add_event_detect(16, gpio.RISING, callback=edges.append, bouncetime=0)
+    n = 20000
+    start = time.time()
+    for i in range(n):
+        gpio.output(9, gpio.LOW)
+        gpio.output(9, gpio.HIGH)
+    elapsed = time.time() - start
+    print("{} presses ({} full door cycles) in {:.3f} secs, {:.0f} cycles/sec, {} edges".format(
+            n, door.cycles, elapsed, door.cycles / elapsed, len(edges)))
@@ -0,0 +1,310 @@
+'''
+    Door history store. Recent events are kept in a fixed size in-memory
+    ring buffer, every event is also a row in the store (storage.py). Rows
+    are trimmed to the retention limit once there are twice that many, and
+    startup only reads the newest ring's worth, so recording an event is
+    O(1) no matter how much history there is.
+
+    Records are kept in time order, both merged and per event type, so
+    last-n, time range and event type queries are a bisect plus the rows
+    returned. Formatting is only done for the rows returned. Queries
+    reaching back past the ring go to the store (indexed on door and time).
+'''
+from array import array
+import datetime as dt
+import logging
+import time
+
+# Event types stored in the history
+OPEN = 1
+CLOSE = 2
+EVENT_NAMES = {OPEN: "Open", CLOSE: "Close"}
+EVENT_TYPES = {"open": OPEN, "close": CLOSE}
+
+TIMESTAMP_FORMAT_STR = "%a %b %d %Y @ %I:%M:%S %p"
+_WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+# Number of events kept in memory
+RING_SIZE = 1000
+# Number of events kept in the store after a compaction
+RETENTION = 10000
+
+l = logging.getLogger(__name__)
+
+
+class Ring_Buffer(object):
+    """
+        Fixed size buffer of (epoch, event type) records. Oldest records are
+        overwritten once it's full. Index 0 is the oldest record.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._times = array('d', [0.0]) * size
+        self._types = array('B', [0]) * size
+        self._start = 0
+        self._count = 0
+        return
+
+    def __len__(self):
+        return self._count
+
+    def append(self, t, event_type):
+        if self._count < self._size:
+            i = (self._start + self._count) % self._size
+            self._count += 1
+        else:
+            i = self._start
+            self._start = (self._start + 1) % self._size
+        self._times[i] = t
+        self._types[i] = event_type
+        return
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("ring buffer index out of range")
+        i = (self._start + i) % self._size
+        return self._times[i], self._types[i]
+
+    def newest(self, n, lo=0, hi=None):
+        """ Return up to n records from index range [lo, hi), newest first """
+        if hi is None:
+            hi = self._count
+        return [self[i] for i in range(hi - 1, max(hi - n, lo) - 1, -1)]
+
+    def bisect(self, t):
+        """ Index of the first record with time >= t """
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._times[(self._start + mid) % self._size] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+def format_record(t, event_type, ts_format=TIMESTAMP_FORMAT_STR):
+    """ Format one history record for display, e.g. 'Mon ... PM (Open) ' """
+    return "{} {:7s}".format(time.strftime(ts_format, time.localtime(t)),
+            "({})".format(EVENT_NAMES[event_type]))
+
+
+def parse_since(word, now=None):
+    """
+        Turn a user supplied start time into an epoch time. Accepts a day
+        name (the most recent one, at midnight), today, yesterday or a number
+        of hours / days / weeks ago (e.g. 12h, 3d, 1w).
+        Returns None if word isn't understood.
+    """
+    if now is None:
+        now = time.time()
+    word = word.lower()
+    midnight = dt.datetime.fromtimestamp(now).replace(hour=0, minute=0,
+            second=0, microsecond=0)
+    if word == "today":
+        start = midnight
+    elif word == "yesterday":
+        start = midnight - dt.timedelta(days=1)
+    elif word[:3] in _WEEKDAYS:
+        days_back = (midnight.weekday() - _WEEKDAYS.index(word[:3])) % 7
+        start = midnight - dt.timedelta(days=days_back)
+    elif word[-1:] in ("h", "d", "w") and word[:-1].isdigit():
+        secs = {"h": 3600, "d": 86400, "w": 604800}[word[-1]]
+        return now - int(word[:-1]) * secs
+    else:
+        return None
+    return time.mktime(start.timetuple())
+
+
+class Door_History(object):
+    """
+        History of open / close events for one door, kept in the history
+        table of a storage.Store. A read only history (e.g. in the SMS
+        process) picks up new rows with refresh().
+    """
+
+    def __init__(self, store, door, ring_size=RING_SIZE, retention=RETENTION,
+            read_only=False):
+        self._store = store
+        self._door = door
+        self._ring_size = ring_size
+        self._retention = max(retention, ring_size)
+        self._read_only = read_only
+        self._rows = 0
+        self._last_rowid = 0
+        self._load()
+        return
+
+    def _append(self, t, event_type):
+        self._ring.append(t, event_type)
+        self._by_type[event_type].append(t, event_type)
+        return
+
+    def _load(self):
+        """ Fill the ring with the newest rows """
+        self._ring = Ring_Buffer(self._ring_size)
+        self._by_type = dict((e, Ring_Buffer(self._ring_size)) for e in EVENT_NAMES)
+        rows = self._store.query("SELECT rowid, t, event FROM history WHERE door = ? "
+                "ORDER BY t DESC LIMIT ?", (self._door, self._ring_size))
+        for rowid, t, event_type in reversed(rows):
+            self._append(t, event_type)
+        self._rows, last_rowid = self._store.query("SELECT COUNT(*), MAX(rowid) "
+                "FROM history WHERE door = ?", (self._door,))[0]
+        self._last_rowid = last_rowid or 0
+        return
+
+    def refresh(self):
+        """
+            Pick up rows another process added. Only needed for read only
+            histories.
+        """
+        rows = self._store.query("SELECT rowid, t, event FROM history WHERE rowid > ? "
+                "AND door = ? ORDER BY rowid LIMIT ?", (self._last_rowid, self._door,
+                self._ring_size + 1))
+        newest = self._ring[-1][0] if len(self._ring) else 0.0
+        if len(rows) > self._ring_size or any(t < newest for rowid, t, e in rows):
+            # Far behind, or older records were added (a migration)
+            self._load()
+            return
+        for rowid, t, event_type in rows:
+            self._append(t, event_type)
+            self._last_rowid = rowid
+        self._rows += len(rows)
+        return
+
+    def __len__(self):
+        return self._rows
+
+    def record(self, event_type, t=None):
+        """ Add an event to the history """
+        if t is None:
+            t = time.time()
+        self._append(t, event_type)
+        self._store.execute("INSERT INTO history (door, t, event) VALUES (?, ?, ?)",
+                (self._door, t, event_type))
+        self._rows += 1
+        if self._rows >= 2 * self._retention:
+            self.compact()
+        return
+
+    def compact(self):
+        """ Delete all but the newest retention rows """
+        self._store.execute("DELETE FROM history WHERE door = ? AND t < (SELECT t FROM "
+                "history WHERE door = ? ORDER BY t DESC LIMIT 1 OFFSET ?)",
+                (self._door, self._door, self._retention - 1))
+        self._rows = self._store.query("SELECT COUNT(*) FROM history WHERE door = ?",
+                (self._door,))[0][0]
+        l.debug("Compacted {}'s history to {} rows".format(self._door, self._rows))
+        return
+
+    def latest(self, count, event_type=None):
+        """ Return the newest count (epoch, event type) records, newest first """
+        return self.query(count, event_type=event_type)
+
+    def query(self, count=None, since=None, until=None, event_type=None):
+        """
+            Return (epoch, event type) records newest first. Optionally limit
+            to the newest count, to since <= time < until and/or to one event
+            type.
+        """
+        ring = self._ring if event_type is None else self._by_type[event_type]
+        lo = 0 if since is None else ring.bisect(since)
+        hi = len(ring) if until is None else ring.bisect(until)
+        rows = ring.newest(hi - lo if count is None else count, lo, hi)
+        if (count is None or len(rows) < count) and self._older_in_store(since):
+            return self._query_store(count, since, until, event_type)
+        return rows
+
+    def _older_in_store(self, since):
+        """ True if the store may have records from since on the ring doesn't """
+        if self._rows <= len(self._ring):
+            return False
+        return since is None or not len(self._ring) or since < self._ring[0][0]
+
+    def _query_store(self, count, since, until, event_type):
+        """ query() answered from the store """
+        sql = "SELECT t, event FROM history WHERE door = ?"
+        args = [self._door]
+        if since is not None:
+            sql += " AND t >= ?"
+            args.append(since)
+        if until is not None:
+            sql += " AND t < ?"
+            args.append(until)
+        if event_type is not None:
+            sql += " AND event = ?"
+            args.append(event_type)
+        sql += " ORDER BY t DESC"
+        if count is not None:
+            sql += " LIMIT ?"
+            args.append(count)
+        return [tuple(row) for row in self._store.query(sql, args)]
+
+    def _add_records(self, records):
+        """ Add (epoch, event type) records from older versions """
+        records = sorted(records)[-self._retention:]
+        self._store.executemany("INSERT INTO history (door, t, event) VALUES (?, ?, ?)",
+                [(self._door, t, e) for t, e in records])
+        self._store.flush()
+        self._load()
+        return len(records)
+
+    def migrate(self, open_list, close_list, ts_format):
+        """ Load history saved as formatted strings by older versions """
+        records = [(time.mktime(time.strptime(s, ts_format)), OPEN) for s in open_list]
+        records += [(time.mktime(time.strptime(s, ts_format)), CLOSE) for s in close_list]
+        return self._add_records(records)
+
+    def close(self):
+        return
+
+
+if __name__ == "__main__":
+    # Benchmark the indexed queries against the old path of keeping
+    # formatted strings and re-parsing them with strptime to merge
+    import timeit
+    from storage import Store
+
+    def old_get_history(open_list, close_list, count):
+        def sort_key(ts):
+            t = time.strptime(ts[:-8], TIMESTAMP_FORMAT_STR)
+            return time.strftime("%Y%m%d%H%M%S", t)
+        hist = [i + " {:7s}".format("(Open)") for i in open_list[:count]]
+        hist += [i + " {:7s}".format("(Close)") for i in close_list[:count]]
+        hist.sort(reverse=True, key=sort_key)
+        return hist[:count]
+
+    def old_since(open_list, close_list, since):
+        # Strings have to be parsed to find the ones in range
+        hist = [(time.mktime(time.strptime(s, TIMESTAMP_FORMAT_STR)), s + " (Open) ")
+                for s in open_list]
+        hist += [(time.mktime(time.strptime(s, TIMESTAMP_FORMAT_STR)), s + " (Close)")
+                for s in close_list]
+        return [s for t, s in sorted(hist, reverse=True) if t >= since]
+
+    now = time.time()
+    for size in (10000, 1000000):
+        h = Door_History(Store(":memory:"), "Bench", ring_size=size, retention=size)
+        open_list = []
+        close_list = []
+        for i in range(size // 2):
+            t = now - (size - 2 * i) * 60
+            h._append(t, OPEN)
+            h._append(t + 30, CLOSE)
+            open_list.insert(0, time.strftime(TIMESTAMP_FORMAT_STR, time.localtime(t)))
+            close_list.insert(0, time.strftime(TIMESTAMP_FORMAT_STR, time.localtime(t + 30)))
+        since = now - 3 * 86400
+        n = 20
+        old = timeit.timeit(lambda: old_get_history(open_list, close_list, 100), number=n) / n
+        new = timeit.timeit(lambda: [format_record(*r) for r in h.query(100)], number=n) / n
+        print("{:>8} records, last 100: old {:.2f} ms, new {:.2f} ms".format(
+                size, old * 1e3, new * 1e3))
+        old = timeit.timeit(lambda: old_since(open_list, close_list, since), number=1)
+        new = timeit.timeit(lambda: [format_record(*r) for r in h.query(since=since)],
+                number=n) / n
+        print("{:>8} records, last 3 days: old {:.2f} ms, new {:.2f} ms".format(
+                size, old * 1e3, new * 1e3))
+        h.close()
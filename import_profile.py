@@ -0,0 +1,145 @@
+'''
+    Import time profiling. Wraps __import__ to time each module the first
+    time it is imported, with its own time (not counting the modules it
+    imports) and the change in resident memory. Like python3's
+    -X importtime, which python 2 doesn't have.
+
+    garage.py turns this on when GARAGE_IMPORT_PROFILE is set in the
+    environment and logs the report once startup is done (the SMS_Monitor
+    process logs its own after loading Flask). To profile importing
+    modules from the command line:
+
+      python import_profile.py garage
+'''
+import __builtin__
+import threading
+import logging
+import time
+import sys
+import os
+
+ENV_VAR = "GARAGE_IMPORT_PROFILE"
+# Rows in the report
+REPORT_ROWS = 25
+
+l = logging.getLogger(__name__)
+
+_original_import = __builtin__.__import__
+# (module, imported by, total secs, self secs, rss change kb, depth)
+_entries = []
+# Each thread has its own stack of imports in progress
+_local = threading.local()
+_enabled = False
+
+try:
+    _PAGE_KB = os.sysconf("SC_PAGE_SIZE") // 1024
+except (ValueError, AttributeError, OSError):
+    _PAGE_KB = 4
+
+
+def rss_kb():
+    """ Current resident set size in kb, 0 if we can't tell """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_KB
+    except (IOError, IndexError, ValueError):
+        return 0
+
+
+def _package(globals):
+    """ Package an implicit relative import would be relative to """
+    if not globals:
+        return None
+    if "__path__" in globals:
+        return globals.get("__name__")
+    return globals.get("__name__", "").rpartition(".")[0]
+
+
+def _profiled_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    if name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    _stack = getattr(_local, "stack", None)
+    if _stack is None:
+        _stack = _local.stack = []
+    parent = _stack[-1][0] if _stack else None
+    # [name, time spent in nested imports]
+    frame = [name, 0.0]
+    _stack.append(frame)
+    rss = rss_kb()
+    start = time.time()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        took = time.time() - start
+        _stack.pop()
+        package = _package(globals)
+        if package and sys.modules.get(package + "." + name) is not None:
+            name = package + "." + name
+        if _stack:
+            _stack[-1][1] += took
+        _entries.append((name, parent, took, took - frame[1], rss_kb() - rss,
+                len(_stack)))
+
+
+def enable():
+    """ Start timing imports (from here on) """
+    global _enabled
+    if not _enabled:
+        __builtin__.__import__ = _profiled_import
+        _enabled = True
+    return
+
+
+def disable():
+    global _enabled
+    if _enabled:
+        __builtin__.__import__ = _original_import
+        _enabled = False
+    return
+
+
+def enable_from_env():
+    """ enable() if GARAGE_IMPORT_PROFILE is set """
+    if os.environ.get(ENV_VAR):
+        enable()
+    return _enabled
+
+
+def enabled():
+    return _enabled
+
+
+def entries():
+    """ (module, imported by, total secs, self secs, rss change kb, depth) """
+    return list(_entries)
+
+
+def report(rows=REPORT_ROWS, title="Import profile", start=0):
+    """
+        Top modules by total import time, and the totals. start skips the
+        entries before it, e.g. the ones a forked process inherited.
+    """
+    profiled = _entries[start:]
+    top = [e for e in profiled if e[5] == 0]
+    lines = ["{} (pid {}): {} modules, {:.3f} secs, {} kb".format(title, os.getpid(),
+            len(profiled), sum(e[2] for e in top), sum(e[4] for e in top)),
+            "  {:>8} {:>8} {:>7}  {}".format("total ms", "self ms", "rss kb", "module")]
+    for name, parent, took, own, rss, depth in sorted(profiled,
+            key=lambda e: e[2], reverse=True)[:rows]:
+        lines.append("  {:8.1f} {:8.1f} {:7d}  {}{}".format(took * 1000.0, own * 1000.0,
+                rss, name, "" if parent is None else " (from {})".format(parent)))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Use: python import_profile.py module [module ...]")
+        sys.exit(2)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    before = rss_kb()
+    enable()
+    for module in sys.argv[1:]:
+        __import__(module)
+    disable()
+    print(report())
+    print("Process rss {} kb ({} kb before imports)".format(rss_kb(), before))
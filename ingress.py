@@ -0,0 +1,269 @@
+'''
+    Runs the SMS_Monitor Flask app on a choice of servers:
+
+      dev - Flask's own single threaded server with a throw away
+        ('adhoc') cert. This is what we used to run.
+      threaded - werkzeug server with a bounded pool of worker threads,
+        HTTP/1.1 keep-alive (TCP_NODELAY, one write per response) and a
+        cert that is generated once and kept. Whatever of a request body
+        the app didn't read is read and thrown away after the response,
+        so it isn't taken for the next request on the connection.
+        The TLS context lives as long as the server so sessions can be
+        resumed.
+      cheroot - CherryPy's production WSGI server, if it's installed.
+'''
+from Queue import Queue
+import threading
+import logging
+import socket
+import os
+
+SERVER = "threaded"
+HOST = "0.0.0.0"
+PORT = 5000
+# Max number of requests handled at once
+MAX_WORKERS = 8
+# Requests accepted and waiting for a worker before we stop accepting
+MAX_PENDING = 32
+# Secs an idle keep-alive connection may hold a worker
+KEEP_ALIVE_TIMEOUT = 5
+# Most bytes of unread request body read to keep a connection open, past
+# that it's closed instead
+MAX_DRAIN = 64 * 1024
+# Cert and key are kept at <CERT_BASE>.crt and <CERT_BASE>.key
+CERT_BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".ssl", "garagepi")
+
+l = logging.getLogger(__name__)
+
+
+def cert_files(cert_base=CERT_BASE):
+    """ Return (cert, key) file names, generating a self signed pair the first time """
+    cert_file = cert_base + ".crt"
+    key_file = cert_base + ".key"
+    if not (os.path.exists(cert_file) and os.path.exists(key_file)):
+        from werkzeug.serving import make_ssl_devcert
+        if not os.path.isdir(os.path.dirname(cert_base)):
+            os.makedirs(os.path.dirname(cert_base))
+        l.info("Generating self signed cert {}".format(cert_file))
+        make_ssl_devcert(cert_base, host="*")
+    return cert_file, key_file
+
+
+def ssl_context(cert_base=CERT_BASE):
+    """
+        Server TLS context using the persistent cert. OpenSSL keeps a session
+        cache (and issues tickets) per context, so returning clients can
+        resume instead of doing a full handshake.
+    """
+    # Only the web server process needs ssl
+    import ssl
+    ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    ctx.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+    ctx.load_cert_chain(*cert_files(cert_base))
+    return ctx
+
+
+def _threaded_server(app, host, port, ctx, workers, max_pending):
+    from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+    from werkzeug.wsgi import LimitedStream
+
+    class Keep_Alive_Handler(WSGIRequestHandler):
+        protocol_version = "HTTP/1.1"
+        timeout = KEEP_ALIVE_TIMEOUT
+        # Buffer the status line, headers and body so a response goes out
+        # in one write (werkzeug flushes after the body)
+        wbufsize = -1
+
+        def make_environ(self):
+            environ = WSGIRequestHandler.make_environ(self)
+            self._body = None
+            if environ.get("wsgi.input_terminated"):
+                # Chunked, we can't tell where it ends without the app
+                self._chunked = True
+            elif environ.get("CONTENT_LENGTH", "").isdigit():
+                self._body = LimitedStream(environ["wsgi.input"],
+                        int(environ["CONTENT_LENGTH"]))
+                environ["wsgi.input"] = self._body
+            return environ
+
+        def run_wsgi(self):
+            self._body = None
+            self._chunked = False
+            WSGIRequestHandler.run_wsgi(self)
+            body = self._body
+            if self._chunked:
+                self.close_connection = True
+            elif body is not None and not body.is_exhausted:
+                if body.limit - body.tell() > MAX_DRAIN:
+                    self.close_connection = True
+                else:
+                    try:
+                        body.exhaust()
+                    except (socket.error, IOError):
+                        self.close_connection = True
+            return
+
+    class Pooled_WSGI_Server(BaseWSGIServer):
+        """
+            Hands accepted connections to a fixed pool of worker threads. When
+            the pending queue is full the accept loop blocks, so load beyond
+            the pool backs up in the listen queue instead of spawning threads.
+        """
+
+        def __init__(self):
+            BaseWSGIServer.__init__(self, host, port, app,
+                    handler=Keep_Alive_Handler, ssl_context=ctx)
+            self._pending = Queue(max_pending)
+            for i in range(workers):
+                t = threading.Thread(target=self._work, name="Ingress-{}".format(i))
+                t.daemon = True
+                t.start()
+            return
+
+        def get_request(self):
+            # Don't hold small responses back (Nagle), on a kept alive
+            # connection they'd wait for the client's delayed ack
+            request, client_address = BaseWSGIServer.get_request(self)
+            request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return request, client_address
+
+        def process_request(self, request, client_address):
+            self._pending.put((request, client_address))
+            return
+
+        def _work(self):
+            while True:
+                request, client_address = self._pending.get()
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+            return
+
+    return Pooled_WSGI_Server()
+
+
+def _cheroot_server(app, host, port, cert_base, workers):
+    from cheroot import wsgi
+    from cheroot.ssl.builtin import BuiltinSSLAdapter
+    server = wsgi.Server((host, port), app, numthreads=workers,
+            timeout=KEEP_ALIVE_TIMEOUT, request_queue_size=MAX_PENDING)
+    server.ssl_adapter = BuiltinSSLAdapter(*cert_files(cert_base))
+    return server
+
+
+def serve(app, server=SERVER, host=HOST, port=PORT, cert_base=CERT_BASE,
+        workers=MAX_WORKERS, max_pending=MAX_PENDING, ready=None):
+    """
+        Serve app until the process is stopped. ready() is called once the
+        port is listening (the dev server gives us no way to tell, there it's
+        called just before starting).
+    """
+    if ready is None:
+        ready = lambda: None
+    l.info("Starting {} server on {}:{}".format(server, host, port))
+    if server == "dev":
+        ready()
+        app.run(host=host, port=port, debug=False, ssl_context='adhoc')
+    elif server == "threaded":
+        httpd = _threaded_server(app, host, port, ssl_context(cert_base), workers,
+                max_pending)
+        ready()
+        httpd.serve_forever()
+    elif server == "cheroot":
+        httpd = _cheroot_server(app, host, port, cert_base, workers)
+        httpd.prepare()
+        ready()
+        httpd.serve()
+    else:
+        raise ValueError("Unknown ingress server {}".format(server))
+    return
+
+
+if __name__ == "__main__":
+    # Compare startup time and requests per second for each server on
+    # localhost. Each client keeps one connection open if the server allows
+    import multiprocessing as MP
+    import httplib
+    import ssl
+    import sys
+    import time
+    from flask import Flask
+
+    def run_server(name, port):
+        app = Flask(__name__)
+
+        @app.route("/", methods=['GET', 'POST'])
+        def get_message():
+            return "Received"
+        serve(app, name, "127.0.0.1", port)
+
+    def wait_for_port(port, timeout=60):
+        ctx = ssl._create_unverified_context()
+        end = time.time() + timeout
+        while time.time() < end:
+            try:
+                s = ctx.wrap_socket(socket.create_connection(("127.0.0.1", port), 1))
+                s.close()
+                return True
+            except (socket.error, ssl.SSLError):
+                time.sleep(0.01)
+        return False
+
+    def client(port, count, results, latencies, statuses):
+        ctx = ssl._create_unverified_context()
+        conn = httplib.HTTPSConnection("127.0.0.1", port, context=ctx)
+        for i in range(count):
+            start = time.time()
+            # The app doesn't read the body, the server has to
+            conn.request("POST", "/", "Text=s")
+            resp = conn.getresponse()
+            resp.read()
+            statuses.append(resp.status)
+            if i > 0:
+                # The first one includes the connect and handshake
+                latencies.append(time.time() - start)
+            if resp.getheader("connection", "").lower() == "close" or \
+                    resp.version == 10:
+                conn.close()
+        results.append(count)
+        return
+
+    def median_ms(values):
+        return sorted(values)[len(values) // 2] * 1000 if values else 0.0
+
+    servers = sys.argv[1:] or ["dev", "threaded"]
+    clients = 8
+    per_client = 100
+    for i, name in enumerate(servers):
+        port = 15000 + i
+        start = time.time()
+        p = MP.Process(target=run_server, args=(name, port))
+        p.daemon = True
+        p.start()
+        if not wait_for_port(port):
+            print("{}: didn't start".format(name))
+            p.terminate()
+            continue
+        startup = time.time() - start
+        results = []
+        latencies = []
+        statuses = []
+        threads = [threading.Thread(target=client, args=(port, per_client, results,
+                latencies, statuses)) for c in range(clients)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        rps = sum(results) / (time.time() - start)
+        # And one request at a time, to see the latency without queueing
+        single = []
+        client(port, 50, [], single, statuses)
+        print("{:>9}: startup {:.2f} secs, {:.0f} requests/sec, median {:.1f} ms "
+                "(loaded) {:.1f} ms (one client), {} of {} not 200".format(name, startup,
+                rps, median_ms(latencies), median_ms(single),
+                len([s for s in statuses if s != 200]), len(statuses)))
+        p.terminate()
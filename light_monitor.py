@@ -1,17 +1,33 @@
 import time
-import smbus
 import threading as thread
-from threading import Timer
+from collections import deque
 import datetime
 import os
 import garage_shared as GS
 import logging
-import shelve
+import storage
 import const
+import lux_series
+import hardware
+import locks
+import sms_dispatcher
+import metrics
 
 _addr_default = 0x23
-_trigger_value = 5
-POLL_TIME = 5
+_bus_default = 1
+_trigger_value = 5  # Light is on above this level
+_hysteresis = 2  # Light is off below _trigger_value - _hysteresis
+# Sampling speeds up to FAST_POLL_TIME when a reading disagrees with the
+# current state and slows down (doubling) to POLL_TIME while it's stable.
+# Door edges poke() the monitor, so the stable poll can be slow.
+POLL_TIME = 30
+FAST_POLL_TIME = 0.25
+# After poke() (a door moved, so someone is likely to switch the light on
+# or off) sample every POKE_POLL_TIME secs for POKE_TIME secs
+POKE_TIME = 20
+POKE_POLL_TIME = 1.0
+# Number of readings the median filter looks at
+MEDIAN_WINDOW = 3
 # Default timer time (in seconds = 7 minutes)
 TIMER_INTERVAL = 900.0
 
@@ -25,30 +41,60 @@ ON_E = "Light on event"
 OFF_E = "Light off event"
 TIMER_E = "Timer event"
 
+# Owner of the light preferences in the store
+_PREFS_OWNER = "Light_Monitor"
+
+_READ_SECONDS = metrics.histogram("garage_light_read_seconds",
+        "Secs an I2C read of the light sensor takes")
+
 class Light_Monitor(thread.Thread):
-    def __init__(self, queue, addr=_addr_default):
+    def __init__(self, queue, addr=_addr_default, backend=None, bus_number=_bus_default):
         """ 
          Some basic setup
+         backend: hardware backend for the I2C bus (see hardware.py),
+           defaults to hardware.default_backend()
         """
         super(Light_Monitor, self).__init__()
         self.queue = queue
         self._addr = addr
         self.light_state = UNKNOWN
+        self.light_level = None
         self.keep_going = True
-        self.bus = smbus.SMBus(1)
+        if backend is None:
+            backend = hardware.default_backend()
+        self.bus = backend.smbus(bus_number)
+        self.bus_reads = 0
+        # Shared with anything else on the bus, see locks.py
+        self._bus_lock = locks.bus_lock(bus_number)
+        self._samples = deque(maxlen=MEDIAN_WINDOW)
+        self._last_reading = 0
+        self._wake = thread.Event()
+        self._fast_until = 0
+        # Set once the first reading has been taken
+        self.ready = thread.Event()
+        # Every reading is kept (and downsampled) for tuning and diagnosis
+        self.lux = lux_series.Lux_Series(const.DOOR_DATA_DIR + lux_series.SPILL_FILE)
         self.light_left_on_timer = None
         self.l = logging.getLogger(__name__)
         #self.l.setLevel(logging.DEBUG)
 
-        # Get preferences
-        pref_file_name = const.light_pref_file
-        self.l.debug("Preference file name: {}".format(pref_file_name))
-        self.notification_list = shelve.open(pref_file_name, writeback=True)
+        # Get preferences, older versions kept them in a shelve file
+        store = GS.get_store()
+        if not store.migrated("light"):
+            old = storage.open_shelve(const.light_pref_file)
+            if old is not None:
+                self.l.info("Migrating light prefs from {}".format(const.light_pref_file))
+                for k in old.keys():
+                    store.set_pref(_PREFS_OWNER, k, old[k])
+                old.close()
+            store.mark_migrated("light")
+        self.notification_list = store.prefs(_PREFS_OWNER)
 
         if ON_E not in self.notification_list:
             e = [ON_E, OFF_E, TIMER_E]
             for k in e:
                 self.notification_list[k] = []
+                store.set_pref(_PREFS_OWNER, k, [])
         else:
             self.l.info("Light notification prefs: {}".format(
                     self.notification_list))
@@ -70,26 +116,46 @@ class Light_Monitor(thread.Thread):
             ret_str = "Unknown"
         return ret_str
 
+    def get_lux_stats(self, since):
+        """ Text summary of the light readings since an epoch time """
+        stats = self.lux.summary(since)
+        if stats is None:
+            return "No light readings for that time."
+        return "Light since {}:\n min {:.0f}, max {:.0f}, mean {:.1f} ({} readings)".format(
+                time.strftime("%a %I:%M %p", time.localtime(since)), *stats)
+
     def get_light_state(self):
         """ 
-            Set the light level and update the current state (on vs. off)
+            Take a reading, set the light level and update the current state
+            (on vs. off). The state only changes when the median of the last
+            few readings crosses the on or off level, so flicker around the
+            trigger value doesn't flap.
         """
-
-        GS.lock.acquire()
-        state = self.light_state
-
-        # Read the value of the light sensor
-        data = self.bus.read_i2c_block_data(self._addr, 0x11)
-        light_level = int((data[1] + (256 * data[0])) / 1.2)
-
-        if light_level > _trigger_value:
-            self.light_state = ON
-        else:
-            self.light_state = OFF
-
-        GS.lock.release()
+        with self._bus_lock:
+            # Read the value of the light sensor
+            start = time.time()
+            data = self.bus.read_i2c_block_data(self._addr, 0x11)
+            _READ_SECONDS.observe(time.time() - start)
+            self.bus_reads += 1
+            light_level = int((data[1] + (256 * data[0])) / 1.2)
+            self.lux.add(light_level)
+
+            self._samples.append(light_level)
+            level = sorted(self._samples)[len(self._samples) // 2]
+            self.light_level = level
+            if level > _trigger_value:
+                self.light_state = ON
+            elif level < _trigger_value - _hysteresis or self.light_state == UNKNOWN:
+                self.light_state = OFF
+            self._last_reading = light_level
         return self.light_state
 
+    def _reading_disagrees(self):
+        """ True if the last raw reading is on the other side of the levels """
+        if self.light_state == ON:
+            return self._last_reading < _trigger_value - _hysteresis
+        return self._last_reading > _trigger_value
+
     def run(self):
         """ 
          Monitor the light level. Change the status if the measurement (on vs.
@@ -98,6 +164,7 @@ class Light_Monitor(thread.Thread):
         """
 
         self.get_light_state()
+        self.ready.set()
 
         self.l.info("\n\tLight monitor:\n" +
                 "\tProcess name: {0}\n".format(thread.current_thread().name) +
@@ -109,6 +176,7 @@ class Light_Monitor(thread.Thread):
                 "\tLight is: {0}\n".format(self.get_light_str()))
 
         log_skip_count = 0
+        poll_time = FAST_POLL_TIME
 
         while self.keep_going:
             # Check to see if I should even be checking, sensor only
@@ -118,23 +186,51 @@ class Light_Monitor(thread.Thread):
                 secs_till_sunset =  int((GS.sunset() - now).total_seconds())
                 self.l.info("Sleeping till sunset at <{0}> for {1} seconds".
                         format(GS.sunset(), secs_till_sunset))
-                # now I should just sleep till one hour afer sunset 
-                time.sleep(secs_till_sunset + 3600)
+                # now I should just sleep till one hour afer sunset, stop()
+                # wakes us up
+                self._wake.wait(secs_till_sunset + 3600)
+                self._wake.clear()
+                # Last night's readings are no use to the filter
+                self._samples.clear()
+                poll_time = FAST_POLL_TIME
+                continue
 
             # Store the "current" as the last state, check the new state
             old_light_state = self.light_state
             if self.get_light_state() == ON and old_light_state == OFF:
                 # Light just turned on
                 self.l.debug("Light turned on (was off).")
-                self.light_left_on_timer = Timer(TIMER_INTERVAL, 
-                        self.check_light_still_on)
-                self.light_left_on_timer.start()
+                self.light_left_on_timer = GS.get_scheduler().call_later(
+                        TIMER_INTERVAL, self.check_light_still_on,
+                        name="light left on")
+
+            # Sample fast while things are changing, a bit faster than
+            # usual just after a poke, back off when stable
+            if self.light_state != old_light_state or self._reading_disagrees():
+                poll_time = FAST_POLL_TIME
+            elif time.time() < self._fast_until:
+                poll_time = POKE_POLL_TIME
+            else:
+                poll_time = min(poll_time * 2, POLL_TIME)
 
             # Just log once in a while to know we are alive
             if log_skip_count % 60 == 0:
-                self.l.debug("Going to sleep for {} seconds.".format(POLL_TIME))
+                self.l.debug("Going to sleep for {} seconds ({} bus reads).".format(
+                        poll_time, self.bus_reads))
             log_skip_count += 1
-            time.sleep(POLL_TIME)
+            self._wake.wait(poll_time)
+            self._wake.clear()
+        return
+
+    def poke(self):
+        """
+            Take a reading now and sample every POKE_POLL_TIME secs for
+            POKE_TIME secs. Called on door edges, so doesn't block. In the
+            day there's nothing to read, so it doesn't wake us.
+        """
+        self._fast_until = time.time() + POKE_TIME
+        if GS.is_dark():
+            self._wake.set()
         return
 
     def check_light_still_on(self):
@@ -142,18 +238,17 @@ class Light_Monitor(thread.Thread):
             Check to see if light is still on
             This runs after timer expired, if light is on then send message
         """
-        GS.lock.acquire()
         self.light_left_on_timer = None
         if self.get_light_state() == ON and GS.is_dark():
             self.l.debug("Sending light message")
-            GS.send_message("Garage light left on.")
-            self.light_left_on_timer = Timer(TIMER_INTERVAL, 
-                    self.check_light_still_on)
-            self.light_left_on_timer.start()
-        GS.lock.release()
+            GS.send_message("Garage light left on.", priority=sms_dispatcher.NAG)
+            self.light_left_on_timer = GS.get_scheduler().call_later(
+                    TIMER_INTERVAL, self.check_light_still_on,
+                    name="light left on")
         return
 
     def stop(self):
         self.keep_going = False
+        self._wake.set()
         return
 
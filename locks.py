@@ -0,0 +1,170 @@
+'''
+    Named locks for the things that need them, instead of one lock for
+    everything. Each door and each I2C bus has its own lock, so work on one
+    doesn't wait for another. Reads of cached state (door state, light
+    state) don't take a lock at all.
+
+    Lock hierarchy. A thread may only take a lock whose level is higher
+    than any lock it already holds (re-taking a reentrant lock it holds is
+    fine):
+
+      DOOR (10)     door:<name>, a door's state, button and settle handling
+      EDGE (20)     door:<name>:edge, a door's reed switch debounce state
+      STORAGE (30)  storage:<path>, a storage.Store connection, and door
+                    storage, reading the old door preferences file
+      BUS (40)      i2c:<bus>, one I2C bus
+
+    So e.g. a door may save its data while holding its own lock, but must
+    not take another door's lock, and nothing may take a door lock while
+    holding the bus. Locks inside other modules (scheduler, dispatcher,
+    subscription registry, replay cache) are never held while taking a
+    DOOR, EDGE or BUS lock, they may be held while writing to the store.
+
+    Set GARAGE_LOCK_DEBUG=1 in the environment (or call enable_debug()) to
+    check the order on every acquire. Violations are logged with both
+    locks and counted, with GARAGE_LOCK_DEBUG=raise they also raise
+    Lock_Order_Error.
+'''
+import threading
+import traceback
+import logging
+import os
+
+DEBUG_ENV_VAR = "GARAGE_LOCK_DEBUG"
+
+# Lock levels, see above
+DOOR = 10
+EDGE = 20
+STORAGE = 30
+BUS = 40
+
+l = logging.getLogger(__name__)
+
+_locks = {}
+_locks_lock = threading.Lock()
+# Locks each thread holds, in the order they were taken (debug mode only)
+_held = threading.local()
+_debug = False
+_strict = False
+violations = []
+
+
+class Lock_Order_Error(RuntimeError):
+    pass
+
+
+class Ordered_Lock(object):
+    """ A lock with a name and a place in the hierarchy """
+
+    def __init__(self, name, level, reentrant=False):
+        self.name = name
+        self.level = level
+        self.reentrant = reentrant
+        self._lock = threading.RLock() if reentrant else threading.Lock()
+        return
+
+    def acquire(self, blocking=True):
+        if _debug:
+            _check(self)
+        got = self._lock.acquire(blocking)
+        if got and _debug:
+            _held_locks().append(self)
+        return got
+
+    def release(self):
+        if _debug:
+            held = _held_locks()
+            # Normally the last one taken, but not always
+            for i in range(len(held) - 1, -1, -1):
+                if held[i] is self:
+                    del held[i]
+                    break
+        self._lock.release()
+        return
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+    def __repr__(self):
+        return "{}({})".format(self.name, self.level)
+
+
+def _held_locks():
+    held = getattr(_held, "locks", None)
+    if held is None:
+        held = _held.locks = []
+    return held
+
+
+def _check(lock):
+    """ Complain if taking lock now breaks the hierarchy """
+    held = _held_locks()
+    if not held:
+        return
+    if lock.reentrant and lock in held:
+        return
+    top = max(held, key=lambda h: h.level)
+    if lock.level > top.level:
+        return
+    msg = "Lock order violation in {}: taking {} while holding {}".format(
+            threading.current_thread().name, lock, held)
+    violations.append(msg)
+    l.error("{}\n{}".format(msg, "".join(traceback.format_stack(limit=8)[:-2])))
+    if _strict:
+        raise Lock_Order_Error(msg)
+    return
+
+
+def enable_debug(strict=False):
+    """ Check lock order from here on, strict raises on a violation """
+    global _debug, _strict
+    _debug = True
+    _strict = strict
+    return
+
+
+def disable_debug():
+    global _debug
+    _debug = False
+    return
+
+
+def enable_debug_from_env():
+    """ enable_debug() if GARAGE_LOCK_DEBUG is set """
+    value = os.environ.get(DEBUG_ENV_VAR)
+    if value:
+        enable_debug(strict=(value == "raise"))
+    return _debug
+
+
+def named(name, level, reentrant=False):
+    """ The lock called name, created the first time """
+    with _locks_lock:
+        lock = _locks.get(name)
+        if lock is None:
+            lock = _locks[name] = Ordered_Lock(name, level, reentrant)
+    return lock
+
+
+def door_lock(door_name):
+    return named("door:{}".format(door_name), DOOR, reentrant=True)
+
+
+def edge_lock(door_name):
+    return named("door:{}:edge".format(door_name), EDGE)
+
+
+def storage_lock():
+    return named("door storage", STORAGE, reentrant=True)
+
+
+def bus_lock(bus_number):
+    return named("i2c:{}".format(bus_number), BUS)
+
+
+enable_debug_from_env()
@@ -0,0 +1,218 @@
+'''
+    Time series of light sensor readings. Raw readings are kept for the last
+    hour, older data is kept as 1 minute buckets for a day and 15 minute
+    buckets for a month (min / max / mean of the readings in the bucket).
+
+    All of it lives in fixed size rings in a memory mapped file, so memory
+    and disk use never grow and another process (the web server) can read
+    the same file. The bucket each tier is filling is kept in the file too,
+    so a reader sees the last few minutes and a restart carries on with it.
+'''
+import logging
+import struct
+import mmap
+import time
+import os
+
+SPILL_FILE = ".lux_series.mmap"
+
+# Secs of raw readings kept, and the most that can be taken in that time
+# sampling as fast as the light monitor does (light_monitor.FAST_POLL_TIME)
+RAW_SECS = 3600
+FASTEST_POLL = 0.25
+RAW_SIZE = int(RAW_SECS / FASTEST_POLL)
+# (bucket secs, buckets kept)
+TIERS = ((60, 1440), (900, 2880))
+
+_MAGIC = b"LUX2"
+# Magic then (head, count) for the raw ring and each tier
+_HEADER = struct.Struct("<4s" + "II" * (1 + len(TIERS)))
+# Start time, min, max, mean, number of readings
+_RECORD = struct.Struct("<dfffI")
+# Bucket being filled: start time, min, max, total, number of readings (0
+# if there isn't one)
+_CURRENT = struct.Struct("<dffdI")
+
+l = logging.getLogger(__name__)
+
+
+class _Ring(object):
+    """ Ring of records in the mapped file, index 0 is the oldest """
+
+    def __init__(self, mm, index, offset, size):
+        self._mm = mm
+        self._state_offset = 4 + 8 * index
+        self._offset = offset
+        self._size = size
+        return
+
+    def _state(self):
+        return struct.unpack_from("<II", self._mm, self._state_offset)
+
+    def __len__(self):
+        return self._state()[1]
+
+    def append(self, record):
+        head, count = self._state()
+        _RECORD.pack_into(self._mm, self._offset + head * _RECORD.size, *record)
+        struct.pack_into("<II", self._mm, self._state_offset,
+                (head + 1) % self._size, min(count + 1, self._size))
+        return
+
+    def __getitem__(self, i):
+        head, count = self._state()
+        slot = (head - count + i) % self._size
+        return _RECORD.unpack_from(self._mm, self._offset + slot * _RECORD.size)
+
+    def bisect(self, t):
+        """ Index of the first record starting at or after t """
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid][0] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def between(self, start, end):
+        """ Records with start <= time < end, oldest first """
+        return [self[i] for i in range(self.bisect(start), self.bisect(end))]
+
+
+class Lux_Series(object):
+    """
+        add() a reading at a time, query() for a time range. With no path the
+        series is kept in anonymous memory.
+    """
+
+    def __init__(self, path=None, read_only=False):
+        self._path = path
+        rings = [RAW_SIZE] + [size for secs, size in TIERS]
+        offset = _HEADER.size + len(TIERS) * _CURRENT.size
+        length = offset + sum(rings) * _RECORD.size
+        if path is None:
+            self._mm = mmap.mmap(-1, length)
+        else:
+            exists = os.path.exists(path) and os.path.getsize(path) == length
+            if not exists and read_only:
+                raise IOError("No lux series at {}".format(path))
+            fd = os.open(path, os.O_RDONLY if read_only else os.O_RDWR | os.O_CREAT)
+            if not exists:
+                os.ftruncate(fd, length)
+            self._mm = mmap.mmap(fd, length, access=mmap.ACCESS_READ if read_only
+                    else mmap.ACCESS_WRITE)
+            os.close(fd)
+        if self._mm[:4] != _MAGIC:
+            if read_only:
+                raise IOError("Bad lux series file {}".format(path))
+            self._mm[:offset] = (_HEADER.pack(_MAGIC, *([0] * 2 * len(rings))) +
+                    b"\0" * (offset - _HEADER.size))
+        self._rings = []
+        for i, size in enumerate(rings):
+            self._rings.append(_Ring(self._mm, i, offset, size))
+            offset += size * _RECORD.size
+        return
+
+    def _current(self, i):
+        """ Bucket tier i is filling, [start, min, max, total, n] or None """
+        cur = _CURRENT.unpack_from(self._mm, _HEADER.size + i * _CURRENT.size)
+        return list(cur) if cur[4] else None
+
+    def _set_current(self, i, cur):
+        _CURRENT.pack_into(self._mm, _HEADER.size + i * _CURRENT.size, *cur)
+        return
+
+    def add(self, lux, t=None):
+        """ Add a raw reading """
+        if t is None:
+            t = time.time()
+        lux = float(lux)
+        self._rings[0].append((t, lux, lux, lux, 1))
+        for i, (secs, size) in enumerate(TIERS):
+            start = t - t % secs
+            cur = self._current(i)
+            if cur is not None and cur[0] != start:
+                self._rings[i + 1].append((cur[0], cur[1], cur[2], cur[3] / cur[4], cur[4]))
+                cur = None
+            if cur is None:
+                cur = [start, lux, lux, lux, 1]
+            else:
+                cur[1] = min(cur[1], lux)
+                cur[2] = max(cur[2], lux)
+                cur[3] += lux
+                cur[4] += 1
+            self._set_current(i, cur)
+        return
+
+    def query(self, start, end=None, resolution=None):
+        """
+            Return (time, min, max, mean, count) tuples for start <= time < end,
+            oldest first. resolution is 0 for raw readings or one of the tier
+            bucket sizes in secs, by default the finest one that still covers
+            start.
+        """
+        now = time.time()
+        if end is None:
+            end = now + 1
+        if resolution is None:
+            resolution = 0 if start >= now - RAW_SECS else None
+            for secs, size in TIERS:
+                if resolution is None and start >= now - secs * size:
+                    resolution = secs
+            if resolution is None:
+                resolution = TIERS[-1][0]
+        if resolution == 0:
+            return self._rings[0].between(start, end)
+        i = [secs for secs, size in TIERS].index(resolution)
+        rows = self._rings[i + 1].between(start, end)
+        cur = self._current(i)
+        if cur is not None and start <= cur[0] < end:
+            rows.append((cur[0], cur[1], cur[2], cur[3] / cur[4], cur[4]))
+        return rows
+
+    def summary(self, start, end=None):
+        """ (min, max, mean, count) over a time range, None if there's no data """
+        rows = self.query(start, end)
+        count = sum(r[4] for r in rows)
+        if not count:
+            return None
+        return (min(r[1] for r in rows), max(r[2] for r in rows),
+                sum(r[3] * r[4] for r in rows) / count, count)
+
+    def flush(self):
+        self._mm.flush()
+        return
+
+    def close(self):
+        self._mm.close()
+        return
+
+
+if __name__ == "__main__":
+    import random
+    s = Lux_Series()
+    now = time.time()
+    t = now - 2 * 86400
+    while t < now:
+        s.add(random.choice((0, 1, 30)), t)
+        t += 5
+    print("raw: {} rows".format(len(s.query(now - 600))))
+    print("1 min: {} rows".format(len(s.query(now - 6 * 3600))))
+    print("15 min: {} rows".format(len(s.query(now - 2 * 86400))))
+    print("summary last day: {}".format(s.summary(now - 86400)))
+
+    # An hour of readings at the fastest poll fits the raw ring, and a
+    # reader (another process) sees the minute being filled
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), SPILL_FILE)
+    s = Lux_Series(path)
+    start = now - RAW_SECS
+    for i in range(RAW_SIZE):
+        s.add(10, start + i * FASTEST_POLL)
+    reader = Lux_Series(path, read_only=True)
+    assert len(reader.query(start, resolution=0)) == RAW_SIZE
+    last = reader.query(now - 60, resolution=60)[-1]
+    assert last[0] == (now - FASTEST_POLL) - (now - FASTEST_POLL) % 60 and last[4] > 0, last
+    print("raw ring holds {:.0f} min at {} sec polls, reader sees the current minute ({} "
+            "readings)".format(RAW_SIZE * FASTEST_POLL / 60, FASTEST_POLL, last[4]))
@@ -0,0 +1,422 @@
+'''
+    Counters, gauges and fixed bucket histograms, served in the Prometheus
+    text format by the SMS process (/metrics).
+
+    Updating a metric never takes a lock. Each thread gets its own cell
+    (a small list only that thread writes to) the first time it updates a
+    metric, and reading a metric adds the cells up. Locks are only taken
+    to add a thread's cell or a new set of label values, and when
+    collecting.
+
+    The doors, light monitor and command queue live in the main process,
+    the web server in the SMS process. Each process other than the SMS one
+    publishes a snapshot of its metrics every PUBLISH_INTERVAL secs
+    (start_publishing()) to a file in SHARED_DIR, which is in memory
+    (tmpfs), so nothing is written to the SD card. The file is only
+    rewritten when the snapshot has changed, otherwise its time is touched
+    to show the process is still there. /metrics adds the snapshots that
+    aren't stale to the SMS process's own metrics. Samples with the same
+    name and labels from different processes are added up.
+
+      REQUESTS = metrics.counter("garage_requests_total", "Requests", ["door"])
+      REQUESTS.labels("Ivan").inc()
+      with metrics.histogram("garage_read_seconds", "I2C reads").time():
+          ...
+'''
+from bisect import bisect_left
+import threading
+import tempfile
+import logging
+import json
+import glob
+import time
+import os
+
+# Secs between publishing snapshots
+PUBLISH_INTERVAL = 5.0
+# Snapshots older than this are left out (their process has gone)
+STALE_AFTER = 3 * PUBLISH_INTERVAL
+# Where snapshots are published, shared memory if there is any
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+SNAPSHOT_FILE = "garage_metrics_{}.json"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Histogram buckets (upper bounds, secs)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0)
+TRAVEL_BUCKETS = (1.0, 2.0, 4.0, 6.0, 8.0, 10.0, 12.0, 14.0, 16.0, 20.0, 30.0)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+l = logging.getLogger(__name__)
+
+_metrics = {}  # name -> _Metric
+_metrics_lock = threading.Lock()
+_publisher = None
+_published = {}  # process -> json last written
+
+
+class _Cells(object):
+    """ Per thread cells of one metric (or one set of its label values) """
+
+    def __init__(self, size):
+        self._size = size
+        self._cells = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        return
+
+    def cell(self):
+        """ This thread's cell """
+        cell = getattr(self._local, "cell", None)
+        if cell is None:
+            cell = self._local.cell = [0] * self._size
+            with self._lock:
+                self._cells.append(cell)
+        return cell
+
+    def total(self):
+        """ The cells added up """
+        totals = [0] * self._size
+        for cell in list(self._cells):
+            for i, value in enumerate(cell):
+                totals[i] += value
+        return totals
+
+
+class Counter(object):
+    """ Only goes up """
+
+    def __init__(self):
+        self._cells = _Cells(1)
+        return
+
+    def inc(self, n=1):
+        self._cells.cell()[0] += n
+        return
+
+    def value(self):
+        return self._cells.total()[0]
+
+
+class Gauge(object):
+    """ Set to a value, or read from fn when collected """
+
+    def __init__(self):
+        self._value = 0
+        self._fn = None
+        return
+
+    def set(self, value):
+        self._value = value
+        return
+
+    def set_function(self, fn):
+        """ Report fn() (skipped if it returns None or raises) """
+        self._fn = fn
+        return
+
+    def value(self):
+        if self._fn is None:
+            return self._value
+        try:
+            return self._fn()
+        except Exception as e:
+            l.debug("Gauge function failed: {}".format(e))
+            return None
+
+
+class Histogram(object):
+    """ Counts observations per bucket, plus their sum and count """
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+        # A count per bucket, one for +Inf, then the sum and the count
+        self._cells = _Cells(len(buckets) + 3)
+        return
+
+    def observe(self, value):
+        cell = self._cells.cell()
+        cell[bisect_left(self._buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+        return
+
+    def time(self):
+        """ Context manager that observes the secs its block takes """
+        return _Timer(self)
+
+    def value(self):
+        return self._cells.total()
+
+
+class _Timer(object):
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+        return
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.time() - self._start)
+        return False
+
+
+_KINDS = {COUNTER: Counter, GAUGE: Gauge, HISTOGRAM: Histogram}
+
+
+class _Metric(object):
+    """
+        A named metric, and its children, one per set of label values. A
+        metric without labels is its own (only) child, so its methods
+        (inc, set, observe, ...) can be called on it directly.
+    """
+
+    def __init__(self, name, kind, help, labels, buckets):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) if kind == HISTOGRAM else None
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            self._only = self._new_child()
+            self._children[()] = self._only
+        return
+
+    def _new_child(self):
+        if self.kind == HISTOGRAM:
+            return Histogram(self.buckets)
+        return _KINDS[self.kind]()
+
+    def labels(self, *values):
+        """ The child for these label values, in label_names order """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError("{} has labels {}".format(self.name, self.label_names))
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def __getattr__(self, attr):
+        # inc(), observe(), ... on a metric without labels
+        if attr.startswith("_") or self.label_names:
+            raise AttributeError(attr)
+        return getattr(self._only, attr)
+
+    def samples(self):
+        """ [label values, value], values that can't be read are left out """
+        with self._lock:
+            children = list(self._children.items())
+        samples = []
+        for values, child in children:
+            value = child.value()
+            if value is not None:
+                samples.append([list(values), value])
+        return samples
+
+
+def _get(name, kind, help, labels, buckets=None):
+    with _metrics_lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = _Metric(name, kind, help, labels, buckets)
+        elif metric.kind != kind or metric.label_names != tuple(labels):
+            raise ValueError("{} is already a {} with labels {}".format(name,
+                    metric.kind, metric.label_names))
+    return metric
+
+
+def counter(name, help, labels=()):
+    """ The counter called name, created the first time """
+    return _get(name, COUNTER, help, labels)
+
+
+def gauge(name, help, labels=(), fn=None):
+    """ The gauge called name, created the first time. fn replaces its function """
+    metric = _get(name, GAUGE, help, labels)
+    if fn is not None:
+        metric.set_function(fn)
+    return metric
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    """ The histogram called name, created the first time """
+    return _get(name, HISTOGRAM, help, labels, buckets)
+
+
+def snapshot():
+    """ This process's metrics, as something json can hold """
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+    snap = {}
+    for metric in metrics:
+        snap[metric.name] = {"type": metric.kind, "help": metric.help,
+                "labels": list(metric.label_names),
+                "buckets": None if metric.buckets is None else list(metric.buckets),
+                "samples": metric.samples()}
+    return snap
+
+
+def _snapshot_path(process):
+    return os.path.join(SHARED_DIR, SNAPSHOT_FILE.format(process))
+
+
+def publish(process):
+    """
+        Write this process's snapshot for the SMS process to read, or just
+        touch the file if it hasn't changed since the last write
+    """
+    data = json.dumps(snapshot(), sort_keys=True)
+    path = _snapshot_path(process)
+    if _published.get(process) == data and os.path.exists(path):
+        os.utime(path, None)
+        return
+    # Renamed into place so a reader never sees half a file
+    tmp = "{}.{}".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(data)
+    os.rename(tmp, path)
+    _published[process] = data
+    return
+
+
+def start_publishing(process, interval=PUBLISH_INTERVAL):
+    """ publish() every interval secs on a thread of its own """
+    global _publisher
+
+    def run():
+        while True:
+            try:
+                publish(process)
+            except Exception as e:
+                l.error("Couldn't publish metrics: {}".format(e))
+            time.sleep(interval)
+
+    _publisher = threading.Thread(target=run, name="Metrics publisher")
+    _publisher.daemon = True
+    _publisher.start()
+    return
+
+
+def gather(process):
+    """ This process's snapshot and the fresh ones other processes published """
+    snaps = [snapshot()]
+    own = _snapshot_path(process)
+    cutoff = time.time() - STALE_AFTER
+    for path in glob.glob(_snapshot_path("*")):
+        if path == own:
+            continue
+        try:
+            if os.path.getmtime(path) <= cutoff:
+                continue
+            with open(path) as f:
+                snaps.append(json.load(f))
+        except (IOError, OSError, ValueError) as e:
+            l.error("Can't read metrics {}: {}".format(path, e))
+    return snaps
+
+
+def _add(a, b):
+    if isinstance(a, list):
+        return [x + y for x, y in zip(a, b)]
+    return a + b
+
+
+def merge(snaps):
+    """ One snapshot, samples with the same name and labels added up """
+    merged = {}
+    for snap in snaps:
+        for name, metric in snap.items():
+            into = merged.get(name)
+            if into is None:
+                into = merged[name] = dict(metric, samples={})
+            elif (into["type"] != metric["type"] or
+                    into.get("buckets") != metric.get("buckets")):
+                l.error("Metric {} differs between processes, skipping one".format(name))
+                continue
+            for values, value in metric["samples"]:
+                key = tuple(values)
+                if key in into["samples"]:
+                    into["samples"][key] = _add(into["samples"][key], value)
+                else:
+                    into["samples"][key] = value
+    return merged
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('{}="{}"'.format(*extra))
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render(snaps):
+    """ Prometheus text format of the snapshots, added up """
+    lines = []
+    for name, metric in sorted(merge(snaps).items()):
+        lines.append("# HELP {} {}".format(name, metric["help"].replace("\n", " ")))
+        lines.append("# TYPE {} {}".format(name, metric["type"]))
+        names = metric["labels"]
+        for values, value in sorted(metric["samples"].items()):
+            if metric["type"] != HISTOGRAM:
+                lines.append("{}{} {}".format(name, _labels(names, values), _number(value)))
+                continue
+            cumulative = 0
+            bounds = [_number(float(b)) for b in metric["buckets"]] + ["+Inf"]
+            for bound, count in zip(bounds, value[:-2]):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name,
+                        _labels(names, values, ("le", bound)), cumulative))
+            lines.append("{}_sum{} {}".format(name, _labels(names, values),
+                    _number(value[-2])))
+            lines.append("{}_count{} {}".format(name, _labels(names, values), value[-1]))
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    # What a counter and a histogram update cost, 4 threads at once, and
+    # what /metrics would show
+    n = 200000
+    c = counter("demo_events_total", "Events", ["door"])
+    h = histogram("demo_seconds", "Handling time")
+
+    def work():
+        ivan = c.labels("Ivan")
+        for i in range(n):
+            ivan.inc()
+            h.observe(0.003)
+
+    start = time.time()
+    work()
+    print("{:.2f} us per counter + histogram update".format(
+            (time.time() - start) * 1e6 / n))
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert c.labels("Ivan").value() == 5 * n and h.value()[-1] == 5 * n
+    gauge("demo_depth", "Queue depth", fn=lambda: 3)
+    print(render([snapshot(), snapshot()]))
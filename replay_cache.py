@@ -0,0 +1,243 @@
+'''
+    Replay protection for inbound webhooks. Remembers the message uuids seen
+    in the last REPLAY_WINDOW seconds in a dict, with a time ordered deque to
+    expire them, so memory and the table on disk are bounded by the window
+    rather than by every message ever received.
+
+    Each uuid is also a row in the store's replay table (storage.py), so a
+    restart still knows about the recent ones. Expired rows are deleted now
+    and then.
+
+    Forgetting a uuid mustn't let its message be replayed, so messages
+    older than the window are turned away too. Plivo's MessageUUIDs are
+    time based (version 1) uuids, uuid_time() gets the time from one.
+'''
+from collections import deque
+import threading
+import logging
+import hashlib
+import struct
+import time
+import uuid as UUID
+import storage
+
+# Secs a message uuid is remembered
+REPLAY_WINDOW = 7 * 86400
+# Min secs between deleting expired rows from the store
+EXPIRE_INTERVAL = 300
+# Secs plivo's clock may be ahead of ours
+CLOCK_SKEW = 300
+# 100ns intervals from the uuid epoch (1582-10-15) to the unix epoch
+_UUID_EPOCH = 0x01b21dd213814000
+
+l = logging.getLogger(__name__)
+
+
+def uuid_time(uuid):
+    """ Unix time a version 1 uuid was made, None for any other uuid """
+    try:
+        u = UUID.UUID(uuid)
+    except ValueError:
+        return None
+    if u.version != 1:
+        return None
+    return (u.time - _UUID_EPOCH) / 1e7
+
+
+class Bloom_Filter(object):
+    """ Fixed size bloom filter, no false negatives, rare false positives """
+
+    def __init__(self, bits=1 << 16, hashes=4):
+        self._bits = bits
+        self._hashes = hashes
+        self._array = bytearray(bits // 8)
+        return
+
+    def _positions(self, key):
+        # md5 gives enough bits for up to 4 hashes
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        for h in struct.unpack_from("<4I", digest)[:self._hashes]:
+            yield h % self._bits
+
+    def add(self, key):
+        for p in self._positions(key):
+            self._array[p >> 3] |= 1 << (p & 7)
+        return
+
+    def __contains__(self, key):
+        return all(self._array[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+
+class Replay_Cache(object):
+    """
+        Set of recently seen uuids. seen() is O(1), expiry is amortized O(1)
+        per uuid.
+    """
+
+    def __init__(self, store=None, window=REPLAY_WINDOW,
+            expire_interval=EXPIRE_INTERVAL, bloom_bits=0):
+        self._store = store
+        self._window = window
+        self._expire_interval = expire_interval
+        self._bloom_bits = bloom_bits
+        self._bloom = None
+        self._seen = {}  # uuid -> time seen
+        self._order = deque()  # (time seen, uuid), oldest first
+        self._lock = threading.Lock()
+        self._last_expire = time.time()
+        if store is not None:
+            self._load()
+        self._rebuild_bloom()
+        return
+
+    def __len__(self):
+        return len(self._seen)
+
+    def __contains__(self, uuid):
+        with self._lock:
+            self._expire(time.time())
+            return self._lookup(uuid)
+
+    def _lookup(self, uuid):
+        if self._bloom is not None and uuid not in self._bloom:
+            return False
+        return uuid in self._seen
+
+    def in_window(self, sent, now=None):
+        """
+            True if a message sent at time sent (uuid_time()) is recent
+            enough that its uuid would still be remembered if it had been
+            seen before.
+        """
+        if now is None:
+            now = time.time()
+        # Seen at the earliest CLOCK_SKEW secs before it says it was sent
+        return now - self._window + CLOCK_SKEW <= sent <= now + CLOCK_SKEW
+
+    def seen(self, uuid, t=None):
+        """
+            Record uuid. Returns True if it was already seen within the
+            window (i.e. this is a replay).
+        """
+        if t is None:
+            t = time.time()
+        with self._lock:
+            self._expire(t)
+            if self._lookup(uuid):
+                return True
+            self._seen[uuid] = t
+            self._order.append((t, uuid))
+            if self._bloom is not None:
+                self._bloom.add(uuid)
+        if self._store is not None:
+            self._store.execute("INSERT OR REPLACE INTO replay (uuid, t) VALUES (?, ?)",
+                    (uuid, t))
+        return False
+
+    def _expire(self, now):
+        """ Drop uuids older than the window, call with lock held """
+        cutoff = now - self._window
+        order = self._order
+        while order and order[0][0] < cutoff:
+            t, uuid = order.popleft()
+            if self._seen.get(uuid) == t:
+                del self._seen[uuid]
+        return
+
+    def _rebuild_bloom(self):
+        """ Expired uuids can't be removed from a bloom filter, so start a new one """
+        if self._bloom_bits:
+            self._bloom = Bloom_Filter(self._bloom_bits)
+            for uuid in self._seen:
+                self._bloom.add(uuid)
+        return
+
+    def maybe_expire(self):
+        """ expire() if the interval has passed """
+        if time.time() - self._last_expire >= self._expire_interval:
+            self.expire()
+        return
+
+    def expire(self):
+        """ Forget expired uuids, in memory and in the store """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            self._rebuild_bloom()
+            self._last_expire = now
+        if self._store is not None:
+            self._store.execute("DELETE FROM replay WHERE t < ?", (now - self._window,))
+        return
+
+    def _load(self):
+        cutoff = time.time() - self._window
+        for uuid, t in self._store.query("SELECT uuid, t FROM replay WHERE t >= ? "
+                "ORDER BY t", (cutoff,)):
+            self._seen[uuid] = t
+            self._order.append((t, uuid))
+        l.info("Loaded {} recent message uuids".format(len(self._seen)))
+        return
+
+    def migrate_shelve(self, path):
+        """
+            Load the uuids from the shelve file older versions kept (every
+            uuid ever seen), the first time only. The shelve has no times,
+            each uuid's is taken from the uuid itself, those outside the
+            window are turned away anyway. Returns how many were added.
+        """
+        if self._store is None or self._store.migrated("replay"):
+            return 0
+        db = storage.open_shelve(path)
+        count = 0
+        if db is not None:
+            for uuid in db.keys():
+                sent = uuid_time(uuid)
+                if sent is not None and self.in_window(sent) and not self.seen(uuid, sent):
+                    count += 1
+            db.close()
+            l.info("Migrated {} recent message uuids from {}".format(count, path))
+        self._store.mark_migrated("replay")
+        return count
+
+
+if __name__ == "__main__":
+    import timeit
+
+    cache = Replay_Cache(window=3600, bloom_bits=1 << 20)
+    ids = [str(UUID.uuid4()) for i in range(100000)]
+    now = time.time()
+    start = timeit.default_timer()
+    for i, u in enumerate(ids):
+        cache.seen(u, now + i * 0.1)  # 10k secs of traffic, 1 hour window
+    elapsed = timeit.default_timer() - start
+    print("{:.2f} usec per seen(), {} uuids live".format(elapsed / len(ids) * 1e6, len(cache)))
+    assert cache.seen(ids[-1], now + len(ids) * 0.1)
+
+    # A fresh message goes through once, sending it again is a replay. One
+    # from before the window (its uuid forgotten, or our clock is wrong) or
+    # with no time in its uuid is turned away without the alarm
+    from Queue import Queue
+    from webhook_pipeline import Signature_Validator, Webhook_Pipeline
+
+    def uuid_at(t):
+        ticks = int(t * 1e7) + _UUID_EPOCH
+        return str(UUID.UUID(fields=(ticks & 0xffffffff, (ticks >> 32) & 0xffff,
+                ((ticks >> 48) & 0x0fff) | 0x1000, 0x80, 0, 0x0123456789ab)))
+
+    assert abs(uuid_time(uuid_at(now - REPLAY_WINDOW)) - (now - REPLAY_WINDOW)) < 1e-3
+    assert uuid_time(str(UUID.uuid4())) is None
+    signer = Signature_Validator("https://example.com/", "token")
+    forwarded = Queue()
+    rejected = []
+    pipeline = Webhook_Pipeline(signer, Replay_Cache(), forwarded, rejected.append)
+    for u in (uuid_at(now), uuid_at(now), uuid_at(now - REPLAY_WINDOW - 3600),
+            str(UUID.uuid4())):
+        form = {"Text": "Ivan", "MessageUUID": u}
+        pipeline.capture(form, form, signer.signature(form))
+        time.sleep(0.1)
+        pipeline._stopped = False  # keep validating after a rejection
+    assert forwarded.qsize() == 1, forwarded.qsize()
+    assert rejected == ["Duplicate msg"], rejected
+    assert pipeline.stale == 2, pipeline.stale
+    print("Replays turned away: {}, stale ignored: {}".format(", ".join(rejected),
+            pipeline.stale))
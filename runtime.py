@@ -0,0 +1,315 @@
+'''
+    Event core for the main process. Inbound commands (from the SMS process
+    queue) are routed to a Command_Executor, a fixed pool of worker threads.
+    Commands with a key (e.g. the door they touch) run one at a time and in
+    order for that key, commands without one (status, history, ...) run on
+    any free worker. So a slow handler only holds up its own door.
+
+    The executor's queue is bounded. When it stays full the command is
+    turned away (on_busy) rather than letting work pile up.
+
+    The systemd watchdog is fed from its own thread, as long as the inbound
+    loop is still turning over.
+'''
+from Queue import Empty, Full
+from collections import deque
+import threading
+import logging
+import time
+import metrics
+
+# Secs between watchdog pings
+WATCHDOG_INTERVAL = 20
+# Max secs without the inbound loop checking in before we stop feeding the
+# watchdog (and let systemd restart us)
+LIVENESS_TIMEOUT = 60
+# Secs to wait on the inbound queue before checking in
+POLL_TIME = 1
+# Number of commands that can run at once
+WORKER_COUNT = 4
+# Max commands waiting for a worker
+MAX_PENDING = 32
+# Secs to wait for room in the executor before turning a command away
+SUBMIT_TIMEOUT = 10
+# Secs between logging the command stats
+STATS_INTERVAL = 3600
+# Key stamp() adds to an inbound message, the time it was queued
+QUEUED_KEY = "_queued"
+
+l = logging.getLogger(__name__)
+
+_WAIT_SECONDS = metrics.histogram("garage_command_wait_seconds",
+        "Secs a command waits in the executor queue", ["command"])
+_RUN_SECONDS = metrics.histogram("garage_command_run_seconds",
+        "Secs a command takes to run", ["command"])
+_ERRORS = metrics.counter("garage_command_errors_total", "Commands that raised",
+        ["command"])
+_TURNED_AWAY = metrics.counter("garage_command_turned_away_total",
+        "Commands turned away because the executor was full")
+_INBOUND_WAIT_SECONDS = metrics.histogram("garage_inbound_wait_seconds",
+        "Secs a message from the SMS process waits in the inbound queue")
+
+
+def stamp(msg):
+    """ msg (a dict), marked with the time it's put on the inbound queue """
+    msg[QUEUED_KEY] = time.time()
+    return msg
+
+
+class Shutdown(Exception):
+    """ Raised by a router to stop the event core """
+    pass
+
+
+class Command_Stats(object):
+    """ Queue wait and run time for one command """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+        self._wait_metric = _WAIT_SECONDS.labels(name)
+        self._run_metric = _RUN_SECONDS.labels(name)
+        return
+
+    def record(self, wait, run, failed=False):
+        # Called with the executor lock held
+        self._wait_metric.observe(wait)
+        self._run_metric.observe(run)
+        self.count += 1
+        if failed:
+            self.errors += 1
+            _ERRORS.labels(self.name).inc()
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.run_total += run
+        self.run_max = max(self.run_max, run)
+        return
+
+    def __str__(self):
+        n = max(self.count, 1)
+        return "{}: count {} errors {} wait avg {:.3f} max {:.3f} run avg {:.3f} max {:.3f}".format(
+                self.name, self.count, self.errors, self.wait_total / n,
+                self.wait_max, self.run_total / n, self.run_max)
+
+
+class Command_Executor(object):
+    """
+        Pool of workers. Commands for the same key run in the order they
+        were submitted and never at the same time, keys take turns so one
+        busy key can't starve the others. Commands with key None run as
+        soon as a worker is free.
+    """
+
+    def __init__(self, workers=WORKER_COUNT, max_pending=MAX_PENDING):
+        self._lock = threading.Lock()
+        self._work_ready = threading.Condition(self._lock)
+        self._space = threading.Condition(self._lock)
+        self._max_pending = max_pending
+        self._pending = 0
+        # Keys with work and no worker on them, or (None, task) for keyless work
+        self._ready = deque()
+        # key -> tasks, a key is here while it has work queued or running
+        self._keyed = {}
+        self.stats = {}
+        metrics.gauge("garage_command_queue_depth", "Commands waiting for a worker",
+                fn=lambda: self._pending)
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name="Executor-{}".format(i))
+            t.daemon = True
+            t.start()
+        return
+
+    def submit(self, key, fn, args=(), name=None, timeout=None):
+        """
+            Queue fn(*args). Blocks while max_pending commands are waiting,
+            raises Queue.Full if there's still no room after timeout secs.
+        """
+        if name is None:
+            name = getattr(fn, '__name__', str(fn))
+        task = (name, fn, args, time.time())
+        with self._lock:
+            end = None if timeout is None else time.time() + timeout
+            while self._pending >= self._max_pending:
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise Full()
+                self._space.wait(remaining)
+            self._pending += 1
+            if key is None:
+                self._ready.append((None, task))
+            elif key in self._keyed:
+                # Picked up when the key's turn comes around
+                self._keyed[key].append(task)
+            else:
+                self._keyed[key] = deque([task])
+                self._ready.append((key, None))
+            self._work_ready.notify()
+        return
+
+    @property
+    def pending(self):
+        """ Number of commands waiting for a worker """
+        return self._pending
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._ready:
+                    self._work_ready.wait()
+                key, task = self._ready.popleft()
+                if key is not None:
+                    task = self._keyed[key].popleft()
+                self._pending -= 1
+                self._space.notify()
+            name, fn, args, submitted = task
+            start = time.time()
+            failed = False
+            try:
+                fn(*args)
+            except Exception:
+                failed = True
+                l.exception("Error in handler {} for {}".format(name, key))
+            end = time.time()
+            with self._lock:
+                stats = self.stats.get(name)
+                if stats is None:
+                    stats = self.stats[name] = Command_Stats(name)
+                stats.record(start - submitted, end - start, failed)
+                if key is not None:
+                    if self._keyed[key]:
+                        # Back of the line for the key's next command
+                        self._ready.append((key, None))
+                        self._work_ready.notify()
+                    else:
+                        del self._keyed[key]
+        return
+
+    def summary(self):
+        with self._lock:
+            lines = [str(s) for n, s in sorted(self.stats.items())]
+            lines.append("pending: {}".format(self._pending))
+        return "\n".join(lines)
+
+
+class Event_Core(object):
+    """
+        Reads messages from the inbound queue and hands them to the router.
+        The router returns (key, handler, args), or None to drop the
+        message, or raises Shutdown. key is None for handlers that can run
+        alongside anything. on_busy(msg) is called for a message turned
+        away because the executor is full.
+    """
+
+    def __init__(self, inbound, router, notifier=None,
+            watchdog_interval=WATCHDOG_INTERVAL, executor=None, on_busy=None):
+        self._inbound = inbound
+        self._router = router
+        self._notifier = notifier
+        self._watchdog_interval = watchdog_interval
+        if executor is None:
+            executor = Command_Executor()
+        self.executor = executor
+        self._on_busy = on_busy
+        self._stop = threading.Event()
+        self._last_tick = time.time()
+        metrics.gauge("garage_inbound_queue_depth",
+                "Messages from the SMS process waiting to be routed", fn=inbound.qsize)
+        return
+
+    def submit(self, key, fn, args=()):
+        """ Hand a command to the executor, False if it was turned away """
+        try:
+            self.executor.submit(key, fn, args, timeout=SUBMIT_TIMEOUT)
+        except Full:
+            _TURNED_AWAY.inc()
+            return False
+        return True
+
+    def _watchdog(self):
+        while not self._stop.wait(self._watchdog_interval):
+            if time.time() - self._last_tick < LIVENESS_TIMEOUT:
+                self._notifier.notify("WATCHDOG=1")
+            else:
+                l.error("Inbound loop is stuck, not feeding the watchdog")
+        return
+
+    def run(self):
+        """ Process inbound messages until stop() is called or a router raises Shutdown """
+        if self._notifier is not None:
+            t = threading.Thread(target=self._watchdog, name="Watchdog")
+            t.daemon = True
+            t.start()
+        next_stats = time.time() + STATS_INTERVAL
+        while not self._stop.is_set():
+            self._last_tick = time.time()
+            if self._last_tick > next_stats:
+                l.info("Command stats:\n{}".format(self.executor.summary()))
+                next_stats = self._last_tick + STATS_INTERVAL
+            try:
+                msg = self._inbound.get(True, POLL_TIME)
+            except Empty:
+                continue
+            queued = msg.pop(QUEUED_KEY, None)
+            if queued is not None:
+                _INBOUND_WAIT_SECONDS.observe(time.time() - queued)
+            l.debug("Received message <{0}>.".format(msg))
+            try:
+                routed = self._router(msg)
+            except Shutdown:
+                l.info("Shutting down event core")
+                self.stop()
+                break
+            except Exception:
+                l.exception("Error routing message <{0}>".format(msg))
+                continue
+            if routed is not None:
+                key, fn, args = routed
+                if not self.submit(key, fn, args):
+                    l.error("Too busy, dropping message <{0}>".format(msg))
+                    if self._on_busy is not None:
+                        self._on_busy(msg)
+        return
+
+    def stop(self):
+        self._stop.set()
+        return
+
+
+if __name__ == "__main__":
+    # Two doors pressed twice each (0.2 sec relay press) plus status checks
+    # from several people. Presses for a door must stay in order and not
+    # overlap, the rest shouldn't wait for them.
+    e = Command_Executor(workers=4, max_pending=8)
+    running = {}
+    order = []
+    lock = threading.Lock()
+
+    def press(door, n):
+        with lock:
+            assert not running.get(door), "overlapping presses"
+            running[door] = True
+        time.sleep(0.2)
+        with lock:
+            running[door] = False
+            order.append((door, n))
+
+    def status():
+        time.sleep(0.01)
+
+    start = time.time()
+    for n in range(2):
+        e.submit("i", press, ("i", n))
+        e.submit("h", press, ("h", n))
+        for i in range(4):
+            e.submit(None, status)
+    while e.pending or len(order) < 4:
+        time.sleep(0.01)
+    print("4 presses and 8 status in {:.2f} secs (one at a time: 0.88)".format(
+            time.time() - start))
+    print("order: {}".format(order))
+    print(e.summary())
@@ -0,0 +1,174 @@
+'''
+    One thread that runs all the timed callbacks (nag timers, door checks,
+    snoozes, light left on, ...) instead of a threading.Timer thread each.
+    Deadlines are on the monotonic clock so wall clock changes (ntp, dst)
+    don't move them.
+
+    Callbacks run on the scheduler thread, so they must not block for long.
+'''
+import threading
+import logging
+import ctypes
+import ctypes.util
+import heapq
+import time
+import os
+
+l = logging.getLogger(__name__)
+
+
+def _clock_gettime_monotonic():
+    """ Python 2 has no time.monotonic, get it from libc when we can """
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    clock_gettime = libc.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_MONOTONIC = 1
+    ts = timespec()
+
+    def monotonic():
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    monotonic()
+    return monotonic
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    try:
+        monotonic = _clock_gettime_monotonic()
+    except (OSError, AttributeError):
+        monotonic = time.time
+
+
+class Timer_Handle(object):
+    """ A scheduled callback. Call cancel() to stop it from running """
+
+    def __init__(self, scheduler, deadline, seq, fn, args, name):
+        self._scheduler = scheduler
+        self.deadline = deadline
+        self._seq = seq
+        self.fn = fn
+        self.args = args
+        self.name = name
+        self.cancelled = False
+        self.fired = False
+        return
+
+    def __lt__(self, other):
+        return (self.deadline, self._seq) < (other.deadline, other._seq)
+
+    @property
+    def active(self):
+        """ True if the callback is still waiting to run """
+        return not (self.cancelled or self.fired)
+
+    def remaining(self):
+        """ Seconds until the callback runs """
+        return max(self.deadline - monotonic(), 0.0)
+
+    def cancel(self):
+        self._scheduler.cancel(self)
+        return
+
+    def __repr__(self):
+        return "<Timer_Handle {} in {:.1f}s>".format(self.name, self.remaining())
+
+
+class Scheduler(object):
+    """
+        Heap of Timer_Handles serviced by a single thread. Cancelled handles
+        are left in the heap and skipped, the heap is rebuilt when they
+        outnumber the live ones.
+    """
+
+    def __init__(self, name="Scheduler"):
+        self._name = name
+        self._heap = []
+        self._seq = 0
+        self._cancelled = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+        self._pid = None
+        return
+
+    def _start(self):
+        """ Start the thread, or start a new one if we are in a forked child """
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=self._name)
+            self._thread.daemon = True
+            self._thread.start()
+        return
+
+    def call_later(self, delay, fn, args=(), name=None):
+        """ Run fn(*args) on the scheduler thread after delay seconds """
+        if self._pid != os.getpid():
+            self._start()
+        with self._cond:
+            self._seq += 1
+            handle = Timer_Handle(self, monotonic() + float(delay), self._seq,
+                    fn, tuple(args), name or getattr(fn, '__name__', str(fn)))
+            heapq.heappush(self._heap, handle)
+            if self._heap[0] is handle:
+                # New earliest deadline, wake the thread to wait less
+                self._cond.notify()
+        return handle
+
+    def cancel(self, handle):
+        with self._cond:
+            if handle.active:
+                handle.cancelled = True
+                self._cancelled += 1
+                if self._cancelled > len(self._heap) // 2:
+                    self._heap = [h for h in self._heap if not h.cancelled]
+                    heapq.heapify(self._heap)
+                    self._cancelled = 0
+        return
+
+    def pending(self):
+        """ Return the live handles, soonest first """
+        with self._cond:
+            return sorted(h for h in self._heap if h.active)
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap) - self._cancelled
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap and self._heap[0].cancelled:
+                        heapq.heappop(self._heap)
+                        self._cancelled -= 1
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait = self._heap[0].deadline - monotonic()
+                    if wait <= 0:
+                        handle = heapq.heappop(self._heap)
+                        handle.fired = True
+                        break
+                    self._cond.wait(wait)
+            try:
+                handle.fn(*handle.args)
+            except Exception:
+                l.exception("Error in scheduled callback {}".format(handle.name))
+        return
+
+
+if __name__ == "__main__":
+    s = Scheduler()
+    done = threading.Event()
+    handles = [s.call_later(0.01 * (i % 50), lambda: None) for i in range(10000)]
+    for h in handles[::2]:
+        h.cancel()
+    s.call_later(0.6, done.set, name="done")
+    print("{} pending, {} threads".format(len(s), threading.active_count()))
+    done.wait()
+    print("{} pending after run".format(len(s)))
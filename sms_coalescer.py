@@ -0,0 +1,290 @@
+'''
+    Coalesces door notifications per recipient, so a door that is opened
+    and closed, or a button press (the door opening, then the press being
+    confirmed), doesn't cost a text message per event. The first event for
+    a number starts a window, events for that number that come in before
+    it ends wait with it, and when it ends:
+
+      - an event that undoes one waiting for the same door (opened then
+        closed, closed then opened) cancels it, neither is sent
+      - an event repeating what is already waiting (e.g. "confirming
+        Ivan's door opened" after "Ivan's door was opened") is dropped
+      - whatever is left is sent as is if it's one event, else as one
+        digest message
+
+    The window is fixed from the first event, so nothing waits more than
+    WINDOW secs. Errors don't come through here, the door sends them
+    straight away. Set GARAGE_SMS_WINDOW in the environment to change the
+    window, 0 sends everything straight away.
+'''
+import threading
+import logging
+import time
+import os
+import metrics
+import garage_shared as GS
+
+WINDOW_ENV_VAR = "GARAGE_SMS_WINDOW"
+# Secs a recipient's events wait to be coalesced
+WINDOW = 30.0
+
+l = logging.getLogger(__name__)
+
+_EVENTS = metrics.counter("garage_notify_events_total",
+        "Door events per recipient given to the coalescer")
+_MESSAGES = metrics.counter("garage_notify_messages_total",
+        "Messages the coalescer sent for them")
+_DELAY_SECONDS = metrics.histogram("garage_notify_delay_seconds",
+        "Secs the coalescer held back an event it sent", buckets=(0.1, 1.0, 5.0, 10.0,
+        15.0, 20.0, 30.0, 60.0, 120.0))
+
+
+def default_window():
+    """ WINDOW, or GARAGE_SMS_WINDOW if it's set """
+    value = os.environ.get(WINDOW_ENV_VAR)
+    if not value:
+        return WINDOW
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        l.error("{} must be a number of secs, not '{}'".format(WINDOW_ENV_VAR, value))
+        return WINDOW
+
+
+def _split_link(msg):
+    """ (text, link) if msg ends with a link, else (msg, None) """
+    text, sep, last = msg.rpartition(" ")
+    if sep and last.startswith(("http://", "https://")):
+        return text, last
+    return msg, None
+
+
+def digest(msgs):
+    """ One message saying what msgs say, each link only once at the end """
+    if len(msgs) == 1:
+        return msgs[0]
+    texts = []
+    links = []
+    for msg in msgs:
+        text, link = _split_link(msg)
+        texts.append(text)
+        if link is not None and link not in links:
+            links.append(link)
+    return " ".join(texts + links)
+
+
+class Coalesce_Stats(object):
+    """ Messages saved and delay added by the coalescer """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.events = 0  # per recipient
+        self.messages = 0
+        self.digests = 0  # messages with more than one event
+        self.cancelled = 0
+        self.repeats = 0
+        self.delay_total = 0.0  # per event sent, secs it waited
+        self.delay_max = 0.0
+        self.delayed = 0
+        return
+
+    def record_event(self, passed=False):
+        """ An event for one recipient, passed if it was sent straight away """
+        _EVENTS.inc()
+        if passed:
+            _MESSAGES.inc()
+        with self._lock:
+            self.events += 1
+            if passed:
+                self.messages += 1
+        return
+
+    def record_cancel(self):
+        """ An event and the one it undid """
+        with self._lock:
+            self.cancelled += 2
+        return
+
+    def record_repeat(self):
+        with self._lock:
+            self.repeats += 1
+        return
+
+    def record_message(self, delays):
+        """ A message sent for events that waited delays secs """
+        _MESSAGES.inc()
+        for delay in delays:
+            _DELAY_SECONDS.observe(delay)
+        with self._lock:
+            self.messages += 1
+            if len(delays) > 1:
+                self.digests += 1
+            for delay in delays:
+                self.delayed += 1
+                self.delay_total += delay
+                self.delay_max = max(self.delay_max, delay)
+        return
+
+    def summary(self):
+        """ Return a dict snapshot of the counters """
+        with self._lock:
+            return {
+                "events": self.events,
+                "messages": self.messages,
+                "saved": self.events - self.messages,
+                "digests": self.digests,
+                "cancelled": self.cancelled,
+                "repeats": self.repeats,
+                "avg_delay": self.delay_total / max(self.delayed, 1),
+                "max_delay": self.delay_max,
+            }
+
+    def __str__(self):
+        return ", ".join("{}: {}".format(k, v) for k, v in sorted(self.summary().items()))
+
+
+class _Waiting(object):
+    """ Events waiting for one number's window to end """
+
+    def __init__(self):
+        # [source, state, msg, time received, priority]
+        self.entries = []
+        # source -> state it's back to after events cancelled out, so e.g.
+        # the confirmation of a close that cancelled an open is a repeat
+        self.cancelled = {}
+        self.timer = None
+        return
+
+
+class SMS_Coalescer(object):
+    """
+        Sits between the doors and send_message. Window timers run on the
+        shared scheduler, sends go through send (GS.send_message by
+        default).
+    """
+
+    def __init__(self, window=None, send=None):
+        self.window = default_window() if window is None else window
+        self._send = send
+        self._waiting = {}  # number -> _Waiting
+        self._lock = threading.Lock()
+        self.stats = Coalesce_Stats()
+        return
+
+    def _send_now(self, msg, number_list, priority):
+        if self._send is None:
+            GS.send_message(msg, number_list, priority)
+        else:
+            self._send(msg, number_list, priority)
+        return
+
+    def add(self, source, event, number_list, state=None, priority=None):
+        """
+            Queue event for the numbers. source is what the event is about
+            (the door name), state is the door state it reports, if any.
+            Events for the same source with different states cancel.
+            priority is the outbox class, a digest gets its most urgent.
+        """
+        if self.window <= 0:
+            for number in number_list:
+                self.stats.record_event(passed=True)
+            self._send_now(event.msg, number_list, priority)
+            return
+        now = time.time()
+        with self._lock:
+            for number in number_list:
+                waiting = self._waiting.get(number)
+                if waiting is None:
+                    waiting = self._waiting[number] = _Waiting()
+                    waiting.timer = GS.get_scheduler().call_later(self.window,
+                            self._window_over, [number], name="sms window")
+                self._add_entry(waiting, source, state, event.msg, now, priority)
+        return
+
+    def _add_entry(self, waiting, source, state, msg, now, priority):
+        """ Add to a number's events, call with _lock held """
+        self.stats.record_event()
+        entries = waiting.entries
+        if any(entry[2] == msg for entry in entries):
+            self.stats.record_repeat()
+            return
+        if state is not None:
+            # Compare with the latest state waiting for this source
+            for i in range(len(entries) - 1, -1, -1):
+                if entries[i][0] != source or entries[i][1] is None:
+                    continue
+                if entries[i][1] == state:
+                    self.stats.record_repeat()
+                else:
+                    del entries[i]
+                    waiting.cancelled[source] = state
+                    self.stats.record_cancel()
+                return
+            if waiting.cancelled.get(source) == state:
+                self.stats.record_repeat()
+                return
+            waiting.cancelled.pop(source, None)
+        entries.append((source, state, msg, now, priority))
+        return
+
+    def _window_over(self, number):
+        with self._lock:
+            waiting = self._waiting.pop(number, None)
+        if waiting is not None:
+            self._send_waiting(number, waiting)
+        return
+
+    def _send_waiting(self, number, waiting):
+        if not waiting.entries:
+            l.info("Nothing left to send {}, events cancelled out".format(number))
+            return
+        now = time.time()
+        msg = digest([entry[2] for entry in waiting.entries])
+        self.stats.record_message([now - entry[3] for entry in waiting.entries])
+        if len(waiting.entries) > 1:
+            l.info("Sending {} {} events as one message".format(number,
+                    len(waiting.entries)))
+        priorities = [entry[4] for entry in waiting.entries if entry[4] is not None]
+        self._send_now(msg, [number, ], min(priorities) if priorities else None)
+        return
+
+    def flush(self):
+        """ Send everything waiting now, e.g. before shutting down """
+        with self._lock:
+            all_waiting = self._waiting
+            self._waiting = {}
+        for number, waiting in sorted(all_waiting.items()):
+            waiting.timer.cancel()
+            self._send_waiting(number, waiting)
+        return
+
+
+if __name__ == "__main__":
+    # A door opened and closed, a button press with its confirmation and a
+    # second door, what each recipient gets and what it saved
+    from event import Event
+
+    OPENED, CLOSED = 0, 1
+    URL = "https://example.com/web/"
+    OPEN_E = Event("Open Event")
+    CLOSE_E = Event("Close Event")
+    BUTTON_OPEN_E = Event("Button Open Event")
+
+    def opened(name):
+        return OPEN_E.localize("{}'s door was opened. {}".format(name, URL))
+
+    sent = []
+    c = SMS_Coalescer(window=0.3,
+            send=lambda msg, numbers, priority: sent.append((numbers, msg)))
+    a, b = "15550000001", "15550000002"
+    c.add("Ivan", opened("Ivan"), [a, b], OPENED)
+    c.add("Ivan", CLOSE_E.localize("Ivan's door was closed. {}".format(URL)), [a, b], CLOSED)
+    c.add("Heather", opened("Heather"), [a], OPENED)
+    c.add("Heather", BUTTON_OPEN_E.localize(
+            "Confirming Heather's door opened. {}".format(URL)), [a], OPENED)
+    c.add("Ivan", opened("Ivan"), [b], OPENED)
+    c.add("Heather", opened("Heather"), [b], OPENED)
+    time.sleep(0.5)
+    for numbers, msg in sent:
+        print("{}: {}".format(", ".join(numbers), msg))
+    print(c.stats)
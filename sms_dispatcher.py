@@ -0,0 +1,764 @@
+'''
+    Outbound SMS dispatcher. Holds a single plivo client for the life of the
+    process and sends each recipient's message on a small pool of worker
+    threads, so the caller (door callback, timer, etc) never waits on the
+    network. The client's requests go through one requests.Session, so each
+    worker keeps its connection to plivo open rather than connecting (and
+    doing a TLS handshake) per message.
+
+    Messages go through an outbox:
+
+      - every recipient's message is a row in the store's outbox table
+        (queued, sending, sent or failed), so a message waiting for plivo
+        or the network to come back survives a restart (see recover())
+      - each message has a priority class, ERROR > CONFIRM > STATE > NAG.
+        A message is only handed to a worker once one is free, and always
+        the most urgent one that may go, so an error never waits behind a
+        burst of nags
+      - token buckets limit the rate overall (what reaches plivo is smooth,
+        about what a long code number may send) and per number (a phone
+        isn't flooded). Errors only wait for the overall one
+      - a failed send (no connection, plivo 5xx / 429) is retried with
+        exponential backoff until it's GIVE_UP_AFTER secs old, one plivo
+        turns away (4xx, e.g. a bad number) fails straight away
+'''
+from Queue import Queue
+import threading
+import logging
+import random
+import json
+import time
+import uuid
+import os
+import const
+import metrics
+import garage_shared as GS
+from scheduler import monotonic
+
+# Number of sends that can be in flight at once
+WORKER_COUNT = 4
+# Max number of recipient messages waiting in the outbox, past that new
+# ones (other than errors) are dropped
+MAX_PENDING = 1000
+# Plivo API base url, None for plivo's default (benchmarks point this at a
+# local fake gateway)
+PLIVO_URL = None
+# Secs to wait for plivo to connect or answer before the send is retried
+REQUEST_TIMEOUT = 30
+
+# Priority classes, most urgent first
+ERROR = 0
+CONFIRM = 1
+STATE = 2
+NAG = 3
+PRIORITY_NAMES = {ERROR: "error", CONFIRM: "confirm", STATE: "state", NAG: "nag"}
+
+# Messages per sec to plivo and how many can go at once after a quiet spell
+RATE = 1.0
+BURST = 5
+# Messages per sec to one number, and its burst
+NUMBER_RATE = 0.2
+NUMBER_BURST = 3
+# Secs before the first retry, doubled each time up to RETRY_MAX
+RETRY_BASE = 5.0
+RETRY_MAX = 300.0
+# Secs after which a message that still hasn't gone out is failed
+GIVE_UP_AFTER = 6 * 3600
+# Secs sent and failed rows are kept in the outbox, and between clean ups
+OUTBOX_RETENTION = 7 * 24 * 3600
+EXPIRE_INTERVAL = 3600
+# Changes every boot, so a pid from before a reboot can't pass for a live one
+BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+
+# Outbox row states
+QUEUED = "queued"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+l = logging.getLogger(__name__)
+
+_SEND_SECONDS = metrics.histogram("garage_sms_send_seconds",
+        "Secs a plivo send takes, per recipient attempt")
+_SENDS = metrics.counter("garage_sms_sends_total",
+        "Plivo send attempts, result sent, retry or failed", ["result"])
+_MESSAGE_SECONDS = metrics.histogram("garage_sms_message_seconds",
+        "Secs from send_message until every recipient was sent or failed")
+_QUEUE_WAIT_SECONDS = metrics.histogram("garage_sms_queue_wait_seconds",
+        "Secs a recipient's message waits in the outbox for its turn")
+_DROPPED = metrics.counter("garage_sms_dropped_total",
+        "Messages dropped because the outbox was full")
+
+
+class Send_Handle(object):
+    """
+        Returned by SMS_Dispatcher.send. Lets the caller check on or wait for
+        the result of a send without blocking when it doesn't care.
+    """
+
+    def __init__(self, msg, number_list):
+        self.msg = msg
+        self.number_list = list(number_list)
+        self.responses = {}
+        self.errors = {}
+        self.submitted = time.time()
+        self.completed = None
+        self._remaining = len(self.number_list)
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        if self._remaining == 0:
+            self.completed = self.submitted
+            self._done.set()
+        return
+
+    def _finish_one(self, number, response=None, error=None):
+        """ Called by a worker when the send to one number is complete """
+        with self._lock:
+            if error is None:
+                self.responses[number] = response
+            else:
+                self.errors[number] = error
+            self._remaining -= 1
+            last = self._remaining == 0
+            if last:
+                self.completed = time.time()
+        if last:
+            self._done.set()
+        return last
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ Block until all recipients are sent, returns True if done """
+        self._done.wait(timeout)
+        return self.done()
+
+    @property
+    def ok(self):
+        return self.done() and not self.errors
+
+    @property
+    def latency(self):
+        """ Secs from submit until the last recipient was sent (None if not done) """
+        if self.completed is None:
+            return None
+        return self.completed - self.submitted
+
+
+class Send_Stats(object):
+    """ Latency and throughput counters for the dispatcher """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.messages = 0
+        self.recipients = 0
+        self.failures = 0
+        self.retries = 0
+        self.dropped = 0
+        self.send_latency_total = 0.0  # per recipient round trip
+        self.send_latency_max = 0.0
+        self.msg_latency_total = 0.0  # submit until all recipients sent
+        self.msg_latency_max = 0.0
+        self.wait_total = 0.0  # per recipient, queued until handed to a worker
+        self.wait_max = 0.0
+        self.waits = 0
+        return
+
+    def record_send(self, latency, failed=False):
+        _SEND_SECONDS.observe(latency)
+        with self._lock:
+            self.recipients += 1
+            if failed:
+                self.failures += 1
+            self.send_latency_total += latency
+            self.send_latency_max = max(self.send_latency_max, latency)
+        return
+
+    def record_wait(self, wait):
+        _QUEUE_WAIT_SECONDS.observe(wait)
+        with self._lock:
+            self.waits += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        return
+
+    def record_retry(self):
+        _SENDS.labels("retry").inc()
+        with self._lock:
+            self.retries += 1
+        return
+
+    def record_message(self, latency):
+        _MESSAGE_SECONDS.observe(latency)
+        with self._lock:
+            self.messages += 1
+            self.msg_latency_total += latency
+            self.msg_latency_max = max(self.msg_latency_max, latency)
+        return
+
+    def record_drop(self):
+        _DROPPED.inc()
+        with self._lock:
+            self.dropped += 1
+        return
+
+    def summary(self):
+        """ Return a dict snapshot of the counters """
+        with self._lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            return {
+                "messages": self.messages,
+                "recipients": self.recipients,
+                "failures": self.failures,
+                "retries": self.retries,
+                "dropped": self.dropped,
+                "avg_send_latency": self.send_latency_total / max(self.recipients, 1),
+                "max_send_latency": self.send_latency_max,
+                "avg_msg_latency": self.msg_latency_total / max(self.messages, 1),
+                "max_msg_latency": self.msg_latency_max,
+                "avg_queue_wait": self.wait_total / max(self.waits, 1),
+                "max_queue_wait": self.wait_max,
+                "sends_per_sec": self.recipients / elapsed,
+            }
+
+    def __str__(self):
+        return ", ".join("{}: {}".format(k, v) for k, v in sorted(self.summary().items()))
+
+
+class Token_Bucket(object):
+    """ rate tokens a sec, holding at most burst. rate None is no limit """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = monotonic()
+        return
+
+    def _fill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return
+
+    def wait_time(self, now):
+        """ Secs until a token is there, 0 if one is now """
+        if self.rate is None:
+            return 0.0
+        self._fill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        if self.rate is not None:
+            self._fill(now)
+            self.tokens -= 1
+        return
+
+    def full(self, now):
+        """ True if it's back to a full burst, i.e. nothing to remember """
+        if self.rate is None:
+            return True
+        self._fill(now)
+        return self.tokens >= self.burst
+
+
+class _Outgoing(object):
+    """ One recipient's message in the outbox """
+
+    __slots__ = ('id', 'handle', 'number', 'priority', 'seq', 'created',
+            'queued', 'attempts', 'due')
+
+    def __init__(self, id, handle, number, priority, seq, created, attempts=0, due=0.0):
+        self.id = id
+        self.handle = handle
+        self.number = number
+        self.priority = priority
+        self.seq = seq
+        self.created = created  # wall clock, for giving up
+        self.queued = monotonic()
+        self.attempts = attempts
+        self.due = due  # monotonic time it may be sent
+        return
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+def _plivo_client(auth_id, auth_token, connections):
+    """ plivo.RestAPI sending through a session that keeps connections open """
+    import plivo
+    import requests
+    if PLIVO_URL is None:
+        client = plivo.RestAPI(auth_id, auth_token)
+    else:
+        client = plivo.RestAPI(auth_id, auth_token, url=PLIVO_URL)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    client._request = _Session_Request(client, session)
+    return client
+
+
+class _Session_Request(object):
+    """
+        Stands in for plivo.RestAPI._request, which calls requests.post and
+        friends, i.e. a new connection per request. Does the same through
+        session, whose connection pool is kept between requests.
+    """
+
+    def __init__(self, client, session):
+        self._client = client
+        self._session = session
+        return
+
+    def __call__(self, method, path, data={}):
+        client = self._client
+        headers = dict(client.headers)
+        if method in ('POST', 'PUT'):
+            headers['content-type'] = 'application/json'
+            kwargs = {"data": json.dumps(data)}
+        else:
+            kwargs = {"params": data}
+        r = self._session.request(method, client._api + path.rstrip('/') + '/',
+                headers=headers, auth=(client.auth_id, client.auth_token),
+                timeout=REQUEST_TIMEOUT, **kwargs)
+        content = r.content
+        response = content
+        if content:
+            try:
+                response = json.loads(content.decode("utf-8"))
+            except ValueError:
+                pass
+        return (r.status_code, response)
+
+
+class SMS_Dispatcher(object):
+    """
+        Long lived sender. One plivo client is created and reused, the
+        outbox is drained by one pump thread handing the next message to a
+        fixed pool of worker threads. durable False keeps the outbox in
+        memory only. rate / number_rate None turn that limit off.
+    """
+
+    def __init__(self, workers=WORKER_COUNT, max_pending=MAX_PENDING, client=None,
+            durable=True, rate=RATE, burst=BURST, number_rate=NUMBER_RATE,
+            number_burst=NUMBER_BURST):
+        self._worker_count = workers
+        self._max_pending = max_pending
+        self._client = client
+        self._own_client = client is None
+        self._durable = durable
+        self._rate = (rate, burst)
+        self._number_rate = (number_rate, number_burst)
+        self._workers = []
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._owner = None
+        self._cond = threading.Condition()
+        self._reset()
+        self._next_expire = 0
+        self.stats = Send_Stats()
+        metrics.gauge("garage_sms_outbox_pending", "Messages in the outbox waiting to go",
+                fn=self.pending)
+        return
+
+    def _reset(self):
+        """ Empty outbox, buckets and task queue (new process) """
+        if self._own_client:
+            # A connection pool can't be shared with the parent either
+            self._client = None
+        self._ready = []  # _Outgoing that may go now, once tokens allow
+        self._retrying = []  # _Outgoing waiting for their due time
+        self._seq = 0
+        self._bucket = Token_Bucket(*self._rate)
+        self._number_buckets = {}
+        self._tasks = Queue()
+        self._idle = threading.Semaphore(self._worker_count)
+        return
+
+    @property
+    def client(self):
+        """ The shared plivo client, built on first use """
+        if self._client is None:
+            # plivo (and requests) are only loaded once we have something
+            # to send
+            self._client = _plivo_client(const.auth_id, const.auth_token,
+                    self._worker_count)
+        return self._client
+
+    def _start(self):
+        """
+            Start the pump and worker pool. Threads don't survive a fork, so
+            if we are now in a child process, start fresh ones. Messages the
+            parent queued are the parent's to send.
+        """
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._owner = _run_token(self._pid)
+            with self._cond:
+                self._reset()
+            self._workers = []
+            for i in range(self._worker_count):
+                t = threading.Thread(target=self._work,
+                        name="SMS_Dispatcher-{}".format(i))
+                t.daemon = True
+                t.start()
+                self._workers.append(t)
+            t = threading.Thread(target=self._pump, name="SMS_Dispatcher pump")
+            t.daemon = True
+            t.start()
+        return
+
+    def _write(self, sql, args):
+        if self._durable:
+            GS.get_store().execute(sql, args)
+        return
+
+    def _set_state(self, item, state, error=None):
+        done = time.time() if state in (SENT, FAILED) else None
+        self._write("UPDATE outbox SET state = ?, attempts = ?, next_try = ?, done = ?, "
+                "error = ? WHERE id = ?", (state, item.attempts,
+                time.time() + max(item.due - monotonic(), 0), done,
+                None if error is None else str(error), item.id))
+        return
+
+    def send(self, msg, number_list, priority=None):
+        """
+            Queue msg for every number in number_list and return right away,
+            priority is one of the classes above (CONFIRM if None). Returns a
+            Send_Handle that can be waited on.
+        """
+        if self._pid != os.getpid():
+            self._start()
+        if priority is None:
+            priority = CONFIRM
+        handle = Send_Handle(msg, number_list)
+        now = time.time()
+        with self._cond:
+            items = []
+            for n in handle.number_list:
+                items.append(_Outgoing(uuid.uuid4().hex, handle, n, priority, self._seq, now))
+                self._seq += 1
+        # The rows go in before a worker can update them
+        for item in items:
+            self._write("INSERT INTO outbox (id, number, msg, priority, state, attempts, "
+                    "created, next_try, owner) VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?)",
+                    (item.id, item.number, msg, priority, QUEUED, now, now, self._owner))
+        dropped = []
+        with self._cond:
+            for item in items:
+                if (priority != ERROR and
+                        len(self._ready) + len(self._retrying) >= self._max_pending):
+                    dropped.append(item)
+                else:
+                    self._ready.append(item)
+            self._cond.notify()
+        for item in dropped:
+            l.error("SMS outbox full, dropping message to {}".format(item.number))
+            self.stats.record_drop()
+            self._set_state(item, FAILED, "outbox full")
+            self._complete(item, error="outbox full")
+        self._maybe_expire(now)
+        return handle
+
+    def recover(self):
+        """
+            Queue what a process that has gone (e.g. before a restart) left in
+            the outbox. Call once at start up in the main process, before
+            anything else could be sending those rows.
+        """
+        if not self._durable:
+            return 0
+        if self._pid != os.getpid():
+            self._start()
+        rows = GS.get_store().query("SELECT id, number, msg, priority, attempts, created, "
+                "next_try, owner FROM outbox WHERE state IN (?, ?) ORDER BY created",
+                (QUEUED, SENDING))
+        now = time.time()
+        recovered = 0
+        with self._cond:
+            for id, number, msg, priority, attempts, created, next_try, owner in rows:
+                if owner == self._owner or _alive(owner):
+                    continue
+                item = _Outgoing(id, Send_Handle(msg, [number]), number, priority,
+                        self._seq, created, attempts, monotonic() + max(next_try - now, 0))
+                self._seq += 1
+                self._retrying.append(item)
+                recovered += 1
+                self._write("UPDATE outbox SET state = ?, owner = ? WHERE id = ?",
+                        (QUEUED, self._owner, id))
+            self._cond.notify()
+        if recovered:
+            l.info("Recovered {} messages from the outbox".format(recovered))
+        return recovered
+
+    def _maybe_expire(self, now):
+        if not self._durable or now < self._next_expire:
+            return
+        self._next_expire = now + EXPIRE_INTERVAL
+        self._write("DELETE FROM outbox WHERE state IN (?, ?) AND created < ?",
+                (SENT, FAILED, now - OUTBOX_RETENTION))
+        # Anything still waiting this long has no process left to send it,
+        # recover() wasn't run for it. Fail it so it ages out like the rest
+        self._write("UPDATE outbox SET state = ?, done = ?, error = ? "
+                "WHERE state IN (?, ?) AND created < ?",
+                (FAILED, now, "abandoned", QUEUED, SENDING,
+                now - GIVE_UP_AFTER - EXPIRE_INTERVAL))
+        return
+
+    def _next(self):
+        """ Block until a message may go, take it out of the outbox """
+        with self._cond:
+            while True:
+                now = monotonic()
+                wait = None
+                for item in list(self._retrying):
+                    if item.due <= now:
+                        self._retrying.remove(item)
+                        self._ready.append(item)
+                    elif wait is None or item.due - now < wait:
+                        wait = item.due - now
+                if self._ready:
+                    overall = self._bucket.wait_time(now)
+                    if overall > 0:
+                        wait = overall if wait is None else min(wait, overall)
+                    else:
+                        for item in sorted(self._ready):
+                            bucket = self._number_bucket(item.number)
+                            number_wait = bucket.wait_time(now)
+                            if number_wait == 0 or item.priority == ERROR:
+                                self._ready.remove(item)
+                                self._bucket.take(now)
+                                bucket.take(now)
+                                return item
+                            wait = number_wait if wait is None else min(wait, number_wait)
+                self._prune_buckets(now)
+                self._cond.wait(wait)
+        return
+
+    def _number_bucket(self, number):
+        bucket = self._number_buckets.get(number)
+        if bucket is None:
+            bucket = self._number_buckets[number] = Token_Bucket(*self._number_rate)
+        return bucket
+
+    def _prune_buckets(self, now):
+        """ Forget full buckets, call with _cond held """
+        for number, bucket in self._number_buckets.items():
+            if bucket.full(now):
+                del self._number_buckets[number]
+        return
+
+    def _pump(self):
+        """ Hand the most urgent message that may go to the next free worker """
+        while True:
+            self._idle.acquire()
+            item = self._next()
+            self.stats.record_wait(monotonic() - item.queued)
+            self._tasks.put(item)
+        return
+
+    def _work(self):
+        """ Worker loop - send to one recipient at a time """
+        while True:
+            item = self._tasks.get()
+            try:
+                self._send_one(item)
+            finally:
+                self._idle.release()
+        return
+
+    def _send_one(self, item):
+        # All numbers must be prefixed by a +
+        params = {'src': const.number,
+                  'dst': "+" + item.number,
+                  'text': item.handle.msg,
+                  'type': 'sms', }
+        item.attempts += 1
+        self._set_state(item, SENDING)
+        start = time.time()
+        try:
+            response = self.client.send_message(params)
+        except Exception as e:
+            self.stats.record_send(time.time() - start, failed=True)
+            l.error("Error sending message to {}: {}".format(item.number, e))
+            self._failed(item, e, retry=True)
+            return
+        status = response[0] if isinstance(response, tuple) else None
+        if status is not None and (status >= 500 or status == 429):
+            self.stats.record_send(time.time() - start, failed=True)
+            l.error("Plivo couldn't take message to {}: {}".format(item.number, response))
+            self._failed(item, response, retry=True)
+            return
+        if status is not None and status >= 400:
+            self.stats.record_send(time.time() - start, failed=True)
+            l.error("Plivo turned away message to {}: {}".format(item.number, response))
+            self._failed(item, response, retry=False)
+            return
+        self.stats.record_send(time.time() - start)
+        _SENDS.labels(SENT).inc()
+        l.debug(str(response))
+        self._set_state(item, SENT)
+        self._complete(item, response=response)
+        return
+
+    def _failed(self, item, error, retry):
+        """ Retry item later with backoff, or give up on it """
+        if retry and time.time() - item.created < GIVE_UP_AFTER:
+            backoff = min(RETRY_MAX, RETRY_BASE * 2 ** (item.attempts - 1))
+            item.due = monotonic() + backoff * random.uniform(0.5, 1.0)
+            item.queued = monotonic()
+            self.stats.record_retry()
+            self._set_state(item, QUEUED, error)
+            with self._cond:
+                self._retrying.append(item)
+                self._cond.notify()
+            return
+        _SENDS.labels(FAILED).inc()
+        self._set_state(item, FAILED, error)
+        self._complete(item, error=error)
+        return
+
+    def _complete(self, item, response=None, error=None):
+        if item.handle._finish_one(item.number, response, error):
+            self.stats.record_message(item.handle.latency)
+        return
+
+    def pending(self):
+        """ Number of messages in the outbox waiting to go """
+        with self._cond:
+            return len(self._ready) + len(self._retrying)
+
+
+def _run_token(pid):
+    """
+        Name process pid by boot id, pid and start time, which no other
+        process will share, even after a reboot hands its pid out again.
+        Just the pid where there is no /proc.
+    """
+    try:
+        with open(BOOT_ID_FILE) as f:
+            boot_id = f.read().strip()
+        with open("/proc/{}/stat".format(pid)) as f:
+            # The command name can hold spaces, start time is the 22nd field
+            started = f.read().rpartition(")")[2].split()[19]
+    except (IOError, IndexError):
+        return str(pid)
+    return "{}:{}:{}".format(boot_id, pid, started)
+
+
+def _alive(owner):
+    """ True if the process a _run_token names is still running """
+    if not owner:
+        return False
+    if ":" in owner:
+        # Gone, or its pid now belongs to something else, if the token differs
+        return _run_token(int(owner.split(":")[1])) == owner
+    try:
+        os.kill(int(owner), 0)
+    except OSError as e:
+        return e.errno == 1  # EPERM, someone else's
+    return True
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+
+    class _Slow_Client(object):
+        """ Stand in for plivo that takes a fixed time per request """
+        def __init__(self):
+            self.sent = []
+            self.down = 0
+        def send_message(self, params):
+            time.sleep(0.2)
+            if self.down:
+                self.down -= 1
+                return (503, {"error": "down"})
+            self.sent.append(params['text'])
+            return (202, {"message_uuid": [params['dst']]})
+
+    RETRY_BASE = 0.2
+    client = _Slow_Client()
+    d = SMS_Dispatcher(client=client, durable=False, rate=5.0, burst=1, number_rate=None)
+    h = d.send("hello", ["15551230001", "15551230002", "15551230003"])
+    h.wait()
+    print("3 recipients sent in {:.3f} secs".format(h.latency))
+
+    # A burst of nags then an error, the error goes out ahead of the nags
+    # still waiting for the rate limit. Then plivo is down for a couple of
+    # tries.
+    for i in range(5):
+        d.send("nag {}".format(i), ["15551230001"], NAG)
+    h = d.send("error", ["15551230002"], ERROR)
+    h.wait()
+    client.down = 2
+    h = d.send("retried", ["15551230003"], CONFIRM)
+    h.wait()
+    time.sleep(1.5)
+    print("Sent in order: {}".format(", ".join(client.sent[3:])))
+    print(d.stats)
+
+    # plivo's own client (a connection per request) against the session,
+    # then the dispatcher with its default workers, on a local keep-alive
+    # server standing in for plivo
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    import plivo
+
+    class _Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        connections = 0
+
+    class _Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        wbufsize = -1  # reply in one write, see ingress.py
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            self.server.connections += 1
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.getheader("content-length", 0)))
+            reply = json.dumps({"message_uuid": [str(uuid.uuid4())]})
+            self.send_response(202)
+            self.send_header("Content-Length", str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def log_message(self, format, *args):
+            return
+
+    server = _Server(("127.0.0.1", 0), _Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    PLIVO_URL = "http://127.0.0.1:{}".format(server.server_address[1])
+    n = 200
+    params = {'src': "15550000000", 'dst': "+15551230001", 'text': "hi", 'type': 'sms'}
+    session_client = _plivo_client("id", "token", WORKER_COUNT)
+    for name, c in (("requests.post", plivo.RestAPI("id", "token", url=PLIVO_URL)),
+            ("session", session_client)):
+        server.connections = 0
+        start = time.time()
+        for i in range(n):
+            c.send_message(params)
+        print("{:14s} {:.2f} ms per message, {} connections".format(name,
+                (time.time() - start) * 1000 / n, server.connections))
+    server.connections = 0
+    d = SMS_Dispatcher(durable=False, rate=None, number_rate=None)
+    start = time.time()
+    h = d.send("hello", ["1555123{:04d}".format(i) for i in range(n)])
+    h.wait()
+    print("{} workers     {:.2f} ms per message, {} connections, ok {}".format(
+            WORKER_COUNT, (time.time() - start) * 1000 / n, server.connections, h.ok))
+    # Hang up, so the server's threads aren't left waiting as we exit
+    for c in (session_client, d.client):
+        c._request._session.close()
+    time.sleep(0.1)
+    server.shutdown()
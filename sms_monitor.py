@@ -1,18 +1,32 @@
-from flask import Flask, request, redirect
 import multiprocessing as MP
+import threading
 import sys
 import os
 import garage_shared as GS
-import plivo
-import base64
-import hmac
-import hashlib
-import shelve
-import datetime
 import const
 import logging
+import history
+import ingress
+import lux_series
+import sms_dispatcher
+import metrics
+import runtime
+import import_profile
+from replay_cache import Replay_Cache
+from webhook_pipeline import Webhook_Pipeline, Signature_Validator
 
 LOG_DIR="/home/garage/garagePi/logs/"
+# This is the uri used by plivo. The port translation is from 
+# the gateway. The ddns is by ddns.net
+#WEBHOOK_URI = "https://ifermon.ddns.net:6000/"
+WEBHOOK_URI = "https://67.246.62.98:6000/"
+# Name this process's metrics go by (see metrics.gather)
+METRICS_PROCESS = "sms"
+# Addresses the routes for us (not plivo) answer, the rest get a 403
+LOCAL_ADDRS = ("127.0.0.1", "::1")
+
+_REQUEST_SECONDS = metrics.histogram("garage_webhook_request_seconds",
+        "Secs the web server takes to handle a plivo webhook")
     
 ###############################################################################
 """
@@ -22,7 +36,12 @@ LOG_DIR="/home/garage/garagePi/logs/"
 """
 class SMS_Monitor(MP.Process):
 
-    def __init__(self, queue, debug=False):
+    def __init__(self, queue, debug=False, port=ingress.PORT):
+        """
+            queue: messages for the main process go here
+            port: port the web server listens on, the ready event is set
+              once it is listening
+        """
 
         self.l = logging.getLogger(__name__)
         self.l.info("Configuring SMS logger")
@@ -30,19 +49,22 @@ class SMS_Monitor(MP.Process):
         super(SMS_Monitor, self).__init__(name="SMS_Monitor")
         self.queue = queue
         self.debug = debug
+        self.port = port
+        self.ready = MP.Event()
 
         return
 
     """
-      This is a function that calcualtes the hash key for the plivo message
-      Essentially it ensures that the message is from plivo
+      Called by the webhook pipeline when a message fails validation
     """
-    def validate_signature (self, uri, post_params, signature, auth_token):
-        for k, v in sorted(post_params.items()):
-            uri += k + v
-        s = base64.encodestring(hmac.new(auth_token, uri, 
-                hashlib.sha1).digest()).strip()
-        return s == signature
+    def invalid_message(self, reason):
+        # This is very bad. It may mean that someone is trying to hack
+        # the system. Shut it down.
+        self.l.error("{}. Possible hack. Shutting down".format(reason))
+        GS.send_message("Shutting down system. Possible hack.",
+                priority=sms_dispatcher.ERROR)
+        self.queue.put(runtime.stamp({"Msg:": "Shutting down"}))
+        return
 
 
     #--------------------------------------------------------------------------
@@ -61,6 +83,11 @@ class SMS_Monitor(MP.Process):
                 MP.current_process().name, os.getppid(), 
                 os.getpid()))
 
+        # Only this process serves http, so only it loads Flask
+        profiled = len(import_profile.entries())
+        from flask import Flask, request
+        if import_profile.enabled():
+            l.info(import_profile.report(title="SMS_Monitor imports", start=profiled))
         app = Flask(__name__)
         l.debug("Just created a Flask")
 
@@ -70,60 +97,26 @@ class SMS_Monitor(MP.Process):
         """
         @app.route("/", methods=['GET', 'POST'])
         def get_message():
-            try:
-                # This is the uri used by plivo. The port translation is from 
-                # the gateway. The ddns is by ddns.net
-                #uri = "https://ifermon.ddns.net:6000/"
-                uri = "https://67.246.62.98:6000/"
-                self.l.info("Got message on {0}\nmsg: \"{1}\"".format(uri, 
-                        request.values))
-
-                # Validate the message
-                self.l.debug("Checking plivo signature exists")
-                if not request.headers.has_key('X-Plivo-Signature'):
-                    # This is very bad. It may mean that someone is trying to hack
-                    # the system. Shut it down.
-                    self.l.error("No plivo sig. Possible hack. Shutting down")
-                    GS.send_message("Shutting down system. Possible hack.")
-                    self.queue.put({"Msg:": "Shutting down"})
-                    self.terminate()
-
-                signature = request.headers['X-Plivo-Signature']
-                self.l.debug("Checking signature hash is valid")
-                if not self.validate_signature(uri, request.form, signature, 
-                        const.auth_token):
-                    # This is very bad. It may mean that someone is trying to hack
-                    # the system. Shut it down.
-                    self.l.error("Invalid hash. Possible hack. Shutting down")
-                    GS.send_message("Shutting down system. Possible hack.")
-                    self.queue.put({"Msg:": "Shutting down"})
-                    self.terminate()
-
-                # Signature is validated, now make sure it's not a duplicate
-                # message
-                self.l.debug("Checking the message is not a duplicate")
-                uuid = str(request.form['MessageUUID'])
-                if uuid_store.has_key(uuid):
-                    # This is very bad. It may mean that someone is trying to hack
-                    # the system. Shut it down.
-                    self.l.info("Duplicate msg. Possible hack. Shutting down")
-                    GS.send_message("Shutting down system. Possible hack.")
-                    self.queue.put({"Msg:": "Shutting down"})
-                    self.terminate()
-
-                # Add the uuid to the message store
-                self.l.debug("Adding to msg id list")
-                d = dict(request.form).update({'Datestamp':datetime.datetime.now()})
-                uuid_store[uuid] = d
-
-                self.l.debug("Putting message into queue")
-                self.queue.put_nowait(request.values)
-                self.l.info("Put msg into queue")
-            except Exception as e:
-                self.l.error("Some kind of error")
-                self.l.error(e)
+            # Just take a copy, validation (and logging) is done by the
+            # pipeline so nothing here waits on the disk or network
+            with _REQUEST_SECONDS.time():
+                pipeline.capture(request.form.to_dict(), request.values.to_dict(),
+                        request.headers.get('X-Plivo-Signature'))
             return "Received"
 
+        @app.route("/pipeline_stats", methods=['GET', ])
+        def pipeline_stats():
+            return pipeline.summary() + "\n"
+
+        """
+            Metrics in the Prometheus text format, this process's and the
+            ones the main process last published
+        """
+        @app.route("/metrics", methods=['GET', ])
+        def prometheus_metrics():
+            return (metrics.render(metrics.gather(METRICS_PROCESS)), 200,
+                    {"Content-Type": metrics.CONTENT_TYPE})
+
         '''
             The irony with all the security in the above function is this
             wide open security hole. At least it texts me when used.
@@ -147,6 +140,64 @@ class SMS_Monitor(MP.Process):
                 GS.send_message(msg)
             return "Received"
 
+        """
+            Door history, read from the store the main process writes. Only
+            answered on this machine (LOCAL_ADDRS), plivo has no business
+            here. A door with no history gets no lines.
+            Optional args: since (day/today/3d/12h), type (open/close), count
+        """
+        hist_readers = {}
+        # Requests are served on several threads, a reader isn't thread safe
+        hist_lock = threading.Lock()
+        @app.route("/hist/<door_name>", methods=['GET', ])
+        def door_history(door_name):
+            if request.remote_addr not in LOCAL_ADDRS:
+                self.l.info("History request from {} refused".format(request.remote_addr))
+                return "Forbidden", 403
+            since = None
+            if 'since' in request.args:
+                since = history.parse_since(request.args['since'])
+                if since is None:
+                    return "Invalid since", 400
+            event_type = history.EVENT_TYPES.get(request.args.get('type'))
+            count = request.args.get('count', type=int)
+            if count is None and since is None:
+                count = history.RING_SIZE
+
+            with hist_lock:
+                hist = hist_readers.get(door_name)
+                if hist is None:
+                    hist = history.Door_History(GS.get_store(), door_name, read_only=True)
+                    hist_readers[door_name] = hist
+                else:
+                    hist.refresh()
+                rows = hist.query(count, since=since, event_type=event_type)
+            return "".join(history.format_record(t, e) + "\n" for t, e in rows)
+
+        """
+            Light readings from the light monitor's series file.
+            Optional args: since (day/today/3d/12h, default 1h),
+            res (0 for raw or bucket secs)
+            Returns csv: time, min, max, mean, count
+        """
+        @app.route("/light", methods=['GET', ])
+        def light_series():
+            since = history.parse_since(request.args.get('since', '1h'))
+            if since is None:
+                return "Invalid since", 400
+            try:
+                series = lux_series.Lux_Series(
+                        const.DOOR_DATA_DIR + lux_series.SPILL_FILE, read_only=True)
+            except IOError:
+                return "No light readings", 404
+            try:
+                rows = series.query(since, resolution=request.args.get('res', type=int))
+            except ValueError:
+                return "Invalid res", 400
+            finally:
+                series.close()
+            return "".join("{:.0f},{:.1f},{:.1f},{:.1f},{}\n".format(*r) for r in rows)
+
         @app.route("/reg_phone", methods=['GET', ])
         def register_phone_ip():
             self.l.info("In register phone")
@@ -154,8 +205,11 @@ class SMS_Monitor(MP.Process):
             return "Received"
 
         # Very bad style hard-coding this. Some day I'll fix it
-        uuid_store = shelve.open("{0}{1}".format(LOG_DIR, "uuid_store"))
-        app.run(host='0.0.0.0', debug=False, ssl_context='adhoc')
+        uuid_store = Replay_Cache(GS.get_store())
+        uuid_store.migrate_shelve("{0}{1}".format(LOG_DIR, "uuid_store"))
+        pipeline = Webhook_Pipeline(Signature_Validator(WEBHOOK_URI, const.auth_token),
+                uuid_store, self.queue, self.invalid_message)
+        ingress.serve(app, port=self.port, ready=self.ready.set)
         return
 
 
@@ -0,0 +1,138 @@
+'''
+    Cached sunrise / sunset schedule. The ephem calculations are done once
+    for a window of days and kept as sorted lists of epoch times, after that
+    is_dark / next sunrise / next sunset are just a bisect.
+'''
+from bisect import bisect_right
+from dateutil import tz
+import datetime as dt
+import calendar
+import threading
+import time
+import ephem
+
+# Where the garage is. If lat and lon are set they are used instead of city
+OBSERVER_CITY = 'New York'
+OBSERVER_LAT = None  # e.g. '40.71'
+OBSERVER_LON = None  # e.g. '-74.00'
+TZ_NAME = 'America/New_York'
+# Number of days ahead to compute each time the schedule is refreshed
+WINDOW_DAYS = 3
+
+# ephem dates are days since 1899/12/31 12:00 UTC
+_EPHEM_EPOCH_DAYS = 25567.5
+
+
+def _to_epoch(ephem_date):
+    return (float(ephem_date) - _EPHEM_EPOCH_DAYS) * 86400.0
+
+
+def _to_ephem(epoch):
+    return ephem.Date(epoch / 86400.0 + _EPHEM_EPOCH_DAYS)
+
+
+class Solar_Schedule(object):
+    """
+        Sunrise and sunset times for a rolling window of days. The window is
+        recomputed lazily the first time it's used after a local day boundary.
+    """
+
+    def __init__(self, city=OBSERVER_CITY, lat=OBSERVER_LAT, lon=OBSERVER_LON,
+            tz_name=TZ_NAME, window_days=WINDOW_DAYS):
+        self._city = city
+        self._lat = lat
+        self._lon = lon
+        self.tz = tz.gettz(tz_name)
+        self._window_days = window_days
+        self._rises = []
+        self._sets = []
+        self._valid_until = 0.0
+        self._lock = threading.Lock()
+        return
+
+    def _observer(self):
+        if self._lat is not None and self._lon is not None:
+            obs = ephem.Observer()
+            obs.lat = str(self._lat)
+            obs.lon = str(self._lon)
+        else:
+            obs = ephem.city(self._city)
+        return obs
+
+    def _next_midnight(self, t):
+        """ Epoch of the next local midnight after t """
+        now = dt.datetime.fromtimestamp(t, self.tz)
+        midnight = (now + dt.timedelta(days=1)).replace(hour=0, minute=0,
+                second=0, microsecond=0)
+        return calendar.timegm(midnight.utctimetuple())
+
+    def _refresh(self, t):
+        """ Compute the rise / set times from a day before t to window_days after """
+        obs = self._observer()
+        sun = ephem.Sun()
+        start = _to_ephem(t - 86400)
+        end = _to_epoch(start) + (self._window_days + 1) * 86400
+        rises = []
+        sets = []
+        for next_event, times in ((obs.next_rising, rises), (obs.next_setting, sets)):
+            d = start
+            while True:
+                d = next_event(sun, start=d)
+                times.append(_to_epoch(d))
+                if times[-1] > end:
+                    break
+                d = ephem.Date(d + ephem.minute)
+        self._rises = rises
+        self._sets = sets
+        self._valid_until = self._next_midnight(t)
+        return
+
+    def _check(self, t):
+        if t >= self._valid_until:
+            with self._lock:
+                if t >= self._valid_until:
+                    self._refresh(t)
+        return
+
+    def next_rising(self, t=None):
+        """ Epoch time of the first sunrise after t (default now) """
+        if t is None:
+            t = time.time()
+        self._check(t)
+        return self._rises[bisect_right(self._rises, t)]
+
+    def next_setting(self, t=None):
+        """ Epoch time of the first sunset after t (default now) """
+        if t is None:
+            t = time.time()
+        self._check(t)
+        return self._sets[bisect_right(self._sets, t)]
+
+    def is_dark(self, t=None):
+        """ It's dark if the sun rises before it sets again """
+        if t is None:
+            t = time.time()
+        self._check(t)
+        rises = self._rises
+        sets = self._sets
+        return rises[bisect_right(rises, t)] < sets[bisect_right(sets, t)]
+
+
+if __name__ == "__main__":
+    # Microbenchmark: cached schedule vs. building an observer for every call
+    import timeit
+
+    def old_is_dark():
+        r = ephem.city('New York').next_rising(ephem.Sun()).datetime()
+        r = r.replace(tzinfo=tz.gettz('UTC')).astimezone(tz.gettz(TZ_NAME))
+        s = ephem.city('New York').next_setting(ephem.Sun()).datetime()
+        s = s.replace(tzinfo=tz.gettz('UTC')).astimezone(tz.gettz(TZ_NAME))
+        return r < s
+
+    sched = Solar_Schedule()
+    assert sched.is_dark() == old_is_dark()
+    n = 2000
+    old = timeit.timeit(old_is_dark, number=n) / n
+    new = timeit.timeit(sched.is_dark, number=n) / n
+    print("is_dark old: {:.1f} usec/call".format(old * 1e6))
+    print("is_dark new: {:.1f} usec/call ({:.0f}x)".format(new * 1e6, old / new))
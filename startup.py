@@ -0,0 +1,156 @@
+'''
+    Startup orchestrator. Each phase is a function with the names of the
+    phases it depends on. A phase runs (on its own thread) as soon as all of
+    its dependencies are done, so independent phases run at the same time.
+    Waiting for a subsystem to be ready (port listening, first sample
+    taken, ...) is just another phase, there are no fixed sleeps.
+
+    run() returns when every phase is done and raises Startup_Error if one
+    fails or they don't all finish in time. report() gives the per phase
+    timing breakdown.
+'''
+import threading
+import logging
+import time
+
+# Secs for all phases to finish before we give up
+STARTUP_TIMEOUT = 30
+
+l = logging.getLogger(__name__)
+
+
+class Startup_Error(Exception):
+    """ A phase failed or startup took too long """
+    pass
+
+
+class Phase(object):
+    """ One step of startup and when it ran (secs from the start of run) """
+
+    def __init__(self, name, fn, deps):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.result = None
+        self.error = None
+        self.began = None
+        self.ended = None
+        self.done = threading.Event()
+        return
+
+    @property
+    def took(self):
+        if self.began is None or self.ended is None:
+            return None
+        return self.ended - self.began
+
+
+class Startup(object):
+
+    def __init__(self, timeout=STARTUP_TIMEOUT):
+        self._timeout = timeout
+        self._phases = []
+        self._by_name = {}
+        self._start = None
+        self.elapsed = None
+        return
+
+    def add(self, name, fn, deps=()):
+        """ Add a phase, fn() is called once all phases in deps are done """
+        if name in self._by_name:
+            raise ValueError("Duplicate startup phase {}".format(name))
+        for d in deps:
+            if d not in self._by_name:
+                raise ValueError("Startup phase {} depends on unknown phase {}".format(name, d))
+        phase = Phase(name, fn, deps)
+        self._phases.append(phase)
+        self._by_name[name] = phase
+        return phase
+
+    def result(self, name):
+        """ What the phase's function returned """
+        return self._by_name[name].result
+
+    def _run_phase(self, phase):
+        for d in phase.deps:
+            dep = self._by_name[d]
+            dep.done.wait()
+            if dep.error is not None:
+                phase.error = "{} failed".format(d)
+                phase.done.set()
+                return
+        phase.began = time.time() - self._start
+        try:
+            phase.result = phase.fn()
+        except Exception as e:
+            l.exception("Startup phase {} failed".format(phase.name))
+            phase.error = e
+        phase.ended = time.time() - self._start
+        phase.done.set()
+        return
+
+    def run(self):
+        """ Run all the phases, returns the total time taken """
+        self._start = time.time()
+        for phase in self._phases:
+            t = threading.Thread(target=self._run_phase, args=(phase,),
+                    name="Startup-{}".format(phase.name))
+            t.daemon = True
+            t.start()
+        end = self._start + self._timeout
+        for phase in self._phases:
+            phase.done.wait(max(end - time.time(), 0))
+        self.elapsed = time.time() - self._start
+        l.info(self.report())
+        failed = [p.name for p in self._phases if p.error is not None]
+        waiting = [p.name for p in self._phases if not p.done.is_set()]
+        if failed or waiting:
+            raise Startup_Error("Startup failed: {} waiting: {}".format(
+                    ", ".join(failed) or "none", ", ".join(waiting) or "none"))
+        return self.elapsed
+
+    def report(self):
+        """ Per phase timing breakdown """
+        fmt = "  {:<16} {:>8} {:>8}  {}"
+        lines = ["Startup took {:.3f} secs".format(self.elapsed or 0.0),
+                fmt.format("phase", "start", "took", "")]
+        for p in sorted(self._phases, key=lambda p: (p.began is None, p.began)):
+            if p.error is not None:
+                status = "FAILED ({})".format(p.error)
+            elif not p.done.is_set():
+                status = "not done"
+            else:
+                status = ""
+            lines.append(fmt.format(p.name,
+                    "-" if p.began is None else "{:.3f}".format(p.began),
+                    "-" if p.took is None else "{:.3f}".format(p.took), status))
+        return "\n".join(lines)
+
+
+def wait_ready(event, process, timeout=STARTUP_TIMEOUT, poll=0.05):
+    """
+        Wait for a thread or process to set its ready event. Raises
+        Startup_Error if it dies first or takes longer than timeout.
+    """
+    end = time.time() + timeout
+    while not event.wait(poll):
+        if not process.is_alive():
+            raise Startup_Error("{} stopped before it was ready".format(process.name))
+        if time.time() > end:
+            raise Startup_Error("{} not ready after {} secs".format(process.name, timeout))
+    return True
+
+
+if __name__ == "__main__":
+    # Same shape as garage.py startup with made up times, the total should
+    # be the longest chain (0.5 secs) not the sum (1.5)
+    logging.basicConfig(level=logging.INFO)
+    s = Startup()
+    s.add("fork", lambda: time.sleep(0.05))
+    s.add("door a", lambda: time.sleep(0.1), ["fork"])
+    s.add("door b", lambda: time.sleep(0.1), ["fork"])
+    s.add("web ready", lambda: time.sleep(0.45), ["fork"])
+    s.add("light", lambda: time.sleep(0.2), ["fork"])
+    s.add("light ready", lambda: time.sleep(0.1), ["light"])
+    s.add("commands", lambda: time.sleep(0.01), ["door a", "door b"])
+    s.run()
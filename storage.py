@@ -0,0 +1,266 @@
+'''
+    Everything we keep between restarts (door history, subscriptions,
+    seen message uuids, preferences and the SMS outbox) in one SQLite
+    database in WAL mode:
+
+      - a change is a row written, not a whole dict re-pickled
+      - a power cut can lose the last batch of writes, but can't corrupt
+        the file the way it can a dbm file in the middle of a sync
+      - the SMS process can read (e.g. history) while the main process
+        writes
+
+    Writes are batched. execute() queues the write and returns straight
+    away, COMMIT_DELAY secs later the store's commit thread writes the batch
+    (whatever was queued meanwhile) in one transaction. The database is only
+    locked while a batch is written, not while it builds up, so the other
+    process isn't kept waiting. flush() writes the batch now, and query()
+    does that first so it sees every write.
+
+    A connection can't be used across a fork, so each process opens its
+    own Store (see garage_shared.get_store). Data kept in shelve files by
+    older versions is moved in once, see migrated() and open_shelve().
+'''
+import threading
+import logging
+import sqlite3
+import shelve
+import json
+import glob
+import time
+import os
+import locks
+import metrics
+
+STORAGE_FILE = ".garage.sqlite"
+# Secs between the first write of a batch and its commit
+COMMIT_DELAY = 0.05
+# Secs to wait for the other process to finish its commit
+BUSY_TIMEOUT = 5.0
+SCHEMA_VERSION = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS prefs (owner TEXT, key TEXT, value TEXT,
+        PRIMARY KEY (owner, key));
+CREATE TABLE IF NOT EXISTS subscriptions (subscription TEXT, event TEXT, phone TEXT,
+        PRIMARY KEY (subscription, event, phone));
+CREATE TABLE IF NOT EXISTS history (door TEXT, t REAL, event INTEGER);
+CREATE INDEX IF NOT EXISTS history_door_t ON history (door, t);
+CREATE TABLE IF NOT EXISTS replay (uuid TEXT PRIMARY KEY, t REAL);
+CREATE INDEX IF NOT EXISTS replay_t ON replay (t);
+CREATE TABLE IF NOT EXISTS outbox (id TEXT PRIMARY KEY, number TEXT, msg TEXT,
+        priority INTEGER, state TEXT, attempts INTEGER, created REAL, next_try REAL,
+        done REAL, error TEXT, owner TEXT);
+CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, created);
+"""
+
+l = logging.getLogger(__name__)
+
+_COMMIT_SECONDS = metrics.histogram("garage_store_commit_seconds",
+        "Secs writing a batch of changes to the store, in one transaction")
+_COMMIT_WRITES = metrics.counter("garage_store_writes_total",
+        "Changes written to the store")
+
+
+class Store(object):
+    """
+        One connection to the database. Safe to use from any thread of the
+        process that opened it. commit_delay 0 commits every write.
+    """
+
+    def __init__(self, path, commit_delay=COMMIT_DELAY):
+        self.path = path
+        self.pid = os.getpid()
+        self.writes = 0
+        self.commits = 0
+        self._commit_delay = commit_delay
+        # Held while using the connection
+        self._lock = locks.Ordered_Lock("storage:{}".format(path), locks.STORAGE,
+                reentrant=True)
+        # Only guards _pending, so a write never waits for a commit
+        self._pending_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT,
+                isolation_level=None, check_same_thread=False)
+        self._conn.text_factory = str
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        # (sql, args or rows, True for executemany) waiting to be written
+        self._pending = []
+        self._wake = threading.Event()
+        self._closed = False
+        self._committer = None
+        if self.get_meta("schema_version") != str(SCHEMA_VERSION):
+            self.set_meta("schema_version", SCHEMA_VERSION)
+            self.flush()
+        return
+
+    def _batch_started(self):
+        if self._commit_delay <= 0:
+            self.flush()
+            return
+        if self._committer is None:
+            self._committer = threading.Thread(target=self._commit_loop,
+                    name="Store commit")
+            self._committer.daemon = True
+            self._committer.start()
+        self._wake.set()
+        return
+
+    def _commit_loop(self):
+        while not self._closed:
+            self._wake.wait()
+            self._wake.clear()
+            if self._closed:
+                break
+            time.sleep(self._commit_delay)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                l.error("Commit failed: {}".format(e))
+                if self._pending:
+                    # Still queued (the database was busy), try again
+                    self._wake.set()
+        return
+
+    def _queue(self, write):
+        with self._pending_lock:
+            started = not self._pending
+            self._pending.append(write)
+            self.writes += 1
+        if started:
+            self._batch_started()
+        return
+
+    def execute(self, sql, args=()):
+        """ A write, committed with the current batch """
+        self._queue((sql, args, False))
+        return
+
+    def executemany(self, sql, rows):
+        self._queue((sql, rows, True))
+        return
+
+    def query(self, sql, args=()):
+        """ All the rows, after writing anything queued """
+        with self._lock:
+            self.flush()
+            return self._conn.execute(sql, args).fetchall()
+
+    def flush(self):
+        """
+            Write the queued batch in one transaction. If the database is
+            busy the batch stays queued for the next try, any other error
+            drops it.
+        """
+        with self._lock:
+            with self._pending_lock:
+                batch = self._pending
+                self._pending = []
+            if not batch:
+                return
+            start = time.time()
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                for sql, args, many in batch:
+                    if many:
+                        self._conn.executemany(sql, args)
+                    else:
+                        self._conn.execute(sql, args)
+                self._conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                try:
+                    self._conn.execute("ROLLBACK")
+                except sqlite3.Error:
+                    pass  # It never started
+                if isinstance(e, sqlite3.OperationalError):
+                    with self._pending_lock:
+                        self._pending[:0] = batch
+                else:
+                    l.error("Dropped {} writes: {}".format(len(batch), e))
+                raise
+            _COMMIT_SECONDS.observe(time.time() - start)
+            _COMMIT_WRITES.inc(len(batch))
+            self.commits += 1
+        return
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        with self._lock:
+            self.flush()
+            self._conn.close()
+        return
+
+    def get_meta(self, key):
+        rows = self.query("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def set_meta(self, key, value):
+        self.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, str(value)))
+        return
+
+    def prefs(self, owner):
+        """ owner's preferences as a dict """
+        return dict((k, json.loads(v)) for k, v in
+                self.query("SELECT key, value FROM prefs WHERE owner = ?", (owner,)))
+
+    def set_pref(self, owner, key, value):
+        """ value has to be something json can hold """
+        self.execute("INSERT OR REPLACE INTO prefs (owner, key, value) VALUES (?, ?, ?)",
+                (owner, key, json.dumps(value)))
+        return
+
+    def migrated(self, name):
+        """ True if the one time migration called name has been done """
+        return self.get_meta("migrated:{}".format(name)) is not None
+
+    def mark_migrated(self, name):
+        """ Record that the migration called name is done, and commit """
+        self.set_meta("migrated:{}".format(name), 1)
+        self.flush()
+        return
+
+
+def open_shelve(path):
+    """ An old shelve file opened read only, None if there isn't one """
+    # Depending on the dbm module the file name may have a suffix
+    if not glob.glob(path + "*"):
+        return None
+    try:
+        return shelve.open(path, flag='r')
+    except Exception as e:
+        l.error("Can't open old data file {}: {}".format(path, e))
+        return None
+
+
+if __name__ == "__main__":
+    # Persisting a door event: a row in SQLite vs. re-pickling and syncing a
+    # writeback shelve holding a door's history (the old way)
+    import tempfile
+
+    d = tempfile.mkdtemp()
+    store = Store(os.path.join(d, STORAGE_FILE))
+    n = 2000
+    start = time.time()
+    for i in range(n):
+        store.execute("INSERT INTO history (door, t, event) VALUES (?, ?, ?)",
+                ("Bench", time.time(), 1))
+    queued = time.time() - start
+    store.flush()
+    elapsed = time.time() - start
+    print("sqlite: {:.4f} ms per event to queue, {:.4f} ms including the commits, "
+            "{} commits for {} events".format(queued * 1000 / n, elapsed * 1000 / n,
+            store.commits, n))
+
+    old = shelve.open(os.path.join(d, "old.db"), writeback=True)
+    old["Bench"] = {"Open history": []}
+    start = time.time()
+    for i in range(n // 10):
+        old["Bench"]["Open history"].insert(0, time.strftime("%a %b %d %Y @ %I:%M:%S %p"))
+        old.sync()
+    elapsed = time.time() - start
+    print("shelve: {:.3f} ms per event ({} events)".format(elapsed * 1000 / (n // 10),
+            n // 10))
+    store.close()
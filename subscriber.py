@@ -7,7 +7,7 @@ class Subscriber(object):
         the garage
     """
     def __init__(self, name, phone=None, ip=None):
-        self._name = None
+        self._name = name
         self._phone = phone
         self._ip = ip
         return
@@ -34,8 +34,18 @@ class Subscriber(object):
         self._ip = ip
         return
 
-    def notify(self):
-        pass
+    def subscriptions(self, registry):
+        """ Everything this subscriber gets, subscription name -> event names """
+        if self._phone is None:
+            return {}
+        return registry.subscriptions_for(self._phone)
+
+    def notify(self, msg):
+        """ Send msg to this subscriber """
+        import garage_shared as GS
+        if self._phone is not None:
+            GS.send_message(msg, [self._phone,])
+        return
 
 
 if __name__ == "__main__":
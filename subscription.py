@@ -1,8 +1,185 @@
+'''
+    Who gets told about what. A Subscription_Registry holds every
+    subscription, indexed both ways:
+
+      forward - (subscription, event) -> set of phone numbers, used when
+        an event is published
+      inverted - phone number -> set of (subscription, event), used for
+        "what do I get" questions
+
+    so membership checks and bulk queries don't scan lists. Each change is
+    one row added or deleted in the store (storage.py).
+'''
+import threading
+import logging
+
+l = logging.getLogger(__name__)
+
+
+def _event_name(event):
+    """ Events are indexed by name, so localized copies match """
+    return getattr(event, "name", event)
 
 
 class Subscription(object):
     """
-        A subscription is a logical container for events. 
+        A subscription is a logical container for events.
         For example, a door has a subscription. And the
         events might be open, close, error, ...
     """
+
+    def __init__(self, registry, name, events=()):
+        self._registry = registry
+        self.name = name
+        self.events = list(events)
+        return
+
+    def subscribe(self, event, phone):
+        """ True if phone wasn't already subscribed """
+        return self._registry.add(self.name, event, phone)
+
+    def unsubscribe(self, event, phone):
+        """ True if phone was subscribed """
+        return self._registry.remove(self.name, event, phone)
+
+    def is_subscribed(self, event, phone):
+        return self._registry.is_subscribed(self.name, event, phone)
+
+    def subscribers(self, event):
+        """ Phone numbers subscribed to event """
+        return self._registry.subscribers(self.name, event)
+
+    def events_for(self, phone):
+        """ Names of the events phone gets from this subscription """
+        return self._registry.subscriptions_for(phone).get(self.name, frozenset())
+
+
+class Subscription_Registry(object):
+    """ All subscriptions. With no store nothing is saved """
+
+    def __init__(self, store=None):
+        self._lock = threading.Lock()
+        self._forward = {}
+        self._inverted = {}
+        self._subscriptions = {}
+        self._store = store
+        if store is not None:
+            for subscription, event, phone in store.query(
+                    "SELECT subscription, event, phone FROM subscriptions"):
+                self._index(subscription, event, phone)
+        return
+
+    def subscription(self, name, events=()):
+        """ The Subscription called name, created the first time """
+        with self._lock:
+            sub = self._subscriptions.get(name)
+            if sub is None:
+                sub = self._subscriptions[name] = Subscription(self, name, events)
+        return sub
+
+    def _index(self, subscription, event, phone):
+        phones = self._forward.setdefault((subscription, event), set())
+        if phone in phones:
+            return False
+        phones.add(phone)
+        self._inverted.setdefault(phone, set()).add((subscription, event))
+        return True
+
+    def add(self, subscription, event, phone):
+        """ Subscribe phone to an event, True if it wasn't already """
+        event = _event_name(event)
+        with self._lock:
+            added = self._index(subscription, event, phone)
+            if added and self._store is not None:
+                self._store.execute("INSERT OR IGNORE INTO subscriptions "
+                        "(subscription, event, phone) VALUES (?, ?, ?)",
+                        (subscription, event, phone))
+        return added
+
+    def remove(self, subscription, event, phone):
+        """ Unsubscribe phone from an event, True if it was subscribed """
+        event = _event_name(event)
+        with self._lock:
+            phones = self._forward.get((subscription, event))
+            if not phones or phone not in phones:
+                return False
+            phones.discard(phone)
+            if not phones:
+                del self._forward[(subscription, event)]
+            events = self._inverted[phone]
+            events.discard((subscription, event))
+            if not events:
+                del self._inverted[phone]
+            if self._store is not None:
+                self._store.execute("DELETE FROM subscriptions WHERE subscription = ? "
+                        "AND event = ? AND phone = ?", (subscription, event, phone))
+        return True
+
+    def remove_subscriber(self, phone):
+        """ Unsubscribe phone from everything, returns how many were removed """
+        with self._lock:
+            events = list(self._inverted.get(phone, ()))
+        for subscription, event in events:
+            self.remove(subscription, event, phone)
+        return len(events)
+
+    def is_subscribed(self, subscription, event, phone):
+        return phone in self._forward.get((subscription, _event_name(event)), ())
+
+    def subscribers(self, subscription, event):
+        """ Phone numbers subscribed to an event """
+        with self._lock:
+            return frozenset(self._forward.get((subscription, _event_name(event)), ()))
+
+    def subscriptions_for(self, phone):
+        """ Everything phone gets, as subscription name -> set of event names """
+        ret = {}
+        with self._lock:
+            for subscription, event in self._inverted.get(phone, ()):
+                ret.setdefault(subscription, set()).add(event)
+        return ret
+
+    def subscribers_all(self):
+        """ Every phone number with at least one subscription """
+        with self._lock:
+            return frozenset(self._inverted)
+
+    def migrate(self, subscription, event_sub_dict):
+        """
+            Load subscriptions saved the old way (dict of event -> list of
+            phone numbers), returns how many were added
+        """
+        count = 0
+        for event, phones in event_sub_dict.items():
+            for phone in phones:
+                if self.add(subscription, event, phone):
+                    count += 1
+        return count
+
+
+if __name__ == "__main__":
+    import time
+    # Old way: list per event, scanned on every check
+    doors = ["Door{}".format(i) for i in range(4)]
+    events = ["Open Event", "Close Event", "Timer Event", "Button Open Event",
+              "Button Close Event", "Door Opening Error Event", "Door Closing Error Event"]
+    phones = ["1555000{:04d}".format(i) for i in range(500)]
+    old = dict((d, dict((e, list(phones)) for e in events)) for d in doors)
+    r = Subscription_Registry()
+    for d in doors:
+        r.migrate(d, old[d])
+
+    n = 200
+    start = time.time()
+    for i in range(n):
+        p = phones[-1 - i]
+        for d in doors:
+            [e for e in events if p in old[d][e]]
+    old_secs = time.time() - start
+    start = time.time()
+    for i in range(n):
+        r.subscriptions_for(phones[-1 - i])
+    new_secs = time.time() - start
+    print("what does this number get, {} doors x {} events x {} numbers: "
+            "lists {:.2f} ms, registry {:.2f} ms".format(len(doors), len(events),
+            len(phones), old_secs * 1000 / n, new_secs * 1000 / n))
@@ -0,0 +1,210 @@
+'''
+    Ack-first handling of the plivo webhook. The request handler only copies
+    the form values and signature into a bounded in-memory ring and returns;
+    a validator thread then checks the signature and replay cache and
+    forwards good messages to the main process. Nothing on the request path
+    touches the network or the disk.
+
+    Stages:
+      capture - request handler puts the raw message in the ring
+      validate - signature (constant time compare), message age and replay
+        check
+      forward - put on the queue to the main process
+'''
+from collections import deque
+import threading
+import logging
+import hashlib
+import base64
+import hmac
+import time
+import metrics
+import runtime
+from replay_cache import uuid_time
+
+# Max number of captured messages waiting for the validator
+RING_SIZE = 256
+
+l = logging.getLogger(__name__)
+
+_STAGE_SECONDS = metrics.histogram("garage_webhook_stage_seconds",
+        "Secs a webhook message spends in each pipeline stage", ["stage"])
+_DROPPED = metrics.counter("garage_webhook_dropped_total",
+        "Webhook messages lost because the ring was full")
+_INVALID = metrics.counter("garage_webhook_invalid_total",
+        "Webhook messages that failed validation")
+_STALE = metrics.counter("garage_webhook_stale_total",
+        "Webhook messages ignored because their uuid was old or had no time")
+
+# Reasons a message is only logged and ignored. The Pi has no clock until
+# it syncs, so an odd looking time is no sign of an attack
+_STALE_REASONS = ("Message uuid has no time", "Expired msg")
+
+
+class Stage_Stats(object):
+    """ Count, total and max time for one pipeline stage """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._metric = _STAGE_SECONDS.labels(name)
+        return
+
+    def record(self, secs):
+        # Only ever updated from one thread per stage
+        self._metric.observe(secs)
+        self.count += 1
+        self.total += secs
+        if secs > self.max:
+            self.max = secs
+        return
+
+    def __str__(self):
+        return "{}: count {} avg {:.6f} max {:.6f}".format(self.name, self.count,
+                self.total / max(self.count, 1), self.max)
+
+
+def _utf8(s):
+    """ s as the bytes plivo signs """
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+class Signature_Validator(object):
+    """
+        Checks the X-Plivo-Signature header. The HMAC key schedule is done
+        once, each message just copies it.
+    """
+
+    def __init__(self, uri, auth_token):
+        self._uri = uri
+        self._mac = hmac.new(auth_token, digestmod=hashlib.sha1)
+        return
+
+    def signature(self, post_params):
+        """ Signature plivo would send for these form values """
+        mac = self._mac.copy()
+        mac.update(_utf8(self._uri))
+        for k, v in sorted(post_params.items()):
+            mac.update(_utf8(k) + _utf8(v))
+        return base64.b64encode(mac.digest())
+
+    def is_valid(self, post_params, signature):
+        return hmac.compare_digest(self.signature(post_params), str(signature))
+
+
+class Webhook_Pipeline(object):
+    """
+        capture() is called from the request handler, everything else happens
+        on the validator thread. on_invalid(reason) is called (once) if a
+        message fails validation, after that nothing more is forwarded. A
+        message that is only too old (or has no time) is ignored.
+    """
+
+    def __init__(self, validator, replay_cache, out_queue, on_invalid,
+            ring_size=RING_SIZE):
+        self._validator = validator
+        self._replay_cache = replay_cache
+        self._out_queue = out_queue
+        self._on_invalid = on_invalid
+        self._ring = deque(maxlen=ring_size)
+        self._ready = threading.Condition(threading.Lock())
+        self._stopped = False
+        self.dropped = 0
+        self.invalid = 0
+        self.stale = 0
+        self.stats = dict((name, Stage_Stats(name)) for name in
+                ("capture", "queued", "validate", "forward"))
+        self._capture_lock = threading.Lock()
+        metrics.gauge("garage_webhook_waiting", "Webhook messages waiting for the validator",
+                fn=lambda: len(self._ring))
+        self._thread = threading.Thread(target=self._run, name="Webhook_Validator")
+        self._thread.daemon = True
+        self._thread.start()
+        return
+
+    def capture(self, form, values, signature):
+        """
+            Save a copy of the message for the validator. form is the posted
+            form (what plivo signs), values is what gets forwarded.
+        """
+        start = time.time()
+        with self._ready:
+            if len(self._ring) == self._ring.maxlen:
+                # Ring is full, the oldest message is lost
+                self.dropped += 1
+                _DROPPED.inc()
+            self._ring.append((start, form, values, signature))
+            self._ready.notify()
+        with self._capture_lock:
+            self.stats["capture"].record(time.time() - start)
+        return
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._ring:
+                    self._ready.wait()
+                captured, form, values, signature = self._ring.popleft()
+            # One bad message mustn't take the only validator thread with it
+            try:
+                self._handle(captured, form, values, signature)
+            except Exception:
+                l.exception("Error handling message <{0}>".format(values))
+        return
+
+    def _handle(self, captured, form, values, signature):
+        """ Validate one captured message and forward it if it's good """
+        start = time.time()
+        self.stats["queued"].record(start - captured)
+        l.info("Got message: \"{0}\"".format(values))
+        reason = self._check(form, signature)
+        self.stats["validate"].record(time.time() - start)
+        if reason in _STALE_REASONS:
+            l.warning("Ignoring message <{0}>: {1}".format(values, reason))
+            self.stale += 1
+            _STALE.inc()
+            return
+        if reason is not None:
+            self.invalid += 1
+            _INVALID.inc()
+            if not self._stopped:
+                self._stopped = True
+                self._on_invalid(reason)
+            return
+        if self._stopped:
+            return
+        start = time.time()
+        self._out_queue.put(runtime.stamp(values))
+        self.stats["forward"].record(time.time() - start)
+        l.info("Put msg into queue")
+        self._replay_cache.maybe_expire()
+        return
+
+    def _check(self, form, signature):
+        """ Return None if the message is good, else the reason it isn't """
+        if signature is None:
+            return "No plivo sig"
+        if not self._validator.is_valid(form, signature):
+            return "Invalid hash"
+        if 'MessageUUID' not in form:
+            return "No message uuid"
+        uuid = str(form['MessageUUID'])
+        sent = uuid_time(uuid)
+        if sent is None:
+            return "Message uuid has no time"
+        # Too old to be in the replay cache, it can't be told from a replay
+        if not self._replay_cache.in_window(sent):
+            return "Expired msg"
+        if self._replay_cache.seen(uuid):
+            return "Duplicate msg"
+        return None
+
+    def summary(self):
+        lines = [str(s) for s in self.stats.values()]
+        lines.append("dropped: {} invalid: {} stale: {} waiting: {}".format(
+                self.dropped, self.invalid, self.stale, len(self._ring)))
+        return "\n".join(lines)